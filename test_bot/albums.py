@@ -0,0 +1,64 @@
+import os
+import asyncio
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Альбом (несколько фото/видео за раз) приходит отдельными сообщениями с общим
+# media_group_id. Middleware собирает их: обработчик с флагом album вызывается
+# один раз - на первом сообщении - и получает все сообщения альбома в аргументе
+# album. Альбом считается полным, когда ALBUM_WINDOW секунд не приходило новых
+# частей или набралось ALBUM_MAX_SIZE сообщений; части сверх лимита начинают
+# следующую пачку.
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 0.6))
+ALBUM_MAX_SIZE = int(os.getenv("ALBUM_MAX_SIZE", 10))
+
+
+class _Album:
+    def __init__(self):
+        self.messages = []
+        self.updated = asyncio.Event()  # Пришла новая часть или альбом заполнен
+        self.full = False
+
+
+class AlbumMiddleware(BaseMiddleware):
+    def __init__(self, window=ALBUM_WINDOW, max_size=ALBUM_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._albums = {}  # (chat_id, media_group_id) -> _Album
+
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, Message) or event.media_group_id is None or not get_flag(data, "album"):
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            # Часть уже собираемого альбома: её обработает первое сообщение
+            album.messages.append(event)
+            album.full = len(album.messages) >= self.max_size
+            if album.full:
+                del self._albums[key]
+            album.updated.set()
+            return None
+
+        album = self._albums[key] = _Album()
+        album.messages.append(event)
+        album.full = self.max_size <= 1
+        try:
+            while not album.full:
+                try:
+                    await asyncio.wait_for(album.updated.wait(), self.window)
+                except asyncio.TimeoutError:
+                    break
+                album.updated.clear()
+        finally:
+            if self._albums.get(key) is album:
+                del self._albums[key]
+        data["album"] = sorted(album.messages, key=lambda message: message.message_id)
+        return await handler(event, data)
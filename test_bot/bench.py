@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import itertools
+import subprocess
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# Нагрузочный прогон сценариев бота через настоящий Dispatcher из media_handler:
+# /start -> выбор филиала -> N сообщений -> подтверждение -> ответ администратора
+# -> отправка клиенту. Telegram подменяется фиктивной сессией, SMTP - локальным
+# приёмником писем; база данных - настоящая (локальный Postgres из POSTGRES_*).
+#   python bench.py --flows 200 --concurrency 20 --items 5 --output bench.json
+# Результат (JSON) содержит коммит, параметры и метрики - его удобно сравнивать между коммитами.
+
+BRANCH = "Филиал 1"
+ADMIN_ID = 900_000_001
+HEAD_OFFICE_ID = 900_000_000
+BOT_TOKEN = "123456:BENCHMARK"
+FILE_CONTENT = b"\xff\xd8\xff\xe0" + bytes(16 * 1024)  # Содержимое любого скачиваемого файла (~16 КБ)
+
+
+# Окружение выставляется до импорта media_handler: модули читают его при импорте
+def _configure_environment(smtp_port, real_limits):
+    os.environ.update({
+        "TOKEN_TG_TEST": os.getenv("TOKEN_TG_TEST") or BOT_TOKEN,
+        "BRANCHES_CONFIG": "",  # Без файла: филиалы берутся из переменных ниже
+        "BRANCH_COUNT": "1",
+        "ADMIN_ID_1": str(ADMIN_ID),
+        "ADMIN_EMAIL_1": "branch@bench.local",
+        "ADMIN_ID_MAIN": str(HEAD_OFFICE_ID),
+        "HEAD_OFFICE_EMAIL": "office@bench.local",
+        "EMAIL_USER": "bot@bench.local",
+        "EMAIL_PASSWORD": "",
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_USE_SSL": "0",
+        "OUTBOX_POLL_INTERVAL": "0.5",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL") or "WARNING",
+        # Счёт SQL-запросов ведёт ProfilingCursor; таблица не должна вытеснять запросы
+        "QUERY_PROFILING": "1",
+        "QUERY_STATS_SIZE": "100000",
+    })
+    if not real_limits:
+        # Фиктивный Telegram не ограничивает частоту - лимиты не должны искажать замер
+        os.environ.update({"DELIVERY_GLOBAL_RATE": "1000000", "DELIVERY_PRIVATE_RATE": "1000000",
+                           "DELIVERY_GROUP_RATE_PER_MINUTE": "60000000"})
+
+
+# Приёмник SMTP: принимает и считает письма, ничего не отправляет
+class SmtpSink:
+    def __init__(self):
+        self.messages = 0
+        self._server = None
+
+    async def _session(self, reader, writer):
+        def reply(line):
+            writer.write(f"{line}\r\n".encode())
+
+        reply("220 bench ESMTP")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors="replace").strip().upper()
+                if command.startswith("EHLO"):
+                    reply("250-bench")
+                    reply("250 8BITMIME")
+                elif command.startswith("DATA"):
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    while (await reader.readline()) not in (b".\r\n", b".\n", b""):
+                        pass
+                    self.messages += 1
+                    reply("250 OK")
+                elif command.startswith("QUIT"):
+                    reply("221 Bye")
+                    break
+                else:
+                    reply("250 OK")  # HELO, MAIL, RCPT, RSET, NOOP
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._session, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+def _fake_session_class():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMediaGroup, GetFile
+    from aiogram.types import Message, Chat, File
+
+    # Сессия Telegram без сети: считает вызовы и возвращает правдоподобные ответы
+    class FakeSession(BaseSession):
+        def __init__(self, latency=0.0):
+            super().__init__()
+            self.latency = latency
+            self.calls = Counter()
+            self._ids = itertools.count(1)
+
+        def _message(self, chat_id):
+            return Message(message_id=next(self._ids), date=datetime.now(),
+                           chat=Chat(id=int(chat_id or 0), type="private"))
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls[type(method).__name__] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            chat_id = getattr(method, "chat_id", None)
+            if isinstance(method, GetFile):  # Путь для bot.download, содержимое отдаёт stream_content
+                return File(file_id=method.file_id, file_unique_id=method.file_id, file_size=len(FILE_CONTENT),
+                            file_path=f"bench/{method.file_id}")
+            if isinstance(method, SendMediaGroup):
+                return [self._message(chat_id) for _ in method.media]
+            if type(method).__name__.startswith("Send"):
+                return self._message(chat_id)
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield FILE_CONTENT
+
+        async def close(self):
+            pass
+
+    return FakeSession
+
+
+# Синтетические обновления Telegram (сырые словари, как из getUpdates)
+class Updates:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id, text=None, photo=None):
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        if photo:
+            message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}]
+        else:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return {"update_id": next(self._ids), "message": message}
+
+    def callback(self, user_id, data):
+        update = self.message(user_id, text="menu")
+        return {"update_id": update["update_id"], "callback_query": {
+            "id": str(update["update_id"]), "from": self._user(user_id), "chat_instance": "bench",
+            "data": data, "message": update["message"]}}
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+# Выполненные SQL-запросы по нормализованному тексту (PREPARE и EXECUTE считаются отдельно)
+def _db_statements():
+    from profiling import query_stats
+    return query_stats.calls()
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+class Benchmark:
+    def __init__(self, dp, bot, flows, concurrency, items):
+        self.dp = dp
+        self.bot = bot
+        self.flows = flows
+        self.concurrency = concurrency
+        self.items = items
+        self.updates = Updates()
+        self.latencies = defaultdict(list)  # Шаг сценария -> задержки обработки обновления
+        self.failures = Counter()
+        self._admin_lock = asyncio.Lock()   # Один администратор отвечает по очереди
+
+    async def _feed(self, step, update):
+        started = time.perf_counter()
+        await self.dp.feed_raw_update(self.bot, update)
+        self.latencies[step].append(time.perf_counter() - started)
+
+    async def _state(self, user_id):
+        return await self.dp.fsm.get_context(self.bot, chat_id=user_id, user_id=user_id).get_data()
+
+    async def flow(self, user_id):
+        updates = self.updates
+        await self._feed("start", updates.message(user_id, text="/start"))
+        await self._feed("new_request", updates.callback(user_id, "new_request"))
+        await self._feed("select_branch", updates.callback(user_id, f"branch_{BRANCH}"))
+        request_id = (await self._state(user_id))["request_id"]
+        for index in range(self.items):
+            if index % 2:
+                await self._feed("get_content", updates.message(user_id, photo=f"photo-{user_id}-{index}"))
+            else:
+                await self._feed("get_content", updates.message(user_id, text=f"Сообщение {index} от {user_id}"))
+        await self._feed("confirm_send", updates.callback(user_id, f"confirm_send_{request_id}"))
+
+        async with self._admin_lock:
+            await self._feed("reply_to_client", updates.callback(ADMIN_ID, f"reply-to-client_{user_id}_{request_id}"))
+            await self._feed("admin_response", updates.message(ADMIN_ID, text=f"Ответ на обращение {request_id}"))
+            await self._feed("send_to_client", updates.callback(ADMIN_ID, f"send-to-client_{user_id}_{request_id}"))
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def guarded(user_id):
+            async with semaphore:
+                try:
+                    await self.flow(user_id)
+                except Exception as e:
+                    self.failures[type(e).__name__] += 1
+                    logging.exception("Сценарий пользователя %s завершился ошибкой", user_id)
+
+        base = int(time.time() * 1000) % 1_000_000 * 1000  # Новые пользователи при каждом запуске
+        started = time.perf_counter()
+        await asyncio.gather(*(guarded(base + index) for index in range(self.flows)))
+        return time.perf_counter() - started
+
+
+async def main(args):
+    sink = SmtpSink()
+    smtp_port = await sink.start()
+    _configure_environment(smtp_port, args.real_limits)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import media_handler
+    from db import init_database
+
+    session = _fake_session_class()(latency=args.telegram_latency / 1000)
+    session.middleware = media_handler.bot.session.middleware  # Сохраняем middleware метрик
+    media_handler.bot.session = session
+    dp, bot = media_handler.dp, media_handler.bot
+
+    await asyncio.to_thread(init_database)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    benchmark = Benchmark(dp, bot, args.flows, args.concurrency, args.items)
+    db_before = _db_statements()
+    try:
+        elapsed = await benchmark.run()
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)  # Дожидаемся фоновой доставки и записи
+        await sink.stop()
+    db_after = _db_statements()
+
+    all_latencies = [value for values in benchmark.latencies.values() for value in values]
+    updates = len(all_latencies)
+    db_per_query = {query: count - db_before.get(query, 0) for query, count in db_after.items()}
+    db_per_query = dict(sorted(((query, count) for query, count in db_per_query.items() if count),
+                               key=lambda item: item[1], reverse=True))
+    completed = args.flows - sum(benchmark.failures.values())
+
+    def summary(values):
+        return {"count": len(values),
+                **{f"p{q}_ms": round(_percentile(values, q) * 1000, 3) if values else None for q in (50, 95, 99)}}
+
+    result = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "params": {"flows": args.flows, "concurrency": args.concurrency, "items": args.items,
+                   "telegram_latency_ms": args.telegram_latency, "real_limits": args.real_limits},
+        "elapsed_s": round(elapsed, 3),
+        "updates": updates,
+        "updates_per_s": round(updates / elapsed, 1) if elapsed else None,
+        "flows_completed": completed,
+        "failures": dict(benchmark.failures),
+        "latency": summary(all_latencies),
+        "latency_by_step": {step: summary(values) for step, values in benchmark.latencies.items()},
+        "db_statements_per_flow": round(sum(db_per_query.values()) / max(completed, 1), 2),
+        "db_statements_by_query": db_per_query,
+        "telegram_calls": dict(session.calls),
+        "emails_received": sink.messages,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(result, file, ensure_ascii=False, indent=2)
+    print(json.dumps({key: result[key] for key in ("updates_per_s", "latency", "db_statements_per_flow", "peak_rss_mb")},
+                     ensure_ascii=False))
+    return 1 if benchmark.failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон сценариев бота")
+    parser.add_argument("--flows", type=int, default=100, help="число сценариев (клиентов)")
+    parser.add_argument("--concurrency", type=int, default=10, help="сценариев одновременно")
+    parser.add_argument("--items", type=int, default=4, help="сообщений клиента в обращении")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка ответа Telegram, мс")
+    parser.add_argument("--real-limits", action="store_true", help="не отключать ограничения частоты отправки")
+    parser.add_argument("--output", default="bench_output.json", help="файл с результатами (JSON)")
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,183 @@
+import os
+import json
+import asyncio
+import logging
+
+from aiogram import types
+from aiogram.filters import BaseFilter
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from dotenv import load_dotenv
+
+from export import REPORT_FORMATS, REPORT_FORMAT
+
+
+load_dotenv()
+
+# Филиалы и администраторы. Источник - JSON-файл BRANCHES_CONFIG:
+# {
+#     "head_office": {"chat_id": 100, "email": "office@example.com", "report_format": "csv"},
+#     "branches": [{"name": "Филиал 1", "chat_id": 101, "email": "branch1@example.com"}, ...]
+# }
+# Если файла нет, берутся переменные окружения ADMIN_ID_MAIN, HEAD_OFFICE_EMAIL,
+# ADMIN_ID_N и ADMIN_EMAIL_N для N = 1..BRANCH_COUNT.
+# report_format - формат отчётов для почты головного офиса (xlsx, csv, parquet),
+# по умолчанию REPORT_FORMAT.
+BRANCHES_CONFIG = os.getenv("BRANCHES_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "branches.json"))
+BRANCH_COUNT = int(os.getenv("BRANCH_COUNT", 3))
+BRANCHES_RELOAD_INTERVAL = float(os.getenv("BRANCHES_RELOAD_INTERVAL", 5))
+
+HEAD_OFFICE = "Головной офис"
+CALLBACK_DATA_LIMIT = 64  # Байт в callback_data
+
+
+class Branch:
+    def __init__(self, name, chat_id, email):
+        self.name = name
+        self.chat_id = chat_id
+        self.email = email
+
+
+def _chat_id(value):
+    return int(value) if value not in (None, "") else None
+
+
+def _load_config(path):
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    return {
+        "head_office": {"chat_id": os.getenv("ADMIN_ID_MAIN"), "email": os.getenv("HEAD_OFFICE_EMAIL")},
+        "branches": [
+            {"name": f"Филиал {n}", "chat_id": os.getenv(f"ADMIN_ID_{n}"), "email": os.getenv(f"ADMIN_EMAIL_{n}")}
+            for n in range(1, BRANCH_COUNT + 1)
+        ],
+    }
+
+
+# Неизменяемый снимок конфигурации: при перезагрузке собирается новый и
+# подменяется целиком, обработчики всегда видят согласованные данные
+class BranchConfig:
+    def __init__(self, config):
+        head_office = config.get("head_office") or {}
+        self.main_chat_id = _chat_id(head_office.get("chat_id"))
+        self.main_email = head_office.get("email")
+        self.main_report_format = head_office.get("report_format") or REPORT_FORMAT
+        if self.main_report_format not in REPORT_FORMATS:
+            raise ValueError(f"Неизвестный формат отчёта: {self.main_report_format}")
+
+        self.branches = {}
+        for entry in config.get("branches", []):
+            name = entry["name"]
+            if name == HEAD_OFFICE or name in self.branches:
+                raise ValueError(f"Повторяющееся название филиала: {name}")
+            if len(f"branch_{name}".encode("utf-8")) > CALLBACK_DATA_LIMIT:
+                raise ValueError(f"Слишком длинное название филиала: {name}")
+            self.branches[name] = Branch(name, _chat_id(entry.get("chat_id")), entry.get("email"))
+
+        # Множества целых chat_id для проверки роли за O(1)
+        self.branch_chat_ids = frozenset(b.chat_id for b in self.branches.values() if b.chat_id is not None)
+        self.admin_chat_ids = self.branch_chat_ids | ({self.main_chat_id} if self.main_chat_id else set())
+
+        # Статичные меню собираются один раз на конфигурацию
+        self.client_menu = self._main_menu(reports=False)
+        self.head_office_menu = self._main_menu(reports=True)
+        self.branch_menu = self._branch_menu()
+        self.branch_list = "\n".join(
+            f"{index} - {name}" for index, name in enumerate([*self.branches, HEAD_OFFICE], start=1))
+
+    @staticmethod
+    def _main_menu(reports):
+        markup = InlineKeyboardBuilder()
+        markup.add(
+            InlineKeyboardButton(text="Направить обращение", callback_data="new_request"),
+            InlineKeyboardButton(text="О боте", callback_data="about_bot")
+        )
+        if reports:
+            markup.add(InlineKeyboardButton(text="Отчет Excel", callback_data="report_excel"))
+        return markup.as_markup()
+
+    def _branch_menu(self):
+        markup = InlineKeyboardBuilder()
+        for name in [*self.branches, HEAD_OFFICE]:
+            markup.add(InlineKeyboardButton(text=name, callback_data=f"branch_{name}"))
+        markup.adjust(2)
+        return markup.as_markup()
+
+
+# Реестр филиалов: загружается один раз и перечитывается при изменении файла
+class BranchRegistry:
+    def __init__(self, path=BRANCHES_CONFIG, reload_interval=BRANCHES_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = self._file_mtime()
+        self.config = BranchConfig(_load_config(path))
+        self._task = None
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Перечитать конфигурацию, если файл изменился; при ошибке остаётся прежняя
+    def reload(self, force=False):
+        mtime = self._file_mtime()
+        if mtime == self._mtime and not force:
+            return False
+        self._mtime = mtime  # Ошибочный файл не перечитываем, пока его не исправят
+        try:
+            config = BranchConfig(_load_config(self.path))
+        except Exception as e:
+            logging.error("Ошибка в конфигурации филиалов %s, используется прежняя: %s", self.path, e)
+            return False
+        self.config = config
+        logging.info("Конфигурация филиалов перезагружена: %s филиалов", len(config.branches))
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            self.reload()
+
+    def start(self):
+        if self._task is None and self.reload_interval > 0:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get(self, name):
+        return self.config.branches.get(name)
+
+    def is_admin(self, chat_id):
+        return chat_id in self.config.admin_chat_ids
+
+    def is_head_office(self, chat_id):
+        return chat_id == self.config.main_chat_id
+
+    def main_menu(self, chat_id):
+        config = self.config
+        return config.head_office_menu if chat_id == config.main_chat_id else config.client_menu
+
+
+registry = BranchRegistry()
+
+
+# Сообщения из чатов администраторов (филиалов и головного офиса)
+class AdminChat(BaseFilter):
+    async def __call__(self, message: types.Message) -> bool:
+        return registry.is_admin(message.chat.id)
+
+
+# Сообщения клиентов - из любых других чатов
+class ClientChat(BaseFilter):
+    async def __call__(self, message: types.Message) -> bool:
+        return not registry.is_admin(message.chat.id)
@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+
+
+# Ограниченный LRU-кэш с временем жизни записей и счётчиками попаданий.
+# Хранит агрегаты обращений (шапка + элементы) по request_id.
+# Инвалидация видна только своему процессу, поэтому при нескольких процессах
+# кэш выключается (enabled = False) и каждое чтение идёт в базу.
+class RequestCache:
+    def __init__(self, max_size=1000, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()   # request_id -> (expires_at, request)
+        # Счётчик изменений: загрузка из базы не кладёт в кэш агрегат,
+        # если обращение изменилось, пока шло чтение
+        self._tick = 0
+        self._changed = {}           # request_id -> tick последнего изменения
+        self._pruned_at = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    # Копия агрегата, чтобы обработчики не меняли содержимое кэша
+    @staticmethod
+    def _copy(request):
+        return dict(request, items=list(request["items"]))
+
+    def get(self, request_id):
+        if not self.enabled:
+            self.misses += 1
+            return None
+        entry = self._data.get(request_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[request_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(request_id)
+        self.hits += 1
+        return self._copy(entry[1])
+
+    # Метка для put(..., since=...): берётся перед чтением из базы
+    def version(self):
+        return self._tick
+
+    def _touch(self, request_id):
+        self._tick += 1
+        self._changed[request_id] = self._tick
+        if len(self._changed) > self.max_size * 4:
+            self._changed.clear()
+            self._pruned_at = self._tick
+
+    def put(self, request_id, request, since=None):
+        if not self.enabled:
+            return
+        if since is not None and self._changed.get(request_id, self._pruned_at) > since:
+            return
+        self._data[request_id] = (time.monotonic() + self.ttl, self._copy(request))
+        self._data.move_to_end(request_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    # Добавление элемента к закэшированному обращению (если оно есть в кэше)
+    def append_item(self, request_id, item):
+        self._touch(request_id)
+        entry = self._data.get(request_id)
+        if entry is not None:
+            entry[1]["items"].append(item)
+
+    def invalidate(self, request_id):
+        self._touch(request_id)
+        self._data.pop(request_id, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,103 @@
+from aiogram.methods import SendMessage, SendMediaGroup, SendPhoto, SendVideo, SendVoice
+from aiogram.types import InputMediaPhoto, InputMediaVideo
+
+
+# Ограничения Telegram
+ALBUM_SIZE = 10         # Элементов в одной медиа-группе
+CAPTION_LIMIT = 1024    # Символов в подписи к медиа
+TEXT_LIMIT = 4096       # Символов в текстовом сообщении
+
+# Фото и видео можно смешивать в одном альбоме; голосовые в альбом не входят
+ALBUM_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo}
+SINGLE_MEDIA = {"photo": (SendPhoto, "photo"), "video": (SendVideo, "video"), "voice": (SendVoice, "voice")}
+
+# Заглушка chat_id в заготовках: настоящий подставляет for_chat()
+_NO_CHAT = 0
+
+
+# Медиа обращения, разложенные на отправки: альбомы по 2-10 фото/видео,
+# одиночные элементы и голосовые. Собирается один раз на обращение.
+class MediaSet:
+    def __init__(self, items):
+        visual = [item for item in items if item["content_type"] in ALBUM_MEDIA]
+        voices = [item for item in items if item["content_type"] == "voice"]
+
+        # Альбомы примерно одного размера: 11 элементов - это 6 + 5, а не 10 + 1
+        # (медиа-группа из одного элемента невозможна)
+        groups = -(-len(visual) // ALBUM_SIZE)
+        self.units = []  # (content_type, content) - одиночная отправка, список InputMedia - альбом
+        start = 0
+        for index in range(groups):
+            size = len(visual) // groups + (1 if index < len(visual) % groups else 0)
+            group = visual[start:start + size]
+            start += size
+            if len(group) == 1:
+                self.units.append((group[0]["content_type"], group[0]["content"]))
+            else:
+                self.units.append([ALBUM_MEDIA[item["content_type"]](media=item["content"]) for item in group])
+        self.units.extend((item["content_type"], item["content"]) for item in voices)
+
+    def __bool__(self):
+        return bool(self.units)
+
+
+# Разбиение длинного текста по строкам (или по границе лимита, если строка длиннее)
+def split_text(text, limit=TEXT_LIMIT):
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def _unit_method(unit, caption=None, reply_markup=None):
+    if isinstance(unit, list):
+        media = list(unit)
+        if caption:
+            media[0] = media[0].model_copy(update={"caption": caption})
+        return SendMediaGroup(chat_id=_NO_CHAT, media=media)
+    content_type, content = unit
+    method, field = SINGLE_MEDIA[content_type]
+    return method(chat_id=_NO_CHAT, caption=caption, reply_markup=reply_markup, **{field: content})
+
+
+# Минимальный набор вызовов API для текста и медиа: текст уходит подписью к
+# первому медиа, кнопки - на одиночное медиа, а отдельное текстовое сообщение
+# отправляется только если без него не обойтись (длинный текст или кнопки
+# при одних альбомах). Возвращает заготовки без chat_id (см. for_chat).
+def compose(media, text, reply_markup=None):
+    units = media.units if media else []
+    if not units:
+        chunks = split_text(text) if text else []
+        return [SendMessage(chat_id=_NO_CHAT, text=chunk,
+                            reply_markup=reply_markup if index == len(chunks) - 1 else None)
+                for index, chunk in enumerate(chunks)]
+
+    fits = bool(text) and len(text) <= CAPTION_LIMIT
+    # Куда ставить подпись: кнопки прикрепляются только к одиночному сообщению
+    if reply_markup is None:
+        target = 0 if fits else None
+    else:
+        target = next((i for i, unit in enumerate(units) if not isinstance(unit, list)), None) if fits else None
+
+    methods = [
+        _unit_method(unit, caption=text if index == target else None,
+                     reply_markup=reply_markup if index == target else None)
+        for index, unit in enumerate(units)
+    ]
+    if target is None and text:
+        chunks = split_text(text)
+        methods.extend(SendMessage(chat_id=_NO_CHAT, text=chunk,
+                                   reply_markup=reply_markup if index == len(chunks) - 1 else None)
+                       for index, chunk in enumerate(chunks))
+    return methods
+
+
+# Заготовки для конкретного получателя (копии без повторной сборки медиа)
+def for_chat(methods, chat_id):
+    return [method.model_copy(update={"chat_id": chat_id}) for method in methods]
@@ -1,151 +1,206 @@
-import random
+import os
 import logging
-from psycopg2 import sql
+from psycopg2.extras import execute_values
 from datetime import datetime, timedelta
 
 from db import get_database_connection
+from cache import RequestCache
+from drafts import DraftBuffer
+from pool import pool
+from statements import register, execute
 
 
-# Функция для генерации уникального пятизначного request_id
-def generate_unique_request_id():
-    conn = get_database_connection()
-    cursor = conn.cursor()
-    unique_id = None
+# Запросы выполняются на переданном соединении (conn) и вызываются
+# асинхронными функциями через пул соединений или синхронными обёртками ниже.
 
-    # Генерация уникального числа
-    while True:
-        potential_id = random.randint(100000, 999999)  # Генерация случайного числа
-        cursor.execute("SELECT 1 FROM requests WHERE request_id = %s", (potential_id,))
-        if not cursor.fetchone():  # Если не найдено совпадений, число уникально
-            unique_id = potential_id
-            break
 
-    cursor.close()
-    conn.close()
-    return unique_id
+# Элементы обращения не старше самого обращения (с запасом на расхождение часов
+# бота и базы): по этой границе запрос читает только секции последних месяцев
+ITEMS_CLOCK_SKEW = "1 day"
 
-# Функция для сохранения обращения клиента
-def save_client_request(user_id, branch=None):
-    conn = get_database_connection()
+# Сколько раз повторять вставку, если сгенерированный номер уже занят
+# (возможно только для номеров, выданных до перехода на серверный генератор)
+REQUEST_ID_ATTEMPTS = 10
+
+# Столбцы обращения, которые можно менять через update_client_request
+UPDATABLE_COLUMNS = ("branch", "admin_response")
+
+
+# Код ошибки PostgreSQL: последовательность дошла до MAXVALUE. request_id_counter
+# выдаёт не больше 900 000 номеров (остаток проверяет lifecycle.check_request_ids)
+SEQUENCE_LIMIT_EXCEEDED = "2200H"
+
+# Частые запросы готовятся один раз на соединение (statements.py)
+INSERT_REQUEST = register("insert_request", """
+    INSERT INTO requests (user_id, branch) VALUES ($1, $2)
+    ON CONFLICT (request_id) DO NOTHING
+    RETURNING request_id, user_id, branch, timestamp, admin_response
+""")
+
+INSERT_REQUEST_ITEM = register("insert_request_item", """
+    INSERT INTO request_items (request_id, content_type, content, file_unique_id) VALUES ($1, $2, $3, $4)
+""")
+
+# Обращение вместе с элементами одним запросом: элементы собираются в JSON-массив
+GET_REQUEST = register("get_request", f"""
+    SELECT r.request_id, r.user_id, r.branch, r.timestamp, r.admin_response,
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                          'item_id', ri.item_id, 'content_type', ri.content_type, 'content', ri.content,
+                          'file_unique_id', ri.file_unique_id, 'timestamp', ri.timestamp
+                      ) ORDER BY ri.timestamp)
+               FROM request_items AS ri
+               WHERE ri.request_id = r.request_id
+                 AND ri.timestamp >= COALESCE(r.timestamp - INTERVAL '{ITEMS_CLOCK_SKEW}', '-infinity')
+           ), '[]')
+    FROM requests AS r
+    WHERE r.request_id = $1
+""")
+
+DELETE_REQUEST_ITEMS = register("delete_request_items", """
+    DELETE FROM request_items WHERE request_id = $1
+""")
+
+
+# UPDATE для набора столбцов (только из UPDATABLE_COLUMNS); отсутствие строк - обращение не найдено
+def _update_statement(columns):
+    unknown = set(columns) - set(UPDATABLE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Столбцы нельзя изменять: {', '.join(sorted(unknown))}")
+    assignments = ", ".join(f"{column} = ${index}" for index, column in enumerate(columns, start=2))
+    return register(f"update_request_{'_'.join(columns)}",
+                    f"UPDATE requests SET {assignments} WHERE request_id = $1 RETURNING request_id")
+
+
+# Возвращает созданное обращение в том же виде, что и _get_client_request
+def _save_client_request(conn, user_id, branch):
     cursor = conn.cursor()
-    request_id = generate_unique_request_id()  # Генерируем уникальный request_id
+    request = None
 
     try:
-        # Вставка данных в таблицу requests
-        cursor.execute(
-            "INSERT INTO requests (request_id, user_id, branch) VALUES (%s, %s, %s)",
-            (request_id, user_id, branch)
-        )
+        # request_id генерирует сервер (next_request_id()), вставка - один запрос
+        for _ in range(REQUEST_ID_ATTEMPTS):
+            execute(cursor, INSERT_REQUEST, (user_id, branch))
+            row = cursor.fetchone()
+            if row:
+                request = {
+                    "request_id": row[0],
+                    "user_id": row[1],
+                    "branch": row[2],
+                    "timestamp": row[3],
+                    "admin_response": row[4],
+                    "items": [],
+                }
+                break
+        if request is None:
+            raise RuntimeError("не удалось получить свободный request_id")
         conn.commit()
-        logging.info(f"Запрос успешно сохранен с request_id: {request_id}")
+        logging.info("Запрос успешно сохранен с request_id: %s", request['request_id'])
     except Exception as e:
-        logging.error(f"Ошибка при сохранении обращения клиента: {e}")
+        if getattr(e, "pgcode", None) == SEQUENCE_LIMIT_EXCEEDED:
+            logging.critical("Номера обращений исчерпаны (request_id_counter), новые обращения не создаются")
+        else:
+            logging.error("Ошибка при сохранении обращения клиента: %s", e)
         conn.rollback()
-        request_id = None
+        request = None
     finally:
         cursor.close()
-        conn.close()
 
-    return request_id
+    return request
 
-# Функция для добавления элементов (текста, фото, видео) к запросу
-def add_request_item(request_id, content_type, content):
-    conn = get_database_connection()
-    cursor = conn.cursor()
 
-    # Проверка, что content_type соответствует одному из допустимых значений
-    if content_type not in ['text', 'photo', 'video', 'voice']:
-        logging.error(f"Некорректный тип контента: {content_type}")
-        return
+def _add_request_item(conn, request_id, content_type, content, file_unique_id=None):
+    cursor = conn.cursor()
 
     try:
         # Вставка элемента в таблицу request_items
-        cursor.execute(
-            "INSERT INTO request_items (request_id, content_type, content) VALUES (%s, %s, %s)",
-            (request_id, content_type, content)
-        )
+        execute(cursor, INSERT_REQUEST_ITEM, (request_id, content_type, content, file_unique_id))
         conn.commit()
-        logging.info(f"Элемент '{content_type}' успешно добавлен к запросу с ID {request_id}")
+        logging.info("Элемент '%s' успешно добавлен к запросу с ID %s", content_type, request_id)
     except Exception as e:
-        logging.error(f"Ошибка при добавлении элемента к запросу с ID {request_id}: {e}")
+        logging.error("Ошибка при добавлении элемента к запросу с ID %s: %s", request_id, e)
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
-# Функция для получения данных обращения по request_id
-def get_client_request(request_id):
-    conn = get_database_connection()
+
+# Пакетная вставка элементов: rows - (item_id, request_id, content_type, content, file_unique_id, timestamp)
+def _add_request_items(conn, rows):
+    cursor = conn.cursor()
+    try:
+        execute_values(
+            cursor,
+            "INSERT INTO request_items (item_id, request_id, content_type, content, file_unique_id, timestamp) "
+            "VALUES %s",
+            rows,
+            template="(%s::uuid, %s, %s, %s, %s, %s)",
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _item_from_json(item):
+    item["timestamp"] = datetime.fromisoformat(item["timestamp"])
+    return item
+
+
+def _get_client_request(conn, request_id):
     cursor = conn.cursor()
 
     try:
-        # Получение информации о запросе
-        cursor.execute("SELECT * FROM requests WHERE request_id = %s", (request_id,))
+        # Обращение и все его элементы - один запрос
+        execute(cursor, GET_REQUEST, (request_id,))
         request = cursor.fetchone()
-
-        # Получение всех элементов запроса
-        cursor.execute("SELECT content_type, content FROM request_items WHERE request_id = %s", (request_id,))
-        items = cursor.fetchall()
-
-        if request:
-            return {
-                "request_id": request[0],
-                "user_id": request[1],
-                "branch": request[2],
-                "timestamp": request[3],
-                "admin_response": request[4],
-                "items": [{"content_type": item[0], "content": item[1]} for item in items]
-            }
-        else:
+        if not request:
             return None
+        return {
+            "request_id": request[0],
+            "user_id": request[1],
+            "branch": request[2],
+            "timestamp": request[3],
+            "admin_response": request[4],
+            "items": [_item_from_json(item) for item in request[5]],
+        }
     except Exception as e:
-        logging.error(f"Ошибка при получении данных запроса с ID {request_id}: {e}")
+        logging.error("Ошибка при получении данных запроса с ID %s: %s", request_id, e)
         return None
     finally:
+        conn.rollback()  # Завершаем транзакцию только для чтения
         cursor.close()
-        conn.close()
 
-# Функция для обновления обращения клиента
-def update_client_request(request_id, **fields):
-    conn = get_database_connection()
+
+def _update_client_request(conn, request_id, fields):
+    columns = sorted(fields)
     cursor = conn.cursor()
 
     try:
-        # Проверяем, существует ли запрос с указанным request_id
-        cursor.execute("SELECT COUNT(1) FROM requests WHERE request_id = %s", (request_id,))
-        exists = cursor.fetchone()[0]
-
-        if not exists:
-            logging.error(f"Запрос с ID {request_id} не найден в базе данных.")
+        # Обновление одним запросом: RETURNING без строк - обращения нет
+        execute(cursor, _update_statement(columns), (request_id, *(fields[column] for column in columns)))
+        if cursor.fetchone() is None:
+            logging.error("Запрос с ID %s не найден в базе данных.", request_id)
+            conn.rollback()
             return False
-
-        # Обновление основного запроса
-        set_clause = ', '.join(f"{field} = %s" for field in fields.keys())
-        values = list(fields.values()) + [request_id]
-
-        cursor.execute(
-            sql.SQL("UPDATE requests SET " + set_clause + " WHERE request_id = %s"),
-            values
-        )
         conn.commit()
-        logging.info(f"Запрос с ID {request_id} успешно обновлен: {fields}")
+        logging.info("Запрос с ID %s успешно обновлен: %s", request_id, fields)
     except Exception as e:
-        logging.error(f"Ошибка при обновлении запроса с ID {request_id}: {e}")
+        logging.error("Ошибка при обновлении запроса с ID %s: %s", request_id, e)
         conn.rollback()
         return False
     finally:
         cursor.close()
-        conn.close()
 
     return True
 
 
-def fetch_requests_in_period(start_date, end_date):
+def _fetch_requests_in_period(conn, start_date, end_date):
+    cursor = conn.cursor()
     try:
-        conn = get_database_connection()
-        cursor = conn.cursor()
-
-        # SQL-запрос для выборки данных за период
+        # SQL-запрос для выборки данных за период. Условие на ri.timestamp -
+        # ключ секционирования: читаются только секции месяцев периода
         query = '''
         SELECT r.request_id, r.user_id, r.branch, ri.content_type, ri.content, ri.timestamp
         FROM requests AS r
@@ -155,24 +210,249 @@ def fetch_requests_in_period(start_date, end_date):
         '''
 
         cursor.execute(query, (start_date, end_date))
-        data = cursor.fetchall()
+        return cursor.fetchall()
+    except Exception as e:
+        # Пустой результат при ошибке выглядел бы как пустой период
+        logging.error("Ошибка при выборке обращений за период %s - %s: %s", start_date, end_date, e)
+        raise
+    finally:
+        conn.rollback()
+        cursor.close()
+
 
-        # Закрываем соединение
+# Потоковая выборка за период для отчётов: именованный (серверный) курсор
+# отдаёт строки порциями по chunk_size, память не зависит от размера периода
+def iter_requests_in_period(conn, start_date, end_date, chunk_size=2000):
+    cursor = conn.cursor(name="requests_in_period")
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute('''
+        SELECT r.request_id, r.user_id, r.branch, ri.content_type, ri.content, ri.timestamp
+        FROM requests AS r
+        JOIN request_items AS ri ON r.request_id = ri.request_id
+        WHERE ri.timestamp BETWEEN %s AND %s
+        ORDER BY ri.timestamp;
+        ''', (start_date, end_date))
+        yield from cursor
+    finally:
         cursor.close()
-        conn.close()
+        conn.rollback()
+
+
+# Максимальная длина значений каждого столбца отчёта за период (считает сервер)
+def period_column_lengths(conn, start_date, end_date):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+        SELECT max(length(r.request_id::text)), max(length(r.user_id::text)), max(length(r.branch)),
+               max(length(ri.content_type)), max(length(ri.content)),
+               max(length(ri.timestamp::timestamp::text))
+        FROM requests AS r
+        JOIN request_items AS ri ON r.request_id = ri.request_id
+        WHERE ri.timestamp BETWEEN %s AND %s;
+        ''', (start_date, end_date))
+        return [length or 0 for length in cursor.fetchone()]
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+# Медиа за период (для архива к отчёту): request_id, content_type, file_id, file_unique_id
+def period_media(conn, start_date, end_date):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+        SELECT request_id, content_type, content, file_unique_id
+        FROM request_items
+        WHERE timestamp BETWEEN %s AND %s AND file_unique_id IS NOT NULL
+        ORDER BY timestamp;
+        ''', (start_date, end_date))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.rollback()
+
 
-        return data
+def _delete_request_items(conn, request_id):
+    cursor = conn.cursor()
+    try:
+        # Здесь выполняется SQL-запрос на удаление записей из таблицы request_items
+        execute(cursor, DELETE_REQUEST_ITEMS, (request_id,))
+        conn.commit()
     except Exception as e:
-        print("Ошибка при выполнении запроса:", e)
-        return []
+        logging.error("Ошибка при удалении элементов запроса с ID %s: %s", request_id, e)
+        conn.rollback()
+    finally:
+        cursor.close()
+
+
+# Буфер черновиков: элементы обращения записываются в базу пачками
+draft_buffer = DraftBuffer(
+    lambda rows: pool.run(_add_request_items, rows),
+    flush_size=int(os.getenv("DRAFT_FLUSH_SIZE", 20)),
+    flush_interval=float(os.getenv("DRAFT_FLUSH_INTERVAL", 5)),
+)
+
+
+# Кэш агрегатов обращений: предпросмотр и подтверждение не ходят в базу
+request_cache = RequestCache(
+    max_size=int(os.getenv("REQUEST_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("REQUEST_CACHE_TTL", 600)),
+)
+
+
+# Несколько процессов вебхука (WEBHOOK_PROCESSES > 1) не видят память друг
+# друга: подтверждение в одном процессе не записало бы элементы, принятые другим,
+# удаление не отбросило бы их черновики, а кэш отдавал бы устаревший агрегат
+# без новых элементов или ответа администратора. В этом режиме элементы пишутся
+# в базу сразу, а обращения читаются из базы.
+def disable_process_buffers():
+    draft_buffer.enabled = False
+    request_cache.enabled = False
+
+
+# Асинхронный API для обработчиков aiogram: запросы не блокируют событийный цикл
+
+# Функция для сохранения обращения клиента
+async def save_client_request(user_id, branch=None):
+    request = await pool.run(_save_client_request, user_id, branch)
+    if request is None:
+        return None
+    request_cache.put(request["request_id"], request)
+    return request["request_id"]
+
+
+async def _add_items(request_id, items):
+    if not items:
+        return
+    if not draft_buffer.enabled:
+        await draft_buffer.write(request_id, [draft_buffer.item(*item) for item in items])
+        request_cache.invalidate(request_id)
+        return
+    for item in items:
+        request_cache.append_item(request_id, draft_buffer.add(request_id, *item))
+    if draft_buffer.full(request_id):
+        await draft_buffer.flush()
+
+
+# Функция для добавления элементов (текста, фото, видео) к запросу.
+# Элемент попадает в буфер черновиков и записывается в базу при следующем сбросе.
+async def add_request_item(request_id, content_type, content, file_unique_id=None):
+    # Проверка, что content_type соответствует одному из допустимых значений
+    if content_type not in ['text', 'photo', 'video', 'voice']:
+        logging.error("Некорректный тип контента: %s", content_type)
+        return
+    if request_id is None:
+        logging.error("Элемент '%s' не добавлен: не указан request_id", content_type)
+        return
+    request_id = int(request_id)
+    await _add_items(request_id, [(content_type, content, file_unique_id)])
+    logging.debug("Элемент '%s' добавлен в черновик запроса с ID %s", content_type, request_id)
 
 
-def delete_request_items(request_id):
+# Несколько элементов за раз (альбом): items - (content_type, content, file_unique_id).
+# Все элементы попадают в черновик вместе и записываются одной пачкой.
+async def add_request_items(request_id, items):
+    if request_id is None:
+        logging.error("Элементы не добавлены: не указан request_id")
+        return
+    request_id = int(request_id)
+    valid = []
+    for content_type, content, file_unique_id in items:
+        if content_type not in ['text', 'photo', 'video', 'voice']:
+            logging.error("Некорректный тип контента: %s", content_type)
+            continue
+        valid.append((content_type, content, file_unique_id))
+    await _add_items(request_id, valid)
+    logging.debug("В черновик запроса с ID %s добавлено элементов: %s", request_id, len(valid))
+    if len(valid) < len(items):
+        logging.warning("В черновик запроса с ID %s не добавлено элементов: %s", request_id, len(items) - len(valid))
+
+
+# Запись всех накопленных черновиков в базу
+async def flush_request_items():
+    await draft_buffer.flush()
+
+
+# Функция для получения данных обращения по request_id (база + несохранённые элементы)
+async def get_client_request(request_id):
+    if request_id is None:
+        return None
+    request_id = int(request_id)
+    request = request_cache.get(request_id)
+    if request is not None:
+        return request
+    # Снимок буфера берём до чтения: элемент, записанный во время чтения,
+    # окажется либо в снимке, либо в результате запроса
+    version = request_cache.version()
+    pending = draft_buffer.pending(request_id)
+    request = await pool.run(_get_client_request, request_id)
+    if request and pending:
+        stored = {item["item_id"] for item in request["items"]}
+        request["items"].extend(item for item in pending if item["item_id"] not in stored)
+    if request is not None:
+        request_cache.put(request_id, request, since=version)
+    return request
+
+
+# Функция для обновления обращения клиента
+async def update_client_request(request_id, **fields):
+    updated = await pool.run(_update_client_request, request_id, fields)
+    request_cache.invalidate(int(request_id))
+    return updated
+
+
+async def fetch_requests_in_period(start_date, end_date):
+    return await pool.run(_fetch_requests_in_period, start_date, end_date)
+
+
+async def get_period_media(start_date, end_date):
+    return await pool.run(period_media, start_date, end_date)
+
+
+# Удаление элементов обращения: черновик отбрасывается в памяти, записанное - в базе
+async def delete_request_items(request_id):
+    request_id = int(request_id)
+    await draft_buffer.discard(request_id)
+    request_cache.invalidate(request_id)
+    await pool.run(_delete_request_items, request_id)
+
+
+# Синхронные обёртки для кода вне событийного цикла (отчёты, скрипты)
+
+def _with_connection(func, *args):
     conn = get_database_connection()
-    cursor = conn.cursor()
-    # Здесь выполняется SQL-запрос на удаление записей из таблицы request_items
-    cursor.execute('''
-        DELETE FROM request_items
-        WHERE request_id = %s;
-    ''', (request_id,))
-    conn.commit()
\ No newline at end of file
+    if conn is None:
+        raise ConnectionError("Не удалось установить соединение с базой данных")
+    try:
+        return func(conn, *args)
+    finally:
+        conn.close()
+
+
+def save_client_request_sync(user_id, branch=None):
+    request = _with_connection(_save_client_request, user_id, branch)
+    return request["request_id"] if request else None
+
+
+def add_request_item_sync(request_id, content_type, content, file_unique_id=None):
+    if content_type not in ['text', 'photo', 'video', 'voice']:
+        logging.error("Некорректный тип контента: %s", content_type)
+        return
+    _with_connection(_add_request_item, request_id, content_type, content, file_unique_id)
+
+
+def get_client_request_sync(request_id):
+    return _with_connection(_get_client_request, request_id)
+
+
+def update_client_request_sync(request_id, **fields):
+    return _with_connection(_update_client_request, request_id, fields)
+
+
+def fetch_requests_in_period_sync(start_date, end_date):
+    return _with_connection(_fetch_requests_in_period, start_date, end_date)
+
+
+def delete_request_items_sync(request_id):
+    _with_connection(_delete_request_items, request_id)
@@ -2,6 +2,10 @@ import psycopg2
 from psycopg2 import OperationalError
 from dotenv import load_dotenv
 import os
+import logging
+
+from profiling import ProfilingCursor, QUERY_PROFILING
+from statements import StatementConnection
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -14,50 +18,32 @@ def get_database_connection():
             port=os.getenv("POSTGRES_PORT"),
             dbname=os.getenv("POSTGRES_DB"),
             user=os.getenv("POSTGRES_USER"),
-            password=os.getenv("POSTGRES_PASSWORD")
+            password=os.getenv("POSTGRES_PASSWORD"),
+            # Соединение с реестром подготовленных запросов (statements.py)
+            connection_factory=StatementConnection,
+            # Замер каждого запроса при QUERY_PROFILING=1 (по умолчанию - обычный курсор)
+            cursor_factory=ProfilingCursor if QUERY_PROFILING else None
         )
         return conn  # Возвращаем соединение
     except OperationalError as e:
-        print("Ошибка соединения с базой данных:", e)
+        logging.error("Ошибка соединения с базой данных: %s", e)
         return None
 
-# Функция для инициализации базы данных (создание таблиц)
+# Функция для инициализации базы данных: применяет недостающие миграции
+# (migrations/*.sql). Если схема актуальна, DDL не выполняется.
 def init_database():
+    from migrate import migrate_up, schema_is_current  # migrate сам импортирует db
+
     conn = get_database_connection()
     if conn is None:
-        print("Не удалось установить соединение с базой данных.")
+        logging.error("Не удалось установить соединение с базой данных.")
         return
 
     try:
-        cursor = conn.cursor()
-
-        # SQL для создания таблицы requests
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS requests (
-            request_id SERIAL PRIMARY KEY,          -- Уникальный идентификатор обращения
-            user_id BIGINT NOT NULL,                -- Идентификатор клиента
-            branch TEXT,                            -- Выбранный филиал
-            timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP, -- Дата и время создания обращения
-            admin_response TEXT                     -- Ответ администратора
-        );
-        ''')
-
-        # SQL для создания таблицы request_items
-        cursor.execute('''
-        CREATE EXTENSION IF NOT EXISTS "uuid-ossp";  -- Убедимся, что расширение UUID доступно
-
-        CREATE TABLE IF NOT EXISTS request_items (
-        item_id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),   -- Уникальный идентификатор элемента с авто-генерацией UUID
-        request_id INT REFERENCES requests(request_id) ON DELETE CASCADE,  -- Связь с таблицей requests
-        content_type TEXT CHECK (content_type IN ('text', 'photo', 'video', 'voice')), -- Тип содержимого
-        content TEXT,                           -- Текст или ID файла для фото/видео
-        timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP  -- Дата и время добавления элемента
-);
-        ''')
-
-        conn.commit()
+        if schema_is_current(conn):
+            return
+        migrate_up(conn)
     except Exception as e:
-        print("Ошибка при инициализации базы данных:", e)
+        logging.error("Ошибка при инициализации базы данных: %s", e)
     finally:
-        cursor.close()
-        conn.close()
\ No newline at end of file
+        conn.close()
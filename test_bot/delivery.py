@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict, deque
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError
+from aiogram.methods import SendMediaGroup
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Приоритеты доставки: ответы пользователю не ждут дублирования в головной офис
+HIGH = 0     # Ответы пользователю
+NORMAL = 1   # Доставка администратору филиала
+LOW = 2      # Дублирование в головной офис
+
+
+# Ведро токенов с резервированием: reserve() сразу списывает токен и
+# возвращает, сколько нужно подождать до отправки
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate             # Токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0     # Пауза после ответа 429 (retry_after)
+
+    def reserve(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+# Планировщик отправки в Telegram: задания разным получателям выполняются
+# параллельно, сообщения одному чату - по порядку. Скорость ограничена
+# глобально и для каждого чата, при 429 отправка в чат приостанавливается
+# на retry_after и повторяется.
+class DeliveryScheduler:
+    def __init__(self, bot, workers=8, global_rate=30.0, private_rate=1.0, group_rate=20 / 60,
+                 max_retries=3, max_chats=10000):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()      # chat_id -> TokenBucket
+        self._active = {}                # chat_id -> очередь заданий чата, который сейчас обслуживается
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._tasks = []
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id - группа или канал
+            rate = self.group_rate if int(chat_id) < 0 else self.private_rate
+            bucket = TokenBucket(rate, max(1.0, rate * 3))
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    # Стоимость для общего лимита: альбом - по сообщению на элемент. Лимит чата
+    # Telegram считает по запросам, и альбом в нём - одна отправка: иначе альбом
+    # из 10 элементов ждал бы в группе (1 токен в 3 с) почти полминуты.
+    @staticmethod
+    def _cost(method):
+        return len(method.media) if isinstance(method, SendMediaGroup) else 1
+
+    async def _call(self, chat_id, method):
+        bucket = self._bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            wait = max(bucket.reserve(), self._global.reserve(self._cost(method)))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                return await self.bot(method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning("Ограничение Telegram для чата %s: повтор через %s с", chat_id, e.retry_after)
+                bucket.block(e.retry_after)
+            except TelegramNetworkError as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning("Сетевая ошибка при отправке в чат %s: %s", chat_id, e)
+                bucket.block(2 ** attempt)
+
+    async def _run_job(self, chat_id, methods, future):
+        try:
+            result = [await self._call(chat_id, method) for method in methods]
+            if not future.cancelled():
+                future.set_result(result)
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+
+    # Чат обслуживает один воркер: задания в занятый чат ставятся в его очередь,
+    # а остальные воркеры свободны для других получателей
+    async def _work(self):
+        while True:
+            _, _, chat_id, methods, future = await self._queue.get()
+            if chat_id in self._active:
+                # task_done вызовет воркер, который обслуживает этот чат
+                self._active[chat_id].append((methods, future))
+                continue
+            jobs = self._active[chat_id] = deque([(methods, future)])
+            try:
+                while jobs:
+                    await self._run_job(chat_id, *jobs[0])
+                    jobs.popleft()
+                    self._queue.task_done()
+            finally:
+                for _, pending in self._active.pop(chat_id):
+                    pending.cancel()
+                    self._queue.task_done()
+
+    def _submit(self, chat_id, methods, priority):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._counter), chat_id, list(methods), future))
+        return future
+
+    # Доставка последовательности методов одному чату; возвращает результаты методов
+    async def deliver(self, chat_id, methods, priority=NORMAL):
+        return await self._submit(chat_id, methods, priority)
+
+    # Доставка без ожидания результата: ошибки только записываются в лог.
+    # Возвращает future - на него можно повесить колбэк по завершении доставки.
+    def post(self, chat_id, methods, priority=NORMAL):
+        def log_error(future):
+            if not future.cancelled() and future.exception():
+                logging.error("Не удалось доставить сообщение в чат %s: %s", chat_id, future.exception())
+        future = self._submit(chat_id, methods, priority)
+        future.add_done_callback(log_error)
+        return future
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10.0):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pending = self._queue.qsize() + sum(len(jobs) for jobs in self._active.values())
+            logging.warning("Не доставлено сообщений при остановке: %s", pending)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+def create_scheduler(bot):
+    return DeliveryScheduler(
+        bot,
+        workers=int(os.getenv("DELIVERY_WORKERS", 8)),
+        global_rate=float(os.getenv("DELIVERY_GLOBAL_RATE", 30)),
+        private_rate=float(os.getenv("DELIVERY_PRIVATE_RATE", 1)),
+        group_rate=float(os.getenv("DELIVERY_GROUP_RATE_PER_MINUTE", 20)) / 60,
+    )
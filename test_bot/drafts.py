@@ -0,0 +1,133 @@
+import uuid
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+
+# Буфер черновиков: элементы обращения копятся в памяти и записываются в базу
+# одной пачкой - по достижении размера, по таймеру, при подтверждении и при остановке.
+# Элемент остаётся в буфере, пока его запись не подтверждена базой, поэтому
+# чтение "база + буфер" никогда не теряет элементы.
+# Буфер виден только своему процессу: при нескольких процессах вебхука он
+# выключается (enabled = False), и элементы записываются в базу сразу через write().
+class DraftBuffer:
+    def __init__(self, write, flush_size=20, flush_interval=5.0, max_attempts=5):
+        self._write = write                  # async write(rows) - пакетная вставка
+        self.enabled = True
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._items = {}                     # request_id -> [item, ...]
+        self._attempts = {}                  # request_id -> число неудачных записей подряд
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self):
+        return sum(len(items) for items in self._items.values())
+
+    @staticmethod
+    def item(content_type, content, file_unique_id=None):
+        return {
+            "item_id": str(uuid.uuid4()),
+            "content_type": content_type,
+            "content": content,
+            "file_unique_id": file_unique_id,
+            "timestamp": datetime.now(timezone.utc),
+        }
+
+    # Добавление элемента в буфер
+    def add(self, request_id, content_type, content, file_unique_id=None):
+        item = self.item(content_type, content, file_unique_id)
+        self._items.setdefault(request_id, []).append(item)
+        return item
+
+    # Запись элементов в базу, минуя буфер
+    async def write(self, request_id, items):
+        await self._write(self._rows({request_id: items}))
+
+    # Черновик достиг порога и его пора записать
+    def full(self, request_id):
+        return len(self._items.get(request_id, ())) >= self.flush_size
+
+    # Элементы черновика, ещё не подтверждённые базой
+    def pending(self, request_id):
+        return list(self._items.get(request_id, ()))
+
+    # Удаление черновика без обращения к базе.
+    # Ждём завершения текущей записи, чтобы она не вернула удалённые элементы.
+    async def discard(self, request_id):
+        async with self._lock:
+            self._attempts.pop(request_id, None)
+            return self._items.pop(request_id, [])
+
+    async def flush(self):
+        async with self._lock:
+            batch = {request_id: list(items) for request_id, items in self._items.items() if items}
+            if not batch:
+                return
+            started = time.monotonic()
+            try:
+                await self._write(self._rows(batch))
+                written = batch
+            except Exception as e:
+                # Одна ошибочная пачка не должна блокировать остальные черновики
+                logging.error("Ошибка пакетной записи черновиков, запись по одному обращению: %s", e)
+                written = await self._flush_each(batch)
+
+            for request_id, items in written.items():
+                self._forget(request_id, items)
+            logging.info("Записано элементов черновиков: %s за %.3f с", sum(map(len, written.values())),
+                         time.monotonic() - started)
+
+    async def _flush_each(self, batch):
+        written = {}
+        for request_id, items in batch.items():
+            try:
+                await self._write(self._rows({request_id: items}))
+                written[request_id] = items
+            except Exception as e:
+                attempts = self._attempts.get(request_id, 0) + 1
+                self._attempts[request_id] = attempts
+                logging.error("Не удалось записать черновик %s (попытка %s): %s", request_id, attempts, e)
+                if attempts >= self.max_attempts:
+                    logging.error("Черновик %s отброшен после %s попыток", request_id, attempts)
+                    written[request_id] = items
+        return written
+
+    def _forget(self, request_id, items):
+        self._attempts.pop(request_id, None)
+        ids = {item["item_id"] for item in items}
+        rest = [item for item in self._items.get(request_id, ()) if item["item_id"] not in ids]
+        if rest:
+            self._items[request_id] = rest
+        else:
+            self._items.pop(request_id, None)
+
+    @staticmethod
+    def _rows(batch):
+        return [
+            (item["item_id"], request_id, item["content_type"], item["content"], item["file_unique_id"],
+             item["timestamp"])
+            for request_id, items in batch.items()
+            for item in items
+        ]
+
+    # Фоновый сброс по таймеру: при падении процесса теряется не больше flush_interval
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error("Ошибка фонового сброса черновиков: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
@@ -1,51 +1,83 @@
-import openpyxl
-from openpyxl.styles import Font, Alignment
+import os
 from datetime import datetime, timedelta
 
-from crud import fetch_requests_in_period
+from rollups import iter_range_rows, range_column_lengths, range_summary
 
 
-def report_generation(period):
-    # Устанавливаем временной интервал для выборки данных
-    today = datetime.now()
+# Заголовки таблицы
+HEADERS = ["ID обращения", "ID клиента", "Филиал", "Тип содержимого", "Содержимое", "Дата и время"]
+SUMMARY_HEADERS = ["Филиал", "Тип содержимого", "Количество"]
+
+# Сколько строк за раз забирать из базы
+REPORT_CHUNK_SIZE = int(os.getenv("REPORT_CHUNK_SIZE", 2000))
+
+
+# Временной интервал для выборки данных
+def report_period(period, today=None):
+    today = today or datetime.now()
     if period == "day":
         start_date = today - timedelta(days=1)
     elif period == "week":
         start_date = today - timedelta(weeks=1)
     else:
         raise ValueError("Неверный период для генерации отчета")
+    return start_date, today
 
-    # Запрашиваем данные из базы данных
-    data = fetch_requests_in_period(start_date, today)
 
-    # Создание нового Excel-файла и активного листа
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Отчет"
+# Имя вложения с отчётом
+def report_name(period, today=None, extension=".xlsx"):
+    today = today or datetime.now()
+    return f"report_{period}_{today.strftime('%Y%m%d')}{extension}"
 
-    # Заголовки таблицы
-    headers = ["ID обращения", "ID клиента", "Филиал", "Тип содержимого", "Содержимое", "Дата и время"]
-    ws.append(headers)
 
-    # Стили заголовков
-    for cell in ws[1]:
+def _header_row(ws, headers):
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment
+
+    row = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal="center")
+        row.append(cell)
+    return row
 
-    # Заполняем Excel-файл данными из запроса
-    for row in data:
-        # Извлекаем данные и конвертируем datetime без временной зоны
-        row = list(row)
-        if isinstance(row[-1], datetime):
-            row[-1] = row[-1].replace(tzinfo=None)  # Убираем временную зону
-        ws.append(row)
+
+# Книга отчёта пишется потоком: строки идут прямо в файл (режим write_only),
+# в памяти не держится ни выборка, ни книга целиком. Дни читаются из готовых
+# снимков (rollups, части интервала - из prepare_range), из базы - только
+# строки после конца снимка текущего дня.
+# openpyxl импортируется здесь: он нужен только процессу, строящему отчёт,
+# а бот импортирует этот модуль ради report_period и report_name.
+def write_workbook(conn, parts, file_path):
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    # В режиме write_only ширина столбцов записывается до первой строки,
+    # поэтому длины значений берём заранее: из снимков дней и одним
+    # агрегирующим запросом за остаток после конца снимка
+    lengths = range_column_lengths(conn, parts)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Отчет")
 
     # Автоматическое изменение ширины столбцов
-    for col in ws.columns:
-        max_length = max(len(str(cell.value)) for cell in col if cell.value) + 2
-        ws.column_dimensions[col[0].column_letter].width = max_length
+    for index, (header, length) in enumerate(zip(HEADERS, lengths), start=1):
+        ws.column_dimensions[get_column_letter(index)].width = max(len(header), length) + 2
+
+    # Стили заголовков
+    ws.append(_header_row(ws, HEADERS))
+
+    # Заполняем Excel-файл данными (время уже без временной зоны)
+    for row in iter_range_rows(conn, parts, REPORT_CHUNK_SIZE):
+        ws.append(row)
+
+    # Сводка по филиалам и типам содержимого
+    summary = wb.create_sheet("Сводка")
+    for index, width in enumerate([24, 18, 12], start=1):
+        summary.column_dimensions[get_column_letter(index)].width = width
+    summary.append(_header_row(summary, SUMMARY_HEADERS))
+    for (branch, content_type), items in range_summary(conn, parts):
+        summary.append([branch or "-", content_type, items])
 
-    # Сохраняем файл и возвращаем путь к нему
-    file_path = f"report_{period}_{today.strftime('%Y%m%d')}.xlsx"
     wb.save(file_path)
-    return file_path
@@ -0,0 +1,112 @@
+import os
+import gzip
+import tempfile
+import importlib.util
+
+from dotenv import load_dotenv
+
+from db import get_database_connection
+from crud import iter_requests_in_period
+from excel import write_workbook, report_period, REPORT_CHUNK_SIZE
+from rollups import prepare_range, range_key
+
+
+load_dotenv()
+
+# Форматы отчёта за период. xlsx - таблица со сводкой (excel.py); csv и
+# parquet - выгрузка строк для BI-систем без построения книги: CSV пишется
+# напрямую из потока COPY ... TO STDOUT в gzip, Parquet - пачками строк из
+# серверного курсора. Память в обоих случаях не зависит от размера периода.
+# Parquet требует необязательный пакет pyarrow.
+REPORT_FORMATS = {"xlsx": ".xlsx", "csv": ".csv.gz", "parquet": ".parquet"}
+REPORT_FORMAT = os.getenv("REPORT_FORMAT", "xlsx")  # Формат по умолчанию (для получателя без настройки)
+CSV_COMPRESSLEVEL = int(os.getenv("REPORT_CSV_COMPRESSLEVEL", 6))
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+COLUMNS = ("request_id", "user_id", "branch", "content_type", "content", "timestamp")
+
+PERIOD_QUERY = '''
+SELECT r.request_id, r.user_id, r.branch, ri.content_type, ri.content, ri.timestamp
+FROM requests AS r
+JOIN request_items AS ri ON r.request_id = ri.request_id
+WHERE ri.timestamp BETWEEN %s AND %s
+ORDER BY ri.timestamp
+'''
+
+
+def available_formats():
+    return [fmt for fmt in REPORT_FORMATS if fmt != "parquet" or PARQUET_AVAILABLE]
+
+
+def _write_csv(conn, start_date, end_date, file_path):
+    cursor = conn.cursor()
+    try:
+        query = cursor.mogrify(PERIOD_QUERY, (start_date, end_date)).decode("utf-8")
+        with open(file_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=CSV_COMPRESSLEVEL) as file:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", file)
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+def _write_parquet(conn, start_date, end_date, file_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("request_id", pa.int64()), ("user_id", pa.int64()), ("branch", pa.string()),
+        ("content_type", pa.string()), ("content", pa.string()), ("timestamp", pa.timestamp("us", tz="UTC")),
+    ])
+
+    def batch(rows):
+        return pa.record_batch([pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)],
+                               schema=schema)
+
+    with pq.ParquetWriter(file_path, schema, compression="zstd") as writer:
+        rows = []
+        for row in iter_requests_in_period(conn, start_date, end_date, REPORT_CHUNK_SIZE):
+            rows.append(row)
+            if len(rows) >= REPORT_CHUNK_SIZE:
+                writer.write_batch(batch(rows))
+                rows = []
+        if rows:
+            writer.write_batch(batch(rows))
+
+
+WRITERS = {"csv": _write_csv, "parquet": _write_parquet}
+
+
+# Отчёт за период в выбранном формате (выполняется в процессе ReportJobs).
+# Возвращает путь к временному файлу (его удаляет вызывающий код) и ключ
+# отчёта - версии снимков дней, из которых он построен (None - окно прочитано
+# из базы не только через снимки, и готовый файл повторно не используется).
+def build_report(period, today=None, fmt="xlsx"):
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат отчёта: {fmt}")
+    if fmt == "parquet" and not PARQUET_AVAILABLE:
+        raise RuntimeError("Для отчёта в формате Parquet нужен пакет pyarrow")
+
+    start_date, today = report_period(period, today)
+    conn = get_database_connection()
+    if conn is None:
+        raise ConnectionError("Не удалось установить соединение с базой данных")
+    try:
+        fd, file_path = tempfile.mkstemp(prefix=f"report_{period}_", suffix=REPORT_FORMATS[fmt])
+        os.close(fd)
+        try:
+            if fmt == "xlsx":
+                # Снимки дней проверяются и достраиваются один раз на весь отчёт
+                parts = prepare_range(conn, start_date, today)
+                write_workbook(conn, parts, file_path)
+                key = range_key(parts)
+            else:
+                # CSV и Parquet - один потоковый запрос к базе за всё окно, без снимков
+                WRITERS[fmt](conn, start_date, today, file_path)
+                key = None
+        except Exception:
+            os.remove(file_path)
+            raise
+        return file_path, key
+    finally:
+        conn.close()
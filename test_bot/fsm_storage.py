@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from dotenv import load_dotenv
+
+from pool import pool
+
+
+load_dotenv()
+
+
+def _get_record(conn, key):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT state, data FROM fsm_states WHERE key = %s AND expires_at > now()",
+            (key,)
+        )
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else (None, {})
+    finally:
+        conn.rollback()
+        cursor.close()
+
+
+def _set_state(conn, key, state, ttl):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO fsm_states (key, state, expires_at)
+            VALUES (%s, %s, now() + %s * interval '1 second')
+            ON CONFLICT (key) DO UPDATE
+            SET state = EXCLUDED.state,
+                data = CASE WHEN fsm_states.expires_at > now() THEN fsm_states.data ELSE '{}' END,
+                expires_at = EXCLUDED.expires_at
+            RETURNING data
+            """,
+            (key, state, ttl)
+        )
+        data = cursor.fetchone()[0]
+        conn.commit()
+        return data
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Запись данных; merge=True - слияние с текущими данными (update_data) одним запросом
+def _set_data(conn, key, data, ttl, merge):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO fsm_states (key, data, expires_at)
+            VALUES (%s, %s::jsonb, now() + %s * interval '1 second')
+            ON CONFLICT (key) DO UPDATE
+            SET data = CASE
+                    WHEN %s AND fsm_states.expires_at > now() THEN fsm_states.data || EXCLUDED.data
+                    ELSE EXCLUDED.data
+                END,
+                state = CASE WHEN fsm_states.expires_at > now() THEN fsm_states.state END,
+                expires_at = EXCLUDED.expires_at
+            RETURNING state, data
+            """,
+            (key, json.dumps(data), ttl, merge)
+        )
+        state, data = cursor.fetchone()
+        conn.commit()
+        return state, data
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _purge_expired(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM fsm_states WHERE expires_at <= now()")
+        conn.commit()
+        return cursor.rowcount
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Хранилище состояний FSM в PostgreSQL: переживает перезапуск и общее для
+# нескольких процессов бота. Чтение кэшируется локально на короткое время
+# (cache_ttl), запись всегда идёт в базу и обновляет локальный кэш. Кэш другого
+# процесса об этой записи не знает, поэтому при нескольких процессах вебхука
+# cache_ttl = 0 - каждое чтение из базы.
+class PostgresStorage(BaseStorage):
+    def __init__(self, ttl=7 * 24 * 3600, cache_ttl=1.0, cache_size=10000,
+                 purge_interval=3600.0, key_builder=None):
+        self.ttl = ttl                      # Через сколько секунд неактивный диалог сбрасывается
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.purge_interval = purge_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = {}                    # key -> (cached_at, state, data)
+        self._purge_task = None
+
+    def _cached(self, key):
+        entry = self._cache.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.cache_ttl:
+            return None
+        return entry
+
+    def _remember(self, key, state, data):
+        if self.cache_ttl <= 0:
+            return
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[key] = (time.monotonic(), state, data)
+
+    async def _load(self, key):
+        entry = self._cached(key)
+        if entry is not None:
+            return entry[1], entry[2]
+        state, data = await pool.run(_get_record, key)
+        self._remember(key, state, data)
+        return state, data
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        data = await pool.run(_set_state, key, state, self.ttl)
+        self._remember(key, state, data)
+
+    async def get_state(self, key):
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = self.key_builder.build(key)
+        state, data = await pool.run(_set_data, key, data, self.ttl, False)
+        self._remember(key, state, data)
+
+    async def get_data(self, key):
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    async def update_data(self, key, data):
+        key = self.key_builder.build(key)
+        state, data = await pool.run(_set_data, key, data, self.ttl, True)
+        self._remember(key, state, data)
+        return dict(data)
+
+    # Периодическое удаление просроченных диалогов
+    async def _purge(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                deleted = await pool.run(_purge_expired)
+                logging.info("Удалено просроченных состояний FSM: %s", deleted)
+            except Exception as e:
+                logging.error("Ошибка при очистке состояний FSM: %s", e)
+
+    def start(self):
+        if self._purge_task is None:
+            self._purge_task = asyncio.create_task(self._purge())
+
+    async def close(self):
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            self._purge_task = None
+        self._cache.clear()
+
+
+# Выбор хранилища: FSM_STORAGE=postgres (по умолчанию) или memory (один процесс, без сохранения)
+def create_storage():
+    backend = os.getenv("FSM_STORAGE", "postgres")
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "postgres":
+        return PostgresStorage(
+            ttl=int(os.getenv("FSM_TTL", 7 * 24 * 3600)),
+            cache_ttl=float(os.getenv("FSM_CACHE_TTL", 1)),
+        )
+    raise ValueError(f"Неизвестное хранилище FSM: {backend}")
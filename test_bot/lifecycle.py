@@ -0,0 +1,311 @@
+import os
+import re
+import csv
+import sys
+import gzip
+import uuid
+import asyncio
+import logging
+import argparse
+from datetime import date
+
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+from db import get_database_connection
+from metrics import REQUEST_IDS_REMAINING
+
+
+load_dotenv()
+
+# Жизненный цикл элементов обращений. request_items секционирована по месяцам
+# (миграция 0004): обслуживание заранее создаёт секции на PARTITION_MONTHS_AHEAD
+# месяцев вперёд, а секции старше ITEMS_RETENTION_MONTHS отсоединяет, выгружает
+# в сжатый CSV в ITEMS_ARCHIVE_DIR и удаляет из базы.
+#   python lifecycle.py maintain         - создать секции и заархивировать старые
+#   python lifecycle.py status           - секции в базе, файлы архива и остаток номеров обращений
+#   python lifecycle.py restore 2024-01  - вернуть месяц из архива в базу
+# Восстановленный месяц снова уйдёт в архив при следующем обслуживании,
+# если он по-прежнему старше срока хранения.
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+ITEMS_RETENTION_MONTHS = int(os.getenv("ITEMS_RETENTION_MONTHS", 0))  # 0 - не архивировать
+ITEMS_ARCHIVE_DIR = os.getenv("ITEMS_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                "archive"))
+LIFECYCLE_INTERVAL_HOURS = float(os.getenv("LIFECYCLE_INTERVAL_HOURS", 24))
+# Номера обращений выдаёт next_request_id() из последовательности request_id_counter
+# (миграция 0001) - не больше 900 000 номеров. Обслуживание проверяет остаток и
+# предупреждает в логе, когда израсходована доля REQUEST_ID_WARN_RATIO
+REQUEST_ID_WARN_RATIO = float(os.getenv("REQUEST_ID_WARN_RATIO", 0.9))
+# Ключ advisory-блокировки: обслуживание не выполняется двумя процессами одновременно
+LOCK_KEY = 72_460_012
+
+PARTITION_NAME = re.compile(r"^request_items_y(\d{4})m(\d{2})$")
+
+
+def partition_name(month):
+    return f"request_items_y{month.year:04d}m{month.month:02d}"
+
+
+def partition_month(name):
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def archive_path(name, directory=ITEMS_ARCHIVE_DIR):
+    return os.path.join(directory, f"{name}.csv.gz")
+
+
+def ensure_partitions(conn, months_ahead=PARTITION_MONTHS_AHEAD):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT request_items_ensure_partitions(%s)", (months_ahead,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Помесячные секции: [(имя, присоединена)]. Отсоединённая секция остаётся,
+# если архивация прервалась между отсоединением и удалением
+def list_partitions(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+        SELECT relname, relispartition
+        FROM pg_class
+        WHERE relkind = 'r' AND relname ~ '^request_items_y[0-9]{4}m[0-9]{2}$' AND pg_table_is_visible(oid)
+        ORDER BY relname;
+        ''')
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+def _write_archive(cursor, name, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    query = sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(name))
+    try:
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as file:
+                cursor.copy_expert(query.as_string(cursor), file)
+            raw.flush()
+            os.fsync(raw.fileno())  # Файл на диске до удаления секции из базы
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Присоединение и отсоединение секции не вызывают триггеров request_items:
+# снимки дней месяца (rollups.py) отмечаются устаревшими явно
+def _touch_month(cursor, month):
+    cursor.execute("UPDATE daily_rollup_days SET version = version + 1 WHERE day >= %s AND day < %s",
+                   (month, add_months(month, 1)))
+
+
+# Архивация секции: отсоединение, выгрузка в файл, удаление. Возвращает путь к архиву
+def archive_partition(conn, name, attached=True, directory=ITEMS_ARCHIVE_DIR):
+    path = archive_path(name, directory)
+    cursor = conn.cursor()
+    try:
+        if attached:
+            cursor.execute(sql.SQL("ALTER TABLE request_items DETACH PARTITION {}").format(sql.Identifier(name)))
+            _touch_month(cursor, partition_month(name))
+            conn.commit()
+        _write_archive(cursor, name, path)
+        conn.rollback()
+        cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    logging.info("Секция %s перенесена в архив %s", name, path)
+    return path
+
+
+# Возврат месяца из архива: таблица по образцу request_items, загрузка и присоединение
+def restore_partition(conn, month, directory=ITEMS_ARCHIVE_DIR):
+    name = partition_name(month)
+    path = archive_path(name, directory)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Нет архива {path}")
+    table = sql.Identifier(name)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql.SQL("CREATE TABLE {} (LIKE request_items INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+                       .format(table))
+        with gzip.open(path, "rb") as file:
+            columns = next(csv.reader([file.readline().decode("utf-8")]))
+            query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                table, sql.SQL(", ").join(map(sql.Identifier, columns)))
+            cursor.copy_expert(query.as_string(cursor), file)
+        cursor.execute(sql.SQL("ALTER TABLE request_items ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+            table, sql.Literal(month.isoformat()), sql.Literal(add_months(month, 1).isoformat())))
+        _touch_month(cursor, month)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    logging.info("Секция %s восстановлена из архива %s", name, path)
+    return name
+
+
+# Обслуживание: секции вперёд и архивация старых. Возвращает имена заархивированных секций
+def maintain(conn, retention_months=ITEMS_RETENTION_MONTHS, months_ahead=PARTITION_MONTHS_AHEAD,
+             directory=ITEMS_ARCHIVE_DIR):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_KEY,))
+        locked = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        cursor.close()
+    if not locked:
+        logging.info("Обслуживание секций уже выполняется другим процессом")
+        return []
+
+    archived = []
+    try:
+        ensure_partitions(conn, months_ahead)
+        if retention_months > 0:
+            cutoff = add_months(date.today().replace(day=1), -retention_months)
+            for name, attached in list_partitions(conn):
+                if partition_month(name) < cutoff:
+                    archive_partition(conn, name, attached, directory)
+                    archived.append(name)
+    finally:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+    return archived
+
+
+# Израсходовано и всего номеров обращений в последовательности request_id_counter
+def request_id_usage(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT last_value, min_value, max_value FROM pg_sequences
+            WHERE schemaname = current_schema() AND sequencename = 'request_id_counter'
+        """)
+        last_value, min_value, max_value = cursor.fetchone()
+        conn.commit()
+    finally:
+        cursor.close()
+    used = 0 if last_value is None else last_value - min_value + 1
+    return used, max_value - min_value + 1
+
+
+# Остаток номеров в метрику; предупреждение, когда он подходит к концу
+def check_request_ids(conn, warn_ratio=REQUEST_ID_WARN_RATIO):
+    used, total = request_id_usage(conn)
+    REQUEST_IDS_REMAINING.set(total - used)
+    if used >= total * warn_ratio:
+        logging.warning("Номера обращений заканчиваются: выдано %s из %s, осталось %s", used, total, total - used)
+    return used, total
+
+
+def run_maintenance():
+    conn = get_database_connection()
+    if conn is None:
+        raise ConnectionError("Не удалось установить соединение с базой данных")
+    try:
+        check_request_ids(conn)
+        return maintain(conn)
+    finally:
+        conn.close()
+
+
+# Периодическое обслуживание в фоне бота (на отдельном соединении, не из пула:
+# выгрузка большой секции не должна занимать соединение обработчиков)
+class LifecycleJob:
+    def __init__(self, interval=LIFECYCLE_INTERVAL_HOURS * 3600):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                archived = await asyncio.to_thread(run_maintenance)
+                if archived:
+                    logging.info("В архив перенесены секции: %s", ', '.join(archived))
+            except Exception as e:
+                logging.error("Ошибка обслуживания секций request_items: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+lifecycle_job = LifecycleJob()
+
+
+def _parse_month(value):
+    year, month = value.split("-")
+    return date(int(year), int(month), 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Секции и архив элементов обращений")
+    parser.add_argument("command", choices=["maintain", "status", "restore"])
+    parser.add_argument("month", nargs="?", type=_parse_month, help="месяц для restore: ГГГГ-ММ")
+    parser.add_argument("--retention", type=int, default=ITEMS_RETENTION_MONTHS,
+                        help="хранить в базе столько месяцев (0 - не архивировать)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "restore" and args.month is None:
+        parser.error("укажите месяц: restore ГГГГ-ММ")
+
+    conn = get_database_connection()
+    if conn is None:
+        return 2
+    try:
+        if args.command == "maintain":
+            check_request_ids(conn)
+            archived = maintain(conn, args.retention)
+            print(f"Заархивировано секций: {len(archived)}")
+            return 0
+        if args.command == "restore":
+            print(f"Восстановлена секция {restore_partition(conn, args.month)}")
+            return 0
+        for name, attached in list_partitions(conn):
+            print(f"{name}: {'в базе' if attached else 'отсоединена'}")
+        used, total = request_id_usage(conn)
+        print(f"Номера обращений: выдано {used} из {total}")
+        if os.path.isdir(ITEMS_ARCHIVE_DIR):
+            for filename in sorted(os.listdir(ITEMS_ARCHIVE_DIR)):
+                if filename.endswith(".csv.gz"):
+                    size = os.path.getsize(os.path.join(ITEMS_ARCHIVE_DIR, filename))
+                    print(f"{filename}: архив, {size / 1024 / 1024:.1f} МБ")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
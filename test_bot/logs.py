@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import contextvars
+import logging.handlers
+from datetime import datetime, timezone
+
+from aiogram import BaseMiddleware
+from dotenv import load_dotenv
+
+from metrics import Counter
+
+
+load_dotenv()
+
+# Логирование без блокировки событийного цикла: обработчики только кладут
+# запись в очередь (QueueHandler), форматирование и запись в stderr выполняет
+# фоновый поток (QueueListener). В записи добавляются request_id, user_id и имя
+# обработчика из контекста (contextvars) - в JSON-формате это отдельные поля.
+#   LOG_LEVEL=INFO                       - уровень по умолчанию
+#   LOG_LEVELS=crud=DEBUG,aiogram=WARNING - уровни по модулям/логгерам
+#   LOG_FORMAT=text|json
+#   LOG_DEBUG_SAMPLE=0.01                - доля записей DEBUG, которые попадают в лог
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", 1.0))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+LOG_RECORDS = Counter("bot_log_records_total", "Записи лога, поставленные в очередь", ["level"])
+LOG_DROPPED = Counter("bot_log_dropped_total", "Записи лога, отброшенные из-за переполнения очереди")
+LOG_EMIT_SECONDS = Counter("bot_log_emit_seconds_total", "Время постановки записей лога в очередь")
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+user_id_var = contextvars.ContextVar("user_id", default=None)
+handler_var = contextvars.ContextVar("handler", default=None)
+
+
+# Привязка request_id к текущему обновлению: попадает во все записи до конца обработки
+def bind_request(request_id):
+    request_id_var.set(request_id)
+
+
+def _parse_levels(value):
+    levels = {}
+    for part in filter(None, (item.strip() for item in value.split(","))):
+        name, _, level = part.partition("=")
+        levels[name.strip()] = _level(level)
+    return levels
+
+
+def _level(name):
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Неизвестный уровень логирования: {name}")
+    return level
+
+
+# Контекст и фильтры выполняются в вызывающем потоке, до очереди
+class ContextFilter(logging.Filter):
+    def __init__(self, level=logging.INFO, levels=None, debug_sample=1.0):
+        super().__init__()
+        self.level = level
+        self.levels = levels or {}   # модуль или логгер -> уровень
+        self.debug_sample = debug_sample
+        self._thresholds = {}        # (логгер, модуль) -> уровень
+
+    # Порог записи: для вызовов через корневой логгер (logging.info) - по имени
+    # модуля, для именованных логгеров - по ближайшему настроенному родителю
+    def _threshold(self, name, module):
+        if name == "root":
+            return self.levels.get(module, self.level)
+        while name:
+            if name in self.levels:
+                return self.levels[name]
+            name = name.rpartition(".")[0]
+        return self.level
+
+    def filter(self, record):
+        key = (record.name, record.module)
+        threshold = self._thresholds.get(key)
+        if threshold is None:
+            threshold = self._thresholds[key] = self._threshold(record.name, record.module)
+        if record.levelno < threshold:
+            return False
+        if record.levelno < logging.INFO and self.debug_sample < 1.0 and random.random() >= self.debug_sample:
+            return False
+        record.request_id = request_id_var.get()
+        record.user_id = user_id_var.get()
+        record.handler = handler_var.get()
+        return True
+
+
+# Запись уходит в очередь без форматирования: сообщение собирается из
+# аргументов уже в фоновом потоке (аргументы не должны меняться после вызова)
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+    def handle(self, record):
+        started = time.perf_counter()
+        try:
+            return super().handle(record)
+        finally:
+            LOG_RECORDS.inc(level=record.levelname)
+            LOG_EMIT_SECONDS.inc(time.perf_counter() - started)
+
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("request_id", "user_id", "handler", "duration_ms")
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name if record.name != "root" else record.module,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _Logging:
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+
+    def _start_listener(self):
+        self.handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *self.output, respect_handler_level=True)
+        self.listener.start()
+
+    def setup(self, level=LOG_LEVEL, levels=LOG_LEVELS, fmt=LOG_FORMAT, debug_sample=LOG_DEBUG_SAMPLE,
+              stream=None):
+        if self.handler is not None:
+            return
+        levels = _parse_levels(levels)
+        level = _level(level)
+
+        stream_handler = logging.StreamHandler(stream or sys.stderr)
+        stream_handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+        self.output = [stream_handler]
+
+        self.handler = BackgroundQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        self.handler.addFilter(ContextFilter(level, levels, debug_sample))
+        root = logging.getLogger()
+        # Корневой логгер пропускает самый подробный из настроенных уровней,
+        # пороги отдельных модулей и логгеров проверяет ContextFilter
+        root.setLevel(min([level, *levels.values()]))
+        root.handlers[:] = [self.handler]
+        self._start_listener()
+        atexit.register(self.stop)
+        # После fork (процессы вебхука) поток записи в дочернем процессе не существует
+        os.register_at_fork(after_in_child=self._start_listener)
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()  # Дописывает всё, что осталось в очереди
+            self.listener = None
+
+
+_logging = _Logging()
+setup_logging = _logging.setup
+stop_logging = _logging.stop
+
+
+# Контекст обновления для записей лога (user_id, имя обработчика) и запись
+# DEBUG о длительности обработчика - она же подвержена выборке LOG_DEBUG_SAMPLE
+class LogContext(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__ if "handler" in data else None
+        user = getattr(event, "from_user", None)
+        tokens = (request_id_var.set(None), user_id_var.set(user.id if user else None), handler_var.set(name))
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            duration_ms = round((time.perf_counter() - started) * 1000, 3)
+            logging.debug("Обработчик %s выполнен за %.1f мс", name, duration_ms, extra={"duration_ms": duration_ms})
+            for var, token in zip((request_id_var, user_id_var, handler_var), tokens):
+                var.reset(token)
+
+
+def setup_log_context(dp):
+    middleware = LogContext()
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(middleware)
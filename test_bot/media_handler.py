@@ -1,41 +1,78 @@
 import os
+import signal
+import asyncio
 import logging
+import argparse
+from startup import startup_profile, SchemaCheck, FirstUpdateProfile  # Первым: отсчёт времени запуска
+from datetime import datetime
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardButton
+from aiogram.methods import SendMessage
 from dotenv import load_dotenv
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from crud import save_client_request, get_client_request, update_client_request, add_request_item, delete_request_items
+from crud import (save_client_request, get_client_request, update_client_request, add_request_items, get_period_media,
+                  delete_request_items, flush_request_items, draft_buffer, disable_process_buffers)
 from db import init_database
-from send_email import send_email
-from excel import report_generation
+from fsm_storage import create_storage
+from pool import pool
+from outbox import outbox
+from excel import report_name, report_period
+from export import REPORT_FORMATS, available_formats
+from reports import report_jobs, ReportScheduler
+from webhook import run_webhook, WEBHOOK_PROCESSES
+from delivery import create_scheduler, HIGH, NORMAL, LOW
+from compose import MediaSet, compose, for_chat
+from branches import registry, AdminChat, ClientChat, HEAD_OFFICE
+from metrics import setup_metrics, metrics_server, observe_request_delivery
+from profiling import query_stats
+from lifecycle import lifecycle_job
+from albums import AlbumMiddleware
+from logs import setup_logging, setup_log_context, bind_request
+from media_store import email_attachments, media_archive, EMAIL_ATTACHMENTS_MAX_MB
 
 
 load_dotenv()
+startup_profile.mark("импорт модулей")
 
-ADMIN_CHAT_IDS = {
-    "Филиал 1": os.getenv("ADMIN_ID_1"),
-    "Филиал 2": os.getenv("ADMIN_ID_2"),
-    "Филиал 3": os.getenv("ADMIN_ID_3"),
-}
+setup_logging()  # Запись лога в фоновом потоке, уровни и формат - LOG_* в .env
 
-ADMIN_EMAIL = {
-    "Филиал 1": os.getenv("ADMIN_EMAIL_1"),
-    "Филиал 2": os.getenv("ADMIN_EMAIL_2"),
-    "Филиал 3": os.getenv("ADMIN_EMAIL_3"),
-}
+storage = create_storage()  # FSM_STORAGE=postgres|memory
+bot = Bot(token=os.getenv("TOKEN_TG_TEST"))
+dp = Dispatcher(storage=storage)  # Передаем storage как именованный аргумент
+schema_check = SchemaCheck(init_database)  # Миграции схемы - параллельно с запуском бота
+dp.update.outer_middleware(FirstUpdateProfile())  # Время до первого обработанного обновления
+dp.message.middleware(AlbumMiddleware())  # Альбом - один вызов обработчика с флагом album
+setup_log_context(dp)  # user_id, обработчик и request_id в записях лога
+setup_metrics(dp, bot)  # Время обработчиков и вызовов Telegram API
 
-ADMIN_CHAT_ID_MAIN = os.getenv("ADMIN_ID_MAIN") # ID галовного филиала
 
-logging.basicConfig(level=logging.INFO)
+def _static_markup(*buttons):
+    markup = InlineKeyboardBuilder()
+    markup.add(*(InlineKeyboardButton(text=text, callback_data=data) for text, data in buttons))
+    return markup.as_markup()
 
-storage = MemoryStorage()
-bot = Bot(token=os.getenv("TOKEN_TG_TEST"))
-dp = Dispatcher(storage=storage)  # Передаем storage как именованный аргумент
+
+# Статичные клавиатуры собираются один раз
+def _report_menu():
+    markup = InlineKeyboardBuilder()
+    markup.add(InlineKeyboardButton(text="Отчет за день", callback_data="report_day"),
+               InlineKeyboardButton(text="Отчёт за неделю", callback_data="report_week"))
+    # Выгрузки для BI-систем: без построения таблицы Excel
+    for fmt in available_formats():
+        if fmt != "xlsx":
+            markup.add(InlineKeyboardButton(text=f"Неделя, {fmt.upper()}", callback_data=f"report_week_{fmt}"))
+    markup.adjust(2)
+    return markup.as_markup()
+
+
+REPORT_MENU = _report_menu()
+ABOUT_MENU = _static_markup(("Направить обращение", "new_request"), ("Возврат в меню", "start"))
+BACK_MENU = _static_markup(("Возврат в меню", "start"))
+delivery = create_scheduler(bot)  # Отправка в Telegram с учётом лимитов
 
 
 # Определение состояний
@@ -50,19 +87,10 @@ class Form(StatesGroup):
 # Шаг 1: Главное меню - команда /start
 @dp.message(Command("start"))
 async def start(message: types.Message):
-    user_id = message.from_user.id
-    logging.info(f"Функция start. user_id - {message.from_user.id}")
-    markup = InlineKeyboardBuilder()
-    markup.add(
-        InlineKeyboardButton(text="Направить обращение", callback_data="new_request"),
-        InlineKeyboardButton(text="О боте", callback_data="about_bot")
-    )
-    if user_id == int(ADMIN_CHAT_ID_MAIN):
-        logging.info(f"Функция start. {ADMIN_CHAT_ID_MAIN}")
-        markup.add(InlineKeyboardButton(text="Отчет Excel", callback_data="report_excel"))
+    logging.debug("Функция start. user_id - %s", message.from_user.id)
     await message.answer(
         "Добрый день! Чем я могу вам помочь? Выберите один из вариантов:",
-        reply_markup=markup.as_markup()
+        reply_markup=registry.main_menu(message.from_user.id)
     )
 
 
@@ -70,72 +98,127 @@ async def start(message: types.Message):
 async def get_report_excel(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()  # Останавливаем анимацию загрузки
 
-    markup = InlineKeyboardBuilder()
-    markup.add(InlineKeyboardButton(text="Отчет за день", callback_data="report_day"),
-               InlineKeyboardButton(text="Отчёт за неделю", callback_data="report_week"))
-
     await callback_query.message.answer(
-        "Пожалуйста, выберите за какой период сформировать отчёт Excel:\n"
+        "Пожалуйста, выберите за какой период сформировать отчёт:\n"
         "Отчёт будет отправлен на почту Головного офиса",
-        reply_markup=markup.as_markup()
+        reply_markup=REPORT_MENU
     )
     await state.set_state(Form.choosing_branch)  # указание состояния
 
 
-@dp.callback_query(F.data == "report_day")
-async def get_report_excel_day(callback_query: types.CallbackQuery):
-    await callback_query.answer()  # Останавливаем анимацию загрузки
+REPORT_TITLES = {"day": "день", "week": "неделю"}
+REPORT_MEDIA_ARCHIVE = os.getenv("REPORT_MEDIA_ARCHIVE", "0") == "1"  # Прикладывать к отчёту архив медиа
+report_tasks = {}  # (период, формат) -> фоновая задача отправки отчёта по кнопке (None - запускается)
+
+
+# Архив медиа за период отчёта (из локального кэша медиа); None - если медиа нет или архив слишком велик
+async def report_media_archive(period, end=None):
+    rows = await get_period_media(*report_period(period, end))
+    archive = await media_archive(bot, rows)
+    if archive and os.path.getsize(archive) > EMAIL_ATTACHMENTS_MAX_MB * 1024 * 1024:
+        logging.warning("Архив медиа за %s превышает лимит письма и не будет приложен", period)
+        os.remove(archive)
+        return None
+    return archive
+
+
+# Отчёт на почту головного офиса (по кнопке - за окно, заканчивающееся сейчас,
+# по расписанию - в момент запуска). Готовый отчёт с неизменившимися данными
+# берётся с диска без повторного формирования.
+# after(cursor, email_id) выполняется в транзакции постановки письма в очередь.
+async def email_report(period, fmt=None, after=None, end=None):
+    title = REPORT_TITLES[period]
+    fmt = fmt or registry.config.main_report_format
+    end = end or datetime.now()
+    start, _ = report_period(period, end)
+    archive = None
+    try:
+        report_file = await report_jobs.build(period, fmt, end)
+        attachments = [(report_file, report_name(period, end, extension=REPORT_FORMATS[fmt]))]
+        if REPORT_MEDIA_ARCHIVE:
+            archive = await report_media_archive(period, end)
+            if archive:
+                attachments.append((archive, report_name(period, end, extension="_media.zip")))
+        body = f"Отчёт за {title} ({start:%d.%m.%Y %H:%M} - {end:%d.%m.%Y %H:%M}) во вложении."
+        return await outbox.enqueue(f"Отчёт за {title}", body,
+                                    registry.config.main_email, attachments=attachments, after=after)
+    finally:
+        if archive:
+            os.remove(archive)  # Очередь писем хранит свою копию
+
+
+report_scheduler = ReportScheduler(lambda period, end, after: email_report(period, after=after, end=end))
+
+
+# Формирование отчёта в фоне и уведомление администратора по готовности
+async def send_report(message: types.Message, period, fmt):
+    title = REPORT_TITLES[period]
+    head_office_email = registry.config.main_email
+    try:
+        await email_report(period, fmt)
+    except Exception as e:
+        logging.exception("Ошибка при формировании отчёта за %s: %s", title, e)
+        await message.answer(f"Не удалось сформировать отчёт за {title}. Попробуйте позже.",
+                             reply_markup=BACK_MENU)
+        return
 
-    markup = InlineKeyboardBuilder()
-    markup.add(InlineKeyboardButton(text="Возврат в меню", callback_data="start"))
+    await message.answer(
+        f"Отчёт за {title} сформирован и отправлен на почту {head_office_email}",
+        reply_markup=BACK_MENU
+    )
 
-    # Генерация отчета и отправка
-    report_file = report_generation("day")
-    send_email("Отчёт за день", "Отчёт за день во вложении.",
-               os.getenv("HEAD_OFFICE_EMAIL"), file_path=report_file)
 
-    await callback_query.message.answer(
-        f"Отчёт за день сформирован и отправлен на почту {os.getenv('HEAD_OFFICE_EMAIL')}",
-        reply_markup=markup.as_markup()
-    )
+# fmt не указан - формат, настроенный для почты головного офиса.
+# Отчёт занимается до первого await: повторное нажатие, пришедшее, пока
+# бот отвечает Telegram, не запускает второе формирование и второе письмо.
+async def request_report(callback_query: types.CallbackQuery, period, fmt=None):
+    title = REPORT_TITLES[period]
+    fmt = fmt or registry.config.main_report_format
+    key = (period, fmt)
+
+    # Повторное нажатие во время формирования не запускает второй отчёт
+    if key in report_tasks or report_jobs.in_progress(period, fmt):
+        await callback_query.answer()  # Останавливаем анимацию загрузки
+        await callback_query.message.answer(f"Отчёт за {title} уже формируется, пришлём уведомление по готовности.")
+        return
+
+    report_tasks[key] = None
+    try:
+        await callback_query.answer()  # Останавливаем анимацию загрузки
+        await callback_query.message.answer(f"Отчёт за {title} формируется, пришлём уведомление по готовности.")
+    except BaseException:
+        del report_tasks[key]
+        raise
+    task = report_tasks[key] = asyncio.create_task(send_report(callback_query.message, period, fmt))
+    task.add_done_callback(lambda _: report_tasks.pop(key, None))
+
+
+@dp.callback_query(F.data == "report_day")
+async def get_report_excel_day(callback_query: types.CallbackQuery):
+    await request_report(callback_query, "day")
 
 
 @dp.callback_query(F.data == "report_week")
 async def get_report_excel_week(callback_query: types.CallbackQuery):
-    await callback_query.answer()  # Останавливаем анимацию загрузки
+    await request_report(callback_query, "week")
 
-    markup = InlineKeyboardBuilder()
-    markup.add(InlineKeyboardButton(text="Возврат в меню", callback_data="start"))
 
-    # Генерация отчета и отправка
-    report_file = report_generation("week")
-    send_email("Отчёт за неделю", "Отчёт за неделю во вложении.", os.getenv("HEAD_OFFICE_EMAIL"), file_path=report_file)
-
-    await callback_query.message.answer(
-        f"Отчёт за неделю сформирован и отправлен на почту {os.getenv('HEAD_OFFICE_EMAIL')}",
-        reply_markup=markup.as_markup()
-    )
+# Отчёт в явно выбранном формате: report_<период>_<формат>
+@dp.callback_query(F.data.regexp(r"^report_(day|week)_(xlsx|csv|parquet)$"))
+async def get_report_in_format(callback_query: types.CallbackQuery):
+    _, period, fmt = callback_query.data.split("_")
+    await request_report(callback_query, period, fmt)
 
 
 # Шаг 2: Обработка выбора в главном меню
 @dp.callback_query(F.data == "new_request")
 async def new_request(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()  # Останавливаем анимацию загрузки
-    markup = InlineKeyboardBuilder()
-
-    markup.row(
-        InlineKeyboardButton(text="Филиал 1", callback_data="branch_Филиал 1"),
-        InlineKeyboardButton(text="Филиал 2", callback_data="branch_Филиал 2")
-    )
-    markup.row(
-        InlineKeyboardButton(text="Филиал 3", callback_data="branch_Филиал 3"),
-        InlineKeyboardButton(text="Головной офис", callback_data="branch_Головной офис")
-    )
+    config = registry.config
 
     await callback_query.message.answer(
-        "Пожалуйста, выберите, куда направить ваше обращение:\n"
-        "1 - Филиал 1\n2 - Филиал 2\n3 - Филиал 3\n4 - Головной офис",
-        reply_markup=markup.as_markup()
+        f"Пожалуйста, выберите, куда направить ваше обращение:\n{config.branch_list}",
+        reply_markup=config.branch_menu
     )
     await state.set_state(Form.choosing_branch)  # указание состояния
 
@@ -143,51 +226,39 @@ async def new_request(callback_query: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "about_bot")
 async def about_bot(callback_query: types.CallbackQuery):
     await callback_query.answer()  # Останавливаем анимацию загрузки
-    markup = InlineKeyboardBuilder()
-    markup.add(InlineKeyboardButton(text="Направить обращение", callback_data="new_request"),
-               InlineKeyboardButton(text="Возврат в меню", callback_data="start"))
 
     await callback_query.message.answer(
         "Я — виртуальный помощник, созданный для направления ваших обращений в наши филиалы или Головной офис. "
         "Чем могу помочь вам сегодня?",
-        reply_markup=markup.as_markup()
+        reply_markup=ABOUT_MENU
     )
 
 # Обработчик для возврата в главное меню
 @dp.callback_query(F.data == "start")
 async def return_to_main_menu(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
     await callback_query.answer()  # Останавливаем анимацию загрузки
-    logging.info(f"Функция return_to_main_menu")
+    logging.debug("Функция return_to_main_menu")
     # Обновляем сообщение с основным меню
-    markup = InlineKeyboardBuilder()
-    markup.add(
-        InlineKeyboardButton(text="Направить обращение", callback_data="new_request"),
-        InlineKeyboardButton(text="О боте", callback_data="about_bot")
-    )
-    if user_id == int(ADMIN_CHAT_ID_MAIN):
-        logging.info(f"Функция start. {ADMIN_CHAT_ID_MAIN}")
-        markup.add(InlineKeyboardButton(text="Отчет Excel", callback_data="report_excel"))
-
     await callback_query.message.answer(
         "Добрый день! Чем я могу вам помочь? Выберите один из вариантов:",
-        reply_markup=markup.as_markup()
+        reply_markup=registry.main_menu(callback_query.from_user.id)
     )
 
 # Шаг 3: Обработка выбора филиала или головного офиса
 @dp.callback_query(F.data.startswith("branch_"))
 async def select_branch(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()  # Останавливаем анимацию загрузки
-    branch = callback_query.data.split("_")[1]
-    logging.info(f"Функция select_branch. Филиал - {branch}")
+    branch = callback_query.data.split("_", 1)[1]  # В названии филиала может быть "_"
+    logging.debug("Функция select_branch. Филиал - %s", branch)
     # Сохранение запроса клиента с филиалом
     user_id = callback_query.from_user.id
-    request_id = save_client_request(user_id, branch=branch)
+    request_id = await save_client_request(user_id, branch=branch)
+    bind_request(request_id)  # request_id в записях лога этого обновления
 
     # Сохраняем request_id и филиал в состоянии
     await state.update_data(selected_branch=branch, request_id=request_id)
 
-    if branch == "Головной офис":
+    if branch == HEAD_OFFICE:
         await callback_query.message.answer(
             "Ваше обращение будет направлено в Головной офис. Вы можете отправить видео, фото или текст."
         )
@@ -201,12 +272,22 @@ async def select_branch(callback_query: types.CallbackQuery, state: FSMContext):
     await state.set_state(Form.waiting_for_content)  # указание состояния
 
 
-# Шаг 4: Получение содержимого обращения
-@dp.message(lambda message: F.content_type.in_(
-    [types.ContentType.TEXT, types.ContentType.PHOTO, types.ContentType.VIDEO])
-                            and str(message.chat.id) != ADMIN_CHAT_ID_MAIN
-                            and str(message.chat.id) not in ADMIN_CHAT_IDS.values())
-async def get_content(message: types.Message, state: FSMContext):
+# Содержимое сообщения: (тип, текст или file_id, file_unique_id) или None
+def message_content(message: types.Message):
+    if message.text:
+        return "text", message.text, None
+    if message.photo:
+        return "photo", message.photo[-1].file_id, message.photo[-1].file_unique_id
+    if message.video:
+        return "video", message.video.file_id, message.video.file_unique_id
+    if message.voice:
+        return "voice", message.voice.file_id, message.voice.file_unique_id
+    return None
+
+
+# Шаг 4: Получение содержимого обращения (альбом приходит целиком в album)
+@dp.message(ClientChat(), flags={"album": True})
+async def get_content(message: types.Message, state: FSMContext, album=None):
     # Проверяем, завершено ли отправление
     current_state = await state.get_state()
     if current_state == Form.submission_completed.state:
@@ -216,29 +297,16 @@ async def get_content(message: types.Message, state: FSMContext):
     data = await state.get_data()
     branch = data.get("selected_branch")
     request_id = data.get("request_id")  # Получаем request_id
-    logging.info(f"Функция get_content. Request ID: {request_id}")
-    # Получение контента и типа содержимого
-    content = None
-    content_type = None
-    if message.text:
-        content = message.text
-        content_type = "text"
-    elif message.photo:
-        content = message.photo[-1].file_id
-        content_type = "photo"
-    elif message.video:
-        content = message.video.file_id
-        content_type = "video"
-    elif message.voice:
-        content = message.voice.file_id
-        content_type = "voice"
-
-    if content and content_type:
-        add_request_item(request_id, content_type, content)  # Сохраняем контент как элемент запроса
-        logging.info(f"Добавлен контент {content_type} к запросу {request_id}")
+    bind_request(request_id)
+    logging.debug("Функция get_content. Request ID: %s", request_id)
+    # Получение контента и типа содержимого (file_unique_id - ключ в кэше медиа)
+    items = [content for content in map(message_content, album or [message]) if content and content[1]]
+    if items:
+        await add_request_items(request_id, items)  # Сохраняем контент как элементы запроса
+        logging.debug("Добавлено элементов %s к запросу %s", len(items), request_id)
 
         # Получение всего контента, связанного с request_id
-    request_data = get_client_request(request_id)
+    request_data = await get_client_request(request_id)
     content_items = "\n".join(
             f"{item['content_type']}: {item['content']}" for item in request_data.get("items", []))
 
@@ -253,7 +321,32 @@ async def get_content(message: types.Message, state: FSMContext):
         f"Просмотрите сообщение:\nОтправка:\n{content_items}\nФилиал: {branch}\nГотовы отправить или хотите отредактировать?",
         reply_markup=markup.as_markup()
     )
-    logging.info(f"Состояния выбора меню")
+    logging.debug("Состояния выбора меню")
+
+email_tasks = set()  # Ссылки на фоновые задачи подготовки писем с медиа
+
+
+# Письма по обращению с медиа во вложениях. Файлы берутся из локального кэша
+# медиа (каждый скачивается один раз на все письма), поэтому письма готовятся в фоне.
+async def send_request_emails(request_id, items, emails):
+    try:
+        attachments, skipped = await email_attachments(bot, items)
+    except Exception as e:
+        logging.error("Не удалось подготовить медиа обращения %s для писем: %s", request_id, e)
+        attachments, skipped = [], len([item for item in items if item["content_type"] != "text"])
+    note = f"\n\nНе приложено медиафайлов: {skipped}, они доступны в Telegram." if skipped else ""
+    # Задача фоновая: ошибка одного адресата логируется и не мешает остальным
+    for subject, body, to_email in emails:
+        try:
+            try:
+                await outbox.enqueue(subject, body + note, to_email, attachments=attachments)
+            except OSError as e:
+                # Файл мог быть вытеснен из кэша между скачиванием и постановкой в очередь
+                logging.error("Вложения обращения %s недоступны: %s", request_id, e)
+                await outbox.enqueue(subject, body + "\n\nМедиафайлы доступны в Telegram.", to_email)
+        except Exception as e:
+            logging.exception("Письмо по обращению %s для %s не поставлено в очередь: %s", request_id, to_email, e)
+
 
 # Шаг 5: Подтверждение отправки
 @dp.callback_query(F.data.startswith("confirm_send_"))
@@ -261,22 +354,30 @@ async def confirm_send(callback_query: types.CallbackQuery, state: FSMContext):
     await state.set_state(Form.submission_completed)  # Ставим финальное состояние
     await callback_query.answer()  # Останавливаем анимацию загрузки
     request_id = callback_query.data.split("_")[2]
-    logging.info(f"Функция confirm_send, request_id - {request_id}")
-    request_data = get_client_request(request_id)
+    bind_request(request_id)
+    logging.debug("Функция confirm_send, request_id - %s", request_id)
+    await flush_request_items()  # Черновик обращения записываем в базу до отправки
+    request_data = await get_client_request(request_id)
     user_id = request_data.get("user_id")
     branch = request_data.get("branch")
-    branch_admin_id = ADMIN_CHAT_IDS.get(branch)
-    branch_admin_email = ADMIN_EMAIL.get(branch)
+    config = registry.config  # Один снимок конфигурации на всю отправку
+    head_office_id = config.main_chat_id
+    head_office_email = config.main_email
+    branch_config = config.branches.get(branch)
+    branch_admin_id = branch_config.chat_id if branch_config else None
+    branch_admin_email = branch_config.email if branch_config else None
     # content_items = "\n".join(
     #     f"{item['content_type']}: {item['content']}" for item in request_data.get("items", [])
     # )
     content_items = "\n".join(
         item['content_type'] for item in request_data.get("items", [])
     )
-    logging.info(f"Функция confirm_sen. Значение переменной content_items - {content_items}")
+    logging.debug("Функция confirm_sen. Значение переменной content_items - %s", content_items)
 
-    # Сообщение пользователю
-    await callback_query.message.answer("Спасибо за ваше обращение! Мы свяжемся с вами в ближайшее время.")
+    # Сообщение пользователю (вне очереди рассылки администраторам)
+    delivery.post(callback_query.message.chat.id, [SendMessage(
+        chat_id=callback_query.message.chat.id,
+        text="Спасибо за ваше обращение! Мы свяжемся с вами в ближайшее время.")], HIGH)
     await callback_query.message.edit_reply_markup()
 
     # Создание клавиатуры с кнопками
@@ -285,28 +386,11 @@ async def confirm_send(callback_query: types.CallbackQuery, state: FSMContext):
 
     markup.add(InlineKeyboardButton(text="Ответить", callback_data=callback_data_reply))
 
-    # Инициализация списка для медиафайлов
-    media_group = []
-    # Определение текстовой части сообщения
-    main_text_list = []
-
-    # Проверка и добавление контента в зависимости от типов
-    for item in request_data.get("items", []):
-        content_type = item.get("content_type")
-        content = item.get("content")
-
-        # Обработка в зависимости от типа контента
-        if content_type == "photo":
-            media_group.append(types.InputMediaPhoto(media=content))
-        elif content_type == "video":
-            media_group.append(types.InputMediaVideo(media=content))
-        elif content_type == "voice":
-            media_group.append(types.InputMediaAudio(media=content))
-        elif content_type == "text":
-            main_text_list.append(content)
+    # Медиа обращения раскладываются на альбомы один раз для всех получателей
+    items = request_data.get("items", [])
+    media = MediaSet(items)
+    main_text = "\n".join(item["content"] for item in items if item["content_type"] == "text")
 
-
-    main_text = "\n".join(item for item in main_text_list)
         # Текст
     send_subject = f"Новое обращение от клиента {user_id}"
     send_body_admin = f"Новое обращение от клиента {user_id}:\n {content_items}"
@@ -320,53 +404,43 @@ async def confirm_send(callback_query: types.CallbackQuery, state: FSMContext):
                                             f"\nСообщение:\n{main_text}")
 
     if branch_admin_id and branch_admin_email:
-        # 1. Сценарий: отправка только текста
-        if not media_group and main_text:
-            logging.info(f"отправка только текста. Текст - {main_text}")
-            await bot.send_message(branch_admin_id, send_body_admin_text, reply_markup=markup.as_markup())
-            await bot.send_message(ADMIN_CHAT_ID_MAIN, send_body_head_office_duplicate_text)
-
-        # 2. Сценарий: отправка только изображения или видео
-        elif media_group and not main_text:
-            logging.info(f"отправка только изображения или видео. Текст - {main_text}")
-            await bot.send_media_group(branch_admin_id, media_group)  # Отправка медиа-группы
-            # Отправляем кнопки "Ответить" как отдельное сообщение
-            await bot.send_message(branch_admin_id, send_body_admin, reply_markup=markup.as_markup())
-
-            await bot.send_media_group(ADMIN_CHAT_ID_MAIN, media_group)  # Отправка медиа-группы
-            # Отправляем кнопки "Ответить" как отдельное сообщение
-            await bot.send_message(ADMIN_CHAT_ID_MAIN,
-                                   send_body_head_office_duplicate)
-
-        # 3. Сценарий: отправка текста вместе с изображением и/или видео
-        elif media_group and main_text:
-            logging.info(f"отправка текста вместе с изображением и/или видео. Текст - {main_text}")
-            # Отправляем текстовое сообщение с кнопкой "Ответить"
-            await bot.send_message(branch_admin_id, send_body_admin_text, reply_markup=markup.as_markup())
-            # Отправка медиа-группы с изображениями и видео
-            await bot.send_media_group(branch_admin_id, media_group)
-
-            await bot.send_message(ADMIN_CHAT_ID_MAIN, send_body_head_office_duplicate_text)
-            # Отправка медиа-группы с изображениями и видео
-            await bot.send_media_group(ADMIN_CHAT_ID_MAIN, media_group)
-
-            # Отправка email
-        send_email(send_subject, send_body_admin, branch_admin_email)
-        send_email(send_subject, send_body_head_office_duplicate, os.getenv("HEAD_OFFICE_EMAIL"))
+        logging.info("Отправка обращения %s: медиа - %s отправок, текст - %s", request_id, len(media.units), main_text)
+        # Без текста клиента в сообщении перечисляются типы вложений
+        admin_text = send_body_admin_text if main_text else send_body_admin
+        head_office_text = send_body_head_office_duplicate_text if main_text else send_body_head_office_duplicate
+
+        # Сообщения администратору филиала и дубль в головной офис уходят параллельно
+        # и в фоне, порядок сообщений внутри каждого чата сохраняется
+        delivered = delivery.post(branch_admin_id,
+                                  for_chat(compose(media, admin_text, markup.as_markup()), branch_admin_id), NORMAL)
+        delivery.post(head_office_id, for_chat(compose(media, head_office_text), head_office_id), LOW)
+
+        # Отправка email (с медиа во вложениях)
+        emails = [(send_subject, send_body_admin, branch_admin_email),
+                  (send_subject, send_body_head_office_duplicate, head_office_email)]
 
     else:
-        logging.info(f"Функция confirm_send, отправка головному филиалу")
-        await bot.send_message(ADMIN_CHAT_ID_MAIN, send_body_head_office,
-                                                    reply_markup=markup.as_markup())
-        send_email(send_subject, send_body_head_office_duplicate, os.getenv("HEAD_OFFICE_EMAIL"))
+        logging.debug("Функция confirm_send, отправка головному филиалу")
+        delivered = delivery.post(head_office_id, for_chat(compose(media, send_body_head_office, markup.as_markup()),
+                                                           head_office_id), NORMAL)
+        emails = [(send_subject, send_body_head_office_duplicate, head_office_email)]
+
+    task = asyncio.create_task(send_request_emails(request_id, items, emails))
+    email_tasks.add(task)
+    task.add_done_callback(email_tasks.discard)
+
+    # Сквозная задержка: от первого сообщения клиента до доставки администратору
+    delivered.add_done_callback(
+        lambda future: future.cancelled() or future.exception() or observe_request_delivery(request_id, items))
 
 
 # Шаг 6: Редактирование сообщения
 @dp.callback_query(F.data.startswith("edit_message_"))
 async def edit_message(callback_query: types.CallbackQuery, state: FSMContext):
     request_id = callback_query.data.split("_")[2]
+    bind_request(request_id)
     await callback_query.answer()  # Останавливаем анимацию загрузки
-    delete_request_items(request_id)  # функция для удаления записей из таблицы request_items
+    await delete_request_items(request_id)  # функция для удаления записей из таблицы request_items
     await callback_query.message.answer("Введите новое сообщение для отправки.")
     await state.set_state(Form.waiting_for_content)  # указание состояния
 
@@ -375,8 +449,9 @@ async def edit_message(callback_query: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data.startswith("add_content_"))
 async def add_more_content(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()  # Останавливаем анимацию загрузки
-    logging.info(f"Запуск функции add_more_content")
+    logging.debug("Запуск функции add_more_content")
     request_id = callback_query.data.split("_")[2]
+    bind_request(request_id)
 
     # Сообщаем пользователю, что он может добавить еще одно сообщение, фото или видео
     await callback_query.message.answer(
@@ -395,7 +470,8 @@ async def reply_to_client(callback_query: types.CallbackQuery, state: FSMContext
     data = callback_query.data.split("_")
     user_id = data[1]  # ID обращения
     request_id = data[2]  # ID клиента
-    logging.info(f"Функция!! reply_to_client: client_id - {user_id} request_id - {request_id}")
+    bind_request(request_id)
+    logging.debug("Функция!! reply_to_client: client_id - %s request_id - %s", user_id, request_id)
 
     # Запрашиваем новое сообщение у администратора
     await callback_query.message.answer("Введите ваше сообщение для клиента:")
@@ -405,17 +481,17 @@ async def reply_to_client(callback_query: types.CallbackQuery, state: FSMContext
 
 
 # Шаг 9: Обработка ввода ответа администратора
-@dp.message(lambda message: str(message.chat.id) in ADMIN_CHAT_IDS.values()
-            or str(message.chat.id) == ADMIN_CHAT_ID_MAIN)
+@dp.message(AdminChat())
 async def admin_response(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     request_id = user_data.get("request_id")
+    bind_request(request_id)
     client_id = user_data.get("client_id")
-    logging.info(f"admin_response: client_id - {client_id} request_id - {request_id}")
+    logging.debug("admin_response: client_id - %s request_id - %s", client_id, request_id)
     if request_id and client_id:
         # Сохраняем ответ администратора
         admin_message = message.text
-        update_client_request(request_id, admin_response=admin_message)
+        await update_client_request(request_id, admin_response=admin_message)
         # Предпросмотр сообщения
         markup = InlineKeyboardBuilder()
         markup.add(
@@ -438,10 +514,11 @@ async def send_to_client(callback_query: types.CallbackQuery):
     data = callback_query.data.split("_")
     client_id = data[1]  # ID клиента
     request_id = data[2]  # ID обращения
-    logging.info(f"send_to_client_: client_id - {client_id} request_id - {request_id}")
+    bind_request(request_id)
+    logging.debug("send_to_client_: client_id - %s request_id - %s", client_id, request_id)
 
     # Получаем данные обращения
-    request_data = get_client_request(request_id)
+    request_data = await get_client_request(request_id)
     if not request_data:
         await callback_query.message.answer("Запрос не найден.")
         return
@@ -453,14 +530,21 @@ async def send_to_client(callback_query: types.CallbackQuery):
                                        f"\nID обращения: {request_id}"
                                         f"\nСообщение администратора: {admin_message}")
     if admin_message:
-        # Отправляем ответ клиенту
-        await bot.send_message(client_id, f"Ответ от администратора: {admin_message}")
-        await callback_query.answer("Ответ отправлен клиенту.")
+        # Ответ клиенту вне очереди
+        try:
+            await delivery.deliver(client_id, [SendMessage(chat_id=client_id,
+                                                           text=f"Ответ от администратора: {admin_message}")], HIGH)
+        except Exception as e:
+            logging.error("Не удалось отправить ответ клиенту %s: %s", client_id, e)
+            await callback_query.message.answer("Не удалось отправить ответ клиенту. Попробуйте позже.")
+            return
         await callback_query.message.answer("Ваш ответ отправлен клиенту.")
 
-        # Дублирование в головной филиал
-        await bot.send_message(ADMIN_CHAT_ID_MAIN, send_body_head_office_duplicate)
-        send_email(send_subject, send_body_head_office_duplicate, os.getenv("HEAD_OFFICE_EMAIL"))
+        # Дублирование в головной филиал - с низким приоритетом, в фоне
+        config = registry.config
+        delivery.post(config.main_chat_id, [SendMessage(chat_id=config.main_chat_id,
+                                                        text=send_body_head_office_duplicate)], LOW)
+        await outbox.enqueue(send_subject, send_body_head_office_duplicate, config.main_email)
 
     else:
         logging.error("Ответ администратора не найден в запросе.")
@@ -476,10 +560,68 @@ async def edit_response(callback_query: types.CallbackQuery):
     await callback_query.message.answer("Редактируйте сообщение и отправьте снова.")
 
 
+# Запуск и остановка пула соединений и фоновых задач вместе с ботом
+@dp.startup()
+async def on_startup():
+    # Пока в фоне идёт проверка схемы: Telegram, метрики и соединения пула
+    await asyncio.gather(bot.me(), metrics_server.start(), pool.open())
+    startup_profile.mark("Telegram, метрики, пул соединений")
+    delivery.start()
+    registry.start()  # Перечитывание конфигурации филиалов без перезапуска
+    # Фоновые задачи ниже работают с таблицами: запускаем их после миграций
+    await schema_check.wait()
+    startup_profile.mark("ожидание проверки схемы")
+    draft_buffer.start()
+    if hasattr(storage, "start"):
+        storage.start()
+    outbox.start()
+    lifecycle_job.start()  # Секции request_items вперёд и архивация старых месяцев
+    report_scheduler.start()  # Плановая рассылка отчётов
+    # kill -USR1 <pid> - таблица самых затратных запросов в лог
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: logging.info("\n%s", query_stats.dump()))
+    startup_profile.mark("фоновые задачи")
+    startup_profile.report()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    await registry.stop()
+    await lifecycle_job.stop()
+    await report_scheduler.stop()
+    await asyncio.gather(*email_tasks, return_exceptions=True)  # Письма ставим в очередь до её остановки
+    await delivery.stop()  # Дожидаемся отправки поставленных в очередь сообщений
+    await draft_buffer.stop()  # Записываем несохранённые черновики
+    await outbox.stop()
+    await storage.close()
+    report_jobs.close()
+    await pool.close()
+    await metrics_server.stop()
+
+
+startup_profile.mark("настройка бота и диспетчера")
+
+
 # Основной запуск бота
 if __name__ == "__main__":
-    # Инициализация базы данных
-    init_database()
+    parser = argparse.ArgumentParser(description="Бот для приёма обращений")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"),
+                        help="способ получения обновлений (по умолчанию BOT_MODE или polling)")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="вывести в stderr время импорта и инициализации по этапам")
+    args = parser.parse_args()
+    startup_profile.enabled = args.startup_profile
+    if args.mode == "webhook" and WEBHOOK_PROCESSES > 1:
+        # Черновики и кэши других процессов не видны: элементы сразу в базу, чтение из базы
+        disable_process_buffers()
+        if hasattr(storage, "cache_ttl"):
+            storage.cache_ttl = 0  # Состояние FSM без локального кэша чтения
+
+    # Проверка схемы базы данных - в фоне, пока запускается бот (on_startup дожидается её
+    # перед фоновыми задачами; если модуль запущен не отсюда, проверку начнёт сам wait())
+    schema_check.start()
 
     # Запуск бота
-    dp.run_polling(bot)
+    if args.mode == "webhook":
+        run_webhook(dp, bot)
+    else:
+        dp.run_polling(bot)
@@ -0,0 +1,191 @@
+import os
+import re
+import uuid
+import asyncio
+import logging
+import zipfile
+import tempfile
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Локальное хранилище медиа обращений. Файл хранится под своим file_unique_id
+# (он одинаков для одного и того же файла в любых сообщениях), поэтому каждый
+# файл скачивается из Telegram один раз - для всех писем, повторных отправок и
+# архивов отчётов. Размер каталога ограничен, давно не использованные файлы
+# удаляются первыми (время использования - mtime, обновляется при каждом чтении).
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "media_cache"))
+MEDIA_CACHE_MAX_MB = float(os.getenv("MEDIA_CACHE_MAX_MB", 1024))
+MEDIA_DOWNLOAD_TIMEOUT = int(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", 120))
+MEDIA_DOWNLOADS = int(os.getenv("MEDIA_DOWNLOADS", 4))                     # Одновременных скачиваний
+EMAIL_ATTACHMENTS_MAX_MB = float(os.getenv("EMAIL_ATTACHMENTS_MAX_MB", 20))  # Лимит вложений одного письма
+
+EXTENSIONS = {"photo": "jpg", "video": "mp4", "voice": "ogg"}
+_UNIQUE_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class MediaStore:
+    def __init__(self, directory=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MAX_MB * 1024 * 1024,
+                 downloads=MEDIA_DOWNLOADS, timeout=MEDIA_DOWNLOAD_TIMEOUT):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._size = None                          # Занято на диске; считается при первой записи
+        self._inflight = {}                        # file_unique_id -> задача скачивания
+        self._downloads = asyncio.Semaphore(downloads)
+        self._accounting = asyncio.Lock()
+
+    def path(self, file_unique_id):
+        if not _UNIQUE_ID.match(file_unique_id):
+            raise ValueError(f"Некорректный file_unique_id: {file_unique_id!r}")
+        return os.path.join(self.directory, file_unique_id[:2], file_unique_id)
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    # Путь к файлу в хранилище; при промахе файл скачивается (один раз на все одновременные запросы)
+    async def get(self, bot, file_id, file_unique_id):
+        path = self.path(file_unique_id)
+        if await asyncio.to_thread(self._touch, path):
+            return path
+        task = self._inflight.get(file_unique_id)
+        if task is None:
+            task = asyncio.create_task(self._download(bot, file_id, path))
+            self._inflight[file_unique_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(file_unique_id, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, bot, file_id, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            async with self._downloads:
+                # Потоковая запись в файл, без чтения целиком в память
+                await bot.download(file_id, destination=partial, timeout=self.timeout)
+            size = os.path.getsize(partial)
+            os.replace(partial, path)
+        except BaseException:
+            try:
+                os.remove(partial)
+            except FileNotFoundError:
+                pass
+            raise
+        await self._account(size)
+        return path
+
+    async def _account(self, size):
+        async with self._accounting:
+            if self._size is None:
+                self._size = await asyncio.to_thread(self._scan_size)
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._size = await asyncio.to_thread(self._evict)
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".part"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    # Удаляем давно не использованные файлы до 90% лимита, чтобы не чистить на каждой записи
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        logging.info("Из кэша медиа удалено файлов: %s, занято %.1f МБ", removed, total / 1024 / 1024)
+        return total
+
+
+media_store = MediaStore()
+
+
+def _media_items(items):
+    return [item for item in items if item.get("file_unique_id") and item["content_type"] in EXTENSIONS]
+
+
+# Вложения для письма с медиа обращения: [(путь, имя файла)] и число пропущенных
+# (не удалось скачать или не уместились в лимит письма)
+async def email_attachments(bot, items, max_bytes=EMAIL_ATTACHMENTS_MAX_MB * 1024 * 1024):
+    media = _media_items(items)
+    paths = await asyncio.gather(
+        *(media_store.get(bot, item["content"], item["file_unique_id"]) for item in media),
+        return_exceptions=True,
+    )
+    attachments = []
+    total = 0
+    for index, (item, path) in enumerate(zip(media, paths), start=1):
+        if isinstance(path, Exception):
+            logging.warning("Медиа %s не получено: %s", item['file_unique_id'], path)
+            continue
+        size = os.path.getsize(path)
+        if total + size > max_bytes:
+            continue
+        total += size
+        attachments.append((path, f"{item['content_type']}_{index}.{EXTENSIONS[item['content_type']]}"))
+    return attachments, len(media) - len(attachments)
+
+
+def _write_archive(entries):
+    fd, archive_path = tempfile.mkstemp(prefix="media_", suffix=".zip")
+    os.close(fd)
+    try:
+        # Фото и видео уже сжаты - храним без повторного сжатия
+        with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for path, name in entries:
+                archive.write(path, name)
+    except Exception:
+        os.remove(archive_path)
+        raise
+    return archive_path
+
+
+# Архив медиа за период для отчёта: rows - (request_id, content_type, file_id, file_unique_id).
+# Возвращает путь к временному zip-файлу (удаляет вызывающий код) или None, если медиа нет.
+async def media_archive(bot, rows):
+    entries = []
+    seen = set()
+    for request_id, content_type, file_id, file_unique_id in rows:
+        if content_type not in EXTENSIONS:
+            continue
+        try:
+            path = await media_store.get(bot, file_id, file_unique_id)
+        except Exception as e:
+            logging.warning("Медиа %s обращения %s не получено: %s", file_unique_id, request_id, e)
+            continue
+        name = f"{request_id}/{file_unique_id}.{EXTENSIONS[content_type]}"
+        if name not in seen:
+            seen.add(name)
+            entries.append((path, name))
+    if not entries:
+        return None
+    return await asyncio.to_thread(_write_archive, entries)
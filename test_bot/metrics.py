@@ -0,0 +1,224 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Метрики в текстовом формате Prometheus на локальном HTTP-порту.
+# METRICS_PORT не задан или 0 - сервер не запускается (счётчики всё равно ведутся).
+# Там же /queries - таблица самых затратных запросов к базе (при QUERY_PROFILING=1).
+# В режиме вебхука с несколькими процессами каждый слушает METRICS_PORT + номер процесса.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics = []  # Все объявленные метрики в порядке объявления
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()  # Наблюдения приходят и из потоков (БД, SMTP)
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_value(key, value) for key, value in items)
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_value(self, key, value):
+        return f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _render_value(self, key, value):
+        return f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    # Замер длительности блока: with HISTOGRAM.time(label=...): ...
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += count
+            labels = _format_labels(self.labels, key, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return "\n".join(lines)
+
+
+def render():
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+# Метрики бота
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время выполнения обработчика", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Ошибки в обработчиках", ["handler"])
+DB_ACQUIRE_SECONDS = Histogram("bot_db_acquire_seconds", "Ожидание соединения из пула", ["function"])
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Время работы функции с базой данных", ["function"])
+DB_ERRORS = Counter("bot_db_errors_total", "Ошибки функций работы с базой данных", ["function"])
+SMTP_SECONDS = Histogram("bot_smtp_send_seconds", "Время отправки письма по SMTP")
+SMTP_ERRORS = Counter("bot_smtp_errors_total", "Ошибки отправки писем")
+TELEGRAM_SECONDS = Histogram("bot_telegram_api_seconds", "Время вызова Telegram Bot API", ["method"])
+TELEGRAM_ERRORS = Counter("bot_telegram_api_errors_total", "Ошибки вызовов Telegram Bot API", ["method"])
+REPORT_SECONDS = Histogram("bot_report_build_seconds", "Время формирования отчёта", ["period", "format"],
+                           buckets=(1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+REQUEST_DELIVERY_SECONDS = Histogram(
+    "bot_request_delivery_seconds", "От первого сообщения клиента до доставки обращения администратору",
+    buckets=(1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0))
+REQUEST_IDS_REMAINING = Gauge("bot_request_ids_remaining",
+                              "Сколько номеров обращений ещё может выдать next_request_id()")
+
+
+# Сквозная задержка обращения: от первого элемента до доставки администратору
+def observe_request_delivery(request_id, items):
+    timestamps = [item["timestamp"] for item in items if item.get("timestamp")]
+    if not timestamps:
+        return
+    seconds = (datetime.now(timezone.utc) - min(timestamps)).total_seconds()
+    REQUEST_DELIVERY_SECONDS.observe(seconds)
+    logging.info("Обращение %s доставлено администратору через %.1f с", request_id, seconds)
+
+
+# Время и ошибки обработчиков aiogram (внутренний middleware: имя обработчика уже известно)
+class HandlerMetrics(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__ if "handler" in data else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+
+# Время и ошибки вызовов Telegram API (middleware сессии бота)
+class TelegramMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            TELEGRAM_ERRORS.inc(method=name)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=name)
+
+
+def setup_metrics(dp, bot):
+    handler_metrics = HandlerMetrics()
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(handler_metrics)
+    bot.session.middleware(TelegramMetrics())
+
+
+# Таблица самых затратных и частых запросов к базе (см. profiling.py)
+async def _queries_handler(request):
+    from profiling import query_stats
+    return web.Response(text=query_stats.dump(int(request.query.get("n", 20))))
+
+
+async def _metrics_handler(request):
+    return web.Response(body=render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+class MetricsServer:
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        port = self.port + int(os.getenv("METRICS_PROCESS_INDEX", 0))
+        app = web.Application()
+        app.router.add_get("/metrics", _metrics_handler)
+        app.router.add_get("/queries", _queries_handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, port).start()
+        logging.info("Метрики доступны на http://%s:%s/metrics", self.host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
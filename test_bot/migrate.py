@@ -0,0 +1,157 @@
+import os
+import re
+import sys
+import hashlib
+import logging
+import argparse
+
+from db import get_database_connection
+
+
+# Версионные миграции схемы: файлы migrations/NNNN_имя.sql применяются по
+# порядку, каждый в своей транзакции, и записываются в schema_migrations.
+#   python migrate.py up      - применить недостающие миграции
+#   python migrate.py verify  - проверить, что схема актуальна и файлы не менялись
+#   python migrate.py status  - список миграций и их состояние
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d{4})_(\w+)\.sql$")
+# Ключ advisory-блокировки: миграции не применяются двумя процессами одновременно
+LOCK_KEY = 72_460_011
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    @property
+    def sql(self):
+        with open(self.path, encoding="utf-8") as file:
+            return file.read()
+
+    @property
+    def checksum(self):
+        return hashlib.sha256(self.sql.encode("utf-8")).hexdigest()
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append(Migration(match.group(1), match.group(2), os.path.join(directory, filename)))
+    return migrations
+
+
+def _ensure_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version TEXT PRIMARY KEY,               -- Номер миграции
+        name TEXT NOT NULL,
+        checksum TEXT NOT NULL,                 -- sha256 файла миграции
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    ''')
+
+
+# Применённые миграции: version -> checksum (пусто, если таблицы ещё нет)
+def applied_migrations(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return {}
+        cursor.execute("SELECT version, checksum FROM schema_migrations")
+        return dict(cursor.fetchall())
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+def pending_migrations(conn, migrations=None):
+    applied = applied_migrations(conn)
+    return [m for m in (migrations or load_migrations()) if m.version not in applied]
+
+
+# Схема актуальна: все миграции применены (один лёгкий запрос, без DDL)
+def schema_is_current(conn):
+    return not pending_migrations(conn)
+
+
+def migrate_up(conn):
+    cursor = conn.cursor()
+    applied_now = []
+    try:
+        # Сессионная блокировка: второй процесс дождётся первого и ничего не применит повторно
+        cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        _ensure_table(cursor)
+        conn.commit()
+        for migration in pending_migrations(conn):
+            try:
+                cursor.execute(migration.sql)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                    (migration.version, migration.name, migration.checksum)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logging.error("Ошибка при применении миграции %s_%s", migration.version, migration.name)
+                raise
+            applied_now.append(migration)
+            logging.info("Применена миграция %s_%s", migration.version, migration.name)
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+    return applied_now
+
+
+# Список проблем: неприменённые миграции и изменённые после применения файлы
+def verify(conn):
+    problems = []
+    applied = applied_migrations(conn)
+    migrations = load_migrations()
+    known = {m.version for m in migrations}
+    for migration in migrations:
+        if migration.version not in applied:
+            problems.append(f"{migration.version}_{migration.name}: не применена")
+        elif applied[migration.version] != migration.checksum:
+            problems.append(f"{migration.version}_{migration.name}: файл изменён после применения")
+    for version in sorted(set(applied) - known):
+        problems.append(f"{version}: применена, но файл миграции отсутствует")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    parser.add_argument("command", choices=["up", "verify", "status"])
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    conn = get_database_connection()
+    if conn is None:
+        return 2
+    try:
+        if args.command == "up":
+            applied_now = migrate_up(conn)
+            print(f"Применено миграций: {len(applied_now)}")
+            return 0
+        if args.command == "verify":
+            problems = verify(conn)
+            for problem in problems:
+                print(problem)
+            print("Схема актуальна" if not problems else f"Найдено проблем: {len(problems)}")
+            return 1 if problems else 0
+        applied = applied_migrations(conn)
+        for migration in load_migrations():
+            print(f"{migration.version}_{migration.name}: {'применена' if migration.version in applied else 'ожидает'}")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
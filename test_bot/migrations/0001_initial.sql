@@ -0,0 +1,106 @@
+-- Исходная схема: таблицы, которые раньше создавались при каждом запуске бота.
+-- Все команды идемпотентны, поэтому миграция применима и к уже существующей базе.
+
+-- Таблица обращений
+CREATE TABLE IF NOT EXISTS requests (
+    request_id SERIAL PRIMARY KEY,          -- Уникальный идентификатор обращения
+    user_id BIGINT NOT NULL,                -- Идентификатор клиента
+    branch TEXT,                            -- Выбранный филиал
+    timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP, -- Дата и время создания обращения
+    admin_response TEXT                     -- Ответ администратора
+);
+
+-- Таблица элементов обращения
+CREATE EXTENSION IF NOT EXISTS "uuid-ossp";  -- Убедимся, что расширение UUID доступно
+
+CREATE TABLE IF NOT EXISTS request_items (
+    item_id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),   -- Уникальный идентификатор элемента с авто-генерацией UUID
+    request_id INT REFERENCES requests(request_id) ON DELETE CASCADE,  -- Связь с таблицей requests
+    content_type TEXT CHECK (content_type IN ('text', 'photo', 'video', 'voice')), -- Тип содержимого
+    content TEXT,                           -- Текст или ID файла для фото/видео
+    timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP  -- Дата и время добавления элемента
+);
+
+-- Серверный генератор request_id: последовательность, переставленная
+-- секретным ключом (сеть Фейстеля). Номера остаются шестизначными,
+-- не идут подряд и не угадываются, а создание обращения - один INSERT.
+CREATE SEQUENCE IF NOT EXISTS request_id_counter MINVALUE 0 START 0 MAXVALUE 899999 NO CYCLE;
+
+CREATE TABLE IF NOT EXISTS request_id_key (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),  -- Таблица из одной строки
+    key BIGINT NOT NULL                              -- Секретный ключ перестановки
+);
+INSERT INTO request_id_key (key) VALUES (floor(random() * 2147483647)::BIGINT)
+ON CONFLICT DO NOTHING;
+
+-- Биекция [0, 900000) -> [100000, 1000000): 4 раунда Фейстеля на 20 битах,
+-- значения за пределами диапазона прогоняются повторно (cycle walking)
+CREATE OR REPLACE FUNCTION request_id_permute(value BIGINT, key BIGINT) RETURNS INT AS $$
+DECLARE
+    result BIGINT := value;
+    l BIGINT;
+    r BIGINT;
+    t BIGINT;
+BEGIN
+    LOOP
+        l := (result >> 10) & 1023;
+        r := result & 1023;
+        FOR i IN 0..3 LOOP
+            t := r;
+            r := l # ((((r # ((key >> (i * 7)) & 32767)) * 40503) >> 7) & 1023);
+            l := t;
+        END LOOP;
+        result := (l << 10) | r;
+        EXIT WHEN result < 900000;
+    END LOOP;
+    RETURN result + 100000;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION next_request_id() RETURNS INT AS $$
+    SELECT request_id_permute(nextval('request_id_counter'), (SELECT key FROM request_id_key))
+$$ LANGUAGE sql VOLATILE;
+
+ALTER TABLE requests ALTER COLUMN request_id SET DEFAULT next_request_id();
+
+-- Состояния FSM (диалоги переживают перезапуск бота)
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY,                   -- Ключ диалога (бот, чат, пользователь)
+    state TEXT,                             -- Текущее состояние
+    data JSONB NOT NULL DEFAULT '{}',       -- Данные диалога
+    expires_at TIMESTAMPTZ NOT NULL         -- Время, после которого диалог сбрасывается
+);
+CREATE INDEX IF NOT EXISTS fsm_states_expires_at_idx ON fsm_states (expires_at);
+
+-- Очередь писем (outbox)
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    to_email TEXT NOT NULL,
+    attachments JSONB NOT NULL DEFAULT '[]',    -- [{"path": ..., "filename": ...}]
+    status TEXT NOT NULL DEFAULT 'pending'
+        CHECK (status IN ('pending', 'sending', 'sent', 'dead')),
+    attempts INT NOT NULL DEFAULT 0,            -- Число попыток отправки
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,  -- Когда пробовать снова
+    last_error TEXT,                            -- Последняя ошибка SMTP
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS email_outbox_due_idx ON email_outbox (next_attempt_at)
+    WHERE status IN ('pending', 'sending');
+
+-- Агрегаты по закрытым дням (для отчётов)
+CREATE TABLE IF NOT EXISTS daily_rollup_days (
+    day DATE PRIMARY KEY,                   -- Материализованный день
+    column_lengths INT[] NOT NULL,          -- Максимальные длины столбцов отчёта
+    built_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    day DATE NOT NULL,
+    branch TEXT NOT NULL,                   -- Филиал ('' - не указан)
+    content_type TEXT NOT NULL,
+    items INT NOT NULL,                     -- Количество элементов за день
+    PRIMARY KEY (day, branch, content_type)
+);
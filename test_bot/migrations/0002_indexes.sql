@@ -0,0 +1,10 @@
+-- Индексы для частых запросов
+
+-- Элементы обращения: предпросмотр, подтверждение, удаление черновика
+CREATE INDEX IF NOT EXISTS request_items_request_id_idx ON request_items (request_id);
+
+-- Выборка за период для отчётов (ri.timestamp BETWEEN ...)
+CREATE INDEX IF NOT EXISTS request_items_timestamp_idx ON request_items (timestamp);
+
+-- Обращения клиента по времени
+CREATE INDEX IF NOT EXISTS requests_user_id_timestamp_idx ON requests (user_id, timestamp);
@@ -0,0 +1,4 @@
+-- Постоянный идентификатор файла Telegram (file_unique_id) для фото, видео и
+-- голосовых: по нему файлы кэшируются на диске (media_store.py). file_id
+-- для одного и того же файла бывает разным, file_unique_id - нет.
+ALTER TABLE request_items ADD COLUMN IF NOT EXISTS file_unique_id TEXT;
@@ -0,0 +1,67 @@
+-- Секционирование request_items по месяцам (по timestamp). Запросы за период
+-- читают только секции своих месяцев, а старые месяцы отсоединяются целиком и
+-- уходят в архив на диск (lifecycle.py) без DELETE по большой таблице.
+-- Секции называются request_items_yYYYYmMM; строки вне созданных секций
+-- попадают в request_items_default.
+
+-- Секция месяца, в который попадает month (если её ещё нет)
+CREATE OR REPLACE FUNCTION request_items_create_partition(month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::DATE;
+    partition_name TEXT := 'request_items_' || to_char(start_at, '"y"YYYY"m"MM');
+BEGIN
+    IF to_regclass(partition_name) IS NULL THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF request_items FOR VALUES FROM (%L) TO (%L)',
+                       partition_name, start_at::TIMESTAMPTZ, (start_at + INTERVAL '1 month')::TIMESTAMPTZ);
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции текущего месяца и months_ahead следующих
+CREATE OR REPLACE FUNCTION request_items_ensure_partitions(months_ahead INT) RETURNS VOID AS $$
+    SELECT request_items_create_partition(month::DATE)
+    FROM generate_series(date_trunc('month', CURRENT_TIMESTAMP),
+                         date_trunc('month', CURRENT_TIMESTAMP) + make_interval(months => months_ahead),
+                         INTERVAL '1 month') AS month
+$$ LANGUAGE sql;
+
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'request_items'::regclass) = 'p' THEN
+        RETURN;  -- Таблица уже секционирована
+    END IF;
+
+    -- Прежняя таблица переименовывается; её индексы освобождают имена для новой
+    ALTER TABLE request_items RENAME TO request_items_unpartitioned;
+    ALTER TABLE request_items_unpartitioned RENAME CONSTRAINT request_items_pkey TO request_items_unpartitioned_pkey;
+    DROP INDEX IF EXISTS request_items_request_id_idx, request_items_timestamp_idx;
+
+    -- Ключ секционирования входит в первичный ключ; timestamp обязателен
+    CREATE TABLE request_items (
+        item_id UUID NOT NULL DEFAULT uuid_generate_v4(),
+        request_id INT REFERENCES requests(request_id) ON DELETE CASCADE,
+        content_type TEXT CHECK (content_type IN ('text', 'photo', 'video', 'voice')),
+        content TEXT,
+        timestamp TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        file_unique_id TEXT,
+        PRIMARY KEY (item_id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+
+    CREATE INDEX request_items_request_id_idx ON request_items (request_id);
+    CREATE INDEX request_items_timestamp_idx ON request_items (timestamp);
+    CREATE TABLE request_items_default PARTITION OF request_items DEFAULT;
+
+    -- Секции для всех месяцев с данными и на несколько месяцев вперёд
+    PERFORM request_items_create_partition(month::DATE)
+    FROM generate_series(date_trunc('month', (SELECT min(timestamp) FROM request_items_unpartitioned)),
+                         date_trunc('month', CURRENT_TIMESTAMP), INTERVAL '1 month') AS month;
+    PERFORM request_items_ensure_partitions(3);
+
+    INSERT INTO request_items (item_id, request_id, content_type, content, timestamp, file_unique_id)
+    SELECT item_id, request_id, content_type, content, COALESCE(timestamp, CURRENT_TIMESTAMP), file_unique_id
+    FROM request_items_unpartitioned;
+
+    DROP TABLE request_items_unpartitioned;
+END;
+$$;
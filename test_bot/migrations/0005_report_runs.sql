@@ -0,0 +1,14 @@
+-- Плановая рассылка отчётов (reports.ReportScheduler): одна строка на отчёт и
+-- дату запуска. Строка захватывается процессом на время отправки (claimed_at),
+-- статус 'sent' ставится в одной транзакции с постановкой письма в очередь,
+-- поэтому после перезапуска отчёт не уходит повторно.
+CREATE TABLE IF NOT EXISTS report_runs (
+    period TEXT NOT NULL,                   -- day или week
+    run_date DATE NOT NULL,                 -- Дата планового запуска
+    status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'sent')),
+    attempts INT NOT NULL DEFAULT 1,
+    claimed_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    email_id BIGINT,                        -- Письмо в email_outbox
+    sent_at TIMESTAMPTZ,
+    PRIMARY KEY (period, run_date)
+);
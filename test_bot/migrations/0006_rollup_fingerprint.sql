@@ -0,0 +1,4 @@
+-- Отпечаток данных дня (crud.period_fingerprint) на момент материализации.
+-- Если элементы закрытого дня изменились (удаление, поздняя запись черновика,
+-- восстановление секции из архива), снимок и агрегаты дня строятся заново.
+ALTER TABLE daily_rollup_days ADD COLUMN IF NOT EXISTS fingerprint TEXT;
@@ -0,0 +1,14 @@
+-- Предел серверного генератора request_id (миграция 0001). Перестановка
+-- request_id_permute - биекция [0, 900000) -> [100000, 1000000), поэтому
+-- request_id_counter ограничена MAXVALUE 899999 без зацикливания: после
+-- 900 000 обращений next_request_id() завершается ошибкой 2200H и новые
+-- обращения не создаются. Остаток видно в метрике bot_request_ids_remaining
+-- и в `python lifecycle.py status`; при расходе REQUEST_ID_WARN_RATIO
+-- обслуживание пишет предупреждение в лог. Чтобы продлить нумерацию, нужна
+-- новая перестановка на более широкий диапазон (семизначные номера).
+COMMENT ON SEQUENCE request_id_counter IS
+    'Счётчик для next_request_id(): не больше 900 000 номеров (MAXVALUE 899999, NO CYCLE)';
+COMMENT ON FUNCTION request_id_permute(BIGINT, BIGINT) IS
+    'Сеть Фейстеля: биекция [0, 900000) -> [100000, 1000000) с ключом из request_id_key';
+COMMENT ON FUNCTION next_request_id() IS
+    'Следующий шестизначный request_id; ошибка 2200H после 900 000 выданных номеров';
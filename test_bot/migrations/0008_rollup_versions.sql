@@ -0,0 +1,45 @@
+-- Признак устаревания снимков дней вместо отпечатка по всем строкам дня.
+-- version увеличивает триггер при любом изменении элементов дня, уже вошедших
+-- в снимок (timestamp не позже covered_until): удаление, поздняя запись
+-- черновика, правка. Секции, присоединённые из архива или отсоединённые в архив,
+-- отмечает lifecycle.py. Снимок актуален, пока built_version = version.
+ALTER TABLE daily_rollup_days ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE daily_rollup_days ADD COLUMN IF NOT EXISTS built_version BIGINT;  -- version на момент построения
+-- Снимок охватывает строки дня до этого момента
+ALTER TABLE daily_rollup_days ADD COLUMN IF NOT EXISTS covered_until TIMESTAMPTZ;
+ALTER TABLE daily_rollup_days DROP COLUMN IF EXISTS fingerprint;
+
+-- Обычная вставка нового элемента не попадает ни в один снимок: условие по
+-- covered_until отсекает строку дня до блокировки, записи не конкурируют
+CREATE OR REPLACE FUNCTION daily_rollup_days_touch(earliest TIMESTAMPTZ[]) RETURNS VOID AS $$
+    UPDATE daily_rollup_days AS d SET version = d.version + 1
+    FROM unnest(earliest) AS changed (at)
+    WHERE d.day = changed.at::DATE AND changed.at <= d.covered_until
+$$ LANGUAGE sql;
+
+-- Самый ранний изменённый элемент каждого дня
+CREATE OR REPLACE FUNCTION request_items_touch_days() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM daily_rollup_days_touch(ARRAY(SELECT min(timestamp) FROM new_rows GROUP BY timestamp::DATE));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM daily_rollup_days_touch(ARRAY(SELECT min(timestamp) FROM old_rows GROUP BY timestamp::DATE));
+    ELSE
+        PERFORM daily_rollup_days_touch(ARRAY(
+            SELECT min(timestamp) FROM (SELECT timestamp FROM old_rows UNION ALL SELECT timestamp FROM new_rows) AS t
+            GROUP BY timestamp::DATE));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS request_items_touch_days_insert ON request_items;
+CREATE TRIGGER request_items_touch_days_insert AFTER INSERT ON request_items
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION request_items_touch_days();
+DROP TRIGGER IF EXISTS request_items_touch_days_delete ON request_items;
+CREATE TRIGGER request_items_touch_days_delete AFTER DELETE ON request_items
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION request_items_touch_days();
+DROP TRIGGER IF EXISTS request_items_touch_days_update ON request_items;
+CREATE TRIGGER request_items_touch_days_update AFTER UPDATE ON request_items
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION request_items_touch_days();
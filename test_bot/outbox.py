@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import shutil
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from pool import pool
+from send_email import build_message, connect_smtp
+from metrics import SMTP_SECONDS, SMTP_ERRORS
+
+
+load_dotenv()
+
+
+# Очередь писем (outbox): обработчики только записывают письмо в таблицу
+# email_outbox, а фоновый отправитель доставляет его через небольшой пул
+# постоянных SMTP-соединений с повторами и переводом в "dead" после
+# исчерпания попыток.
+
+
+# after(cursor, email_id) - дополнительные изменения в той же транзакции
+def _enqueue(conn, subject, body, to_email, attachments, after=None):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "INSERT INTO email_outbox (subject, body, to_email, attachments) "
+            "VALUES (%s, %s, %s, %s::jsonb) RETURNING id",
+            (subject, body, to_email, json.dumps(attachments))
+        )
+        email_id = cursor.fetchone()[0]
+        if after is not None:
+            after(cursor, email_id)
+        conn.commit()
+        return email_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Захват пачки писем; зависшие в "sending" (упавший процесс) возвращаются по истечении блокировки
+def _claim(conn, limit, lock_seconds):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            UPDATE email_outbox
+            SET status = 'sending', attempts = attempts + 1,
+                next_attempt_at = now() + %s * interval '1 second'
+            WHERE id IN (
+                SELECT id FROM email_outbox
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= now()
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, subject, body, to_email, attachments, attempts
+            """,
+            (lock_seconds, limit)
+        )
+        rows = cursor.fetchall()
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _mark_sent(conn, email_id):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "UPDATE email_outbox SET status = 'sent', sent_at = now(), last_error = NULL WHERE id = %s",
+            (email_id,)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _mark_failed(conn, email_id, error, retry_in, dead):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            UPDATE email_outbox
+            SET status = %s, last_error = %s, next_attempt_at = now() + %s * interval '1 second'
+            WHERE id = %s
+            """,
+            ("dead" if dead else "pending", error, retry_in, email_id)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _purge_sent(conn, keep_days):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "DELETE FROM email_outbox WHERE status = 'sent' AND sent_at < now() - %s * interval '1 day'",
+            (keep_days,)
+        )
+        conn.commit()
+        return cursor.rowcount
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Пул постоянных авторизованных SMTP-соединений (используется из потоков)
+class SmtpConnectionPool:
+    def __init__(self, size=2, check_after=30.0, connect=connect_smtp):
+        self.size = size
+        self.check_after = check_after  # После такого простоя соединение проверяется NOOP
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put((None, 0.0))  # Соединения открываются при первой отправке
+
+    def _alive(self, server):
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+    def send(self, msg, to_email):
+        import smtplib  # Уже загружен connect_smtp при первом соединении
+
+        server, released_at = self._idle.get()
+        try:
+            if server is not None and time.monotonic() - released_at > self.check_after and not self._alive(server):
+                self._close(server)
+                server = None
+            if server is None:
+                server = self._connect()
+            try:
+                server.sendmail(msg['From'], to_email, msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # Сервер закрыл соединение - одна повторная попытка на новом
+                server = self._connect()
+                server.sendmail(msg['From'], to_email, msg.as_string())
+        except BaseException:
+            if server is not None:
+                self._close(server)
+            self._idle.put((None, 0.0))
+            raise
+        self._idle.put((server, time.monotonic()))
+
+    def close(self):
+        for _ in range(self.size):
+            server, _ = self._idle.get()
+            if server is not None:
+                self._close(server)
+            self._idle.put((None, 0.0))
+
+
+class EmailOutbox:
+    def __init__(self, spool_dir="outbox", connections=2, batch_size=10, poll_interval=5.0,
+                 max_attempts=8, backoff_base=30.0, backoff_max=3600.0, lock_seconds=300, keep_days=7):
+        self.spool_dir = spool_dir           # Каталог для копий вложений до отправки
+        self.connections = connections
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock_seconds = lock_seconds
+        self.keep_days = keep_days
+        self._smtp = SmtpConnectionPool(size=connections)
+        self._executor = None
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    # Копия вложения в каталоге очереди: письмо не зависит от жизни исходного файла
+    def _spool(self, file_path, filename):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        filename = filename or os.path.basename(file_path)
+        spooled = os.path.join(self.spool_dir, f"{uuid.uuid4().hex}_{filename}")
+        try:
+            os.link(file_path, spooled)
+        except OSError:
+            shutil.copyfile(file_path, spooled)
+        return {"path": os.path.abspath(spooled), "filename": filename}
+
+    # Постановка письма в очередь; attachments - пути к файлам или пары (путь, имя);
+    # after(cursor, email_id) выполняется в транзакции записи письма
+    async def enqueue(self, subject, body, to_email, attachments=(), after=None):
+        if not to_email:
+            logging.warning("Письмо '%s' не поставлено в очередь: не указан адрес", subject)
+            return None
+        spooled = []
+        try:
+            for item in attachments:
+                file_path, filename = item if isinstance(item, tuple) else (item, None)
+                spooled.append(await asyncio.to_thread(self._spool, file_path, filename))
+            email_id = await pool.run(_enqueue, subject, body, to_email, spooled, after)
+        except BaseException:
+            # Письмо не записано: копии вложений в каталоге очереди никому не нужны
+            await asyncio.to_thread(self._remove_attachments, spooled)
+            raise
+        self._wakeup.set()
+        logging.info("Письмо %s для %s поставлено в очередь", email_id, to_email)
+        return email_id
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    @staticmethod
+    def _remove_attachments(attachments):
+        for attachment in attachments:
+            try:
+                os.remove(attachment["path"])
+            except FileNotFoundError:
+                pass
+
+    def _send(self, subject, body, to_email, attachments):
+        msg = build_message(subject, body, to_email,
+                            [(a["path"], a["filename"]) for a in attachments])
+        try:
+            with SMTP_SECONDS.time():
+                self._smtp.send(msg, to_email)
+        except Exception:
+            SMTP_ERRORS.inc()
+            raise
+
+    async def _deliver(self, row):
+        email_id, subject, body, to_email, attachments, attempts = row
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._send, subject, body, to_email, attachments)
+        except Exception as e:
+            dead = attempts >= self.max_attempts
+            retry_in = 0 if dead else self._backoff(attempts)
+            await pool.run(_mark_failed, email_id, str(e), retry_in, dead)
+            if dead:
+                logging.error("Письмо %s для %s не доставлено после %s попыток: %s", email_id, to_email, attempts, e)
+                self._remove_attachments(attachments)
+            else:
+                logging.warning("Ошибка отправки письма %s (попытка %s), повтор через %.0f с: %s",
+                                email_id, attempts, retry_in, e)
+            return
+        await pool.run(_mark_sent, email_id)
+        self._remove_attachments(attachments)
+        logging.info("Письмо %s отправлено на %s", email_id, to_email)
+
+    async def process_batch(self):
+        rows = await pool.run(_claim, self.batch_size, self.lock_seconds)
+        if rows:
+            await asyncio.gather(*(self._deliver(row) for row in rows))
+        return len(rows)
+
+    async def _run(self):
+        last_purge = 0.0
+        while not self._stopping:
+            try:
+                while not self._stopping and await self.process_batch() == self.batch_size:
+                    pass
+                if time.monotonic() - last_purge > 3600:
+                    last_purge = time.monotonic()
+                    await pool.run(_purge_sent, self.keep_days)
+            except Exception as e:
+                logging.error("Ошибка отправителя писем: %s", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix="smtp")
+            self._task = asyncio.create_task(self._run())
+
+    # Дожидаемся писем, которые уже отправляются; остальные остаются в таблице
+    # и будут доставлены после перезапуска
+    async def stop(self, timeout=30.0):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Отправитель писем не завершился вовремя")
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._smtp.close()
+
+
+outbox = EmailOutbox(
+    spool_dir=os.getenv("OUTBOX_SPOOL_DIR", "outbox"),
+    connections=int(os.getenv("OUTBOX_SMTP_CONNECTIONS", 2)),
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", 10)),
+    poll_interval=float(os.getenv("OUTBOX_POLL_INTERVAL", 5)),
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8)),
+    backoff_base=float(os.getenv("OUTBOX_BACKOFF_BASE", 30)),
+    backoff_max=float(os.getenv("OUTBOX_BACKOFF_MAX", 3600)),
+)
@@ -0,0 +1,214 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from psycopg2.extensions import STATUS_READY
+
+from db import get_database_connection
+from metrics import DB_ACQUIRE_SECONDS, DB_QUERY_SECONDS, DB_ERRORS
+
+
+load_dotenv()
+
+
+class PoolError(Exception):
+    pass
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+# Асинхронный пул соединений с базой данных.
+# Соединения psycopg2 блокирующие, поэтому все запросы выполняются в отдельном
+# пуле потоков, а событийный цикл aiogram только ждёт результата.
+class ConnectionPool:
+    def __init__(self, min_size=1, max_size=10, acquire_timeout=10.0,
+                 max_idle=300.0, max_lifetime=3600.0, check_interval=30.0,
+                 connect=get_database_connection):
+        if min_size > max_size:
+            raise ValueError("min_size не может быть больше max_size")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_idle = max_idle                # Сколько соединение может простаивать
+        self.max_lifetime = max_lifetime        # Максимальный срок жизни соединения
+        self.check_interval = check_interval    # Простой, после которого соединение проверяется
+        self._connect = connect
+
+        self._idle = deque()        # (conn, created_at, released_at)
+        self._created = {}          # id(conn) -> created_at для выданных соединений
+        self._size = 0
+        self._semaphore = None
+        self._executor = None
+        self._maintenance_task = None
+        self._closed = True
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    async def open(self):
+        if not self._closed:
+            return
+        self._closed = False
+        self._semaphore = asyncio.Semaphore(self.max_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="db")
+        for _ in range(self.min_size):
+            conn = await self._new_connection()
+            self._idle.append((conn, time.monotonic(), time.monotonic()))
+        self._maintenance_task = asyncio.create_task(self._maintenance())
+        logging.info("Пул соединений открыт: min=%s max=%s", self.min_size, self.max_size)
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        while self._idle:
+            conn, _, _ = self._idle.popleft()
+            await self._discard(conn)
+        self._executor.shutdown(wait=True)
+        logging.info("Пул соединений закрыт")
+
+    # Выполнение блокирующей функции в потоке пула
+    async def run_in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _new_connection(self):
+        conn = await self.run_in_thread(self._connect)
+        if conn is None:
+            raise PoolError("Не удалось установить соединение с базой данных")
+        self._size += 1
+        return conn
+
+    async def _discard(self, conn):
+        self._size -= 1
+        try:
+            await self.run_in_thread(conn.close)
+        except Exception as e:
+            logging.warning("Ошибка при закрытии соединения: %s", e)
+
+    # Проверка соединения перед выдачей
+    @staticmethod
+    def _check(conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    async def acquire(self):
+        if self._closed:
+            raise PoolError("Пул соединений закрыт")
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(
+                f"Не удалось получить соединение за {self.acquire_timeout} с "
+                f"(занято {self._size - len(self._idle)} из {self.max_size})"
+            ) from None
+
+        try:
+            now = time.monotonic()
+            while self._idle:
+                conn, created_at, released_at = self._idle.pop()  # LIFO: самое "тёплое" соединение
+                if conn.closed or now - created_at > self.max_lifetime:
+                    await self._discard(conn)
+                    continue
+                if now - released_at > self.check_interval and not await self.run_in_thread(self._check, conn):
+                    logging.warning("Соединение не прошло проверку и будет пересоздано")
+                    await self._discard(conn)
+                    continue
+                self._created[id(conn)] = created_at
+                return conn
+
+            conn = await self._new_connection()
+            self._created[id(conn)] = time.monotonic()
+            return conn
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    async def release(self, conn):
+        created_at = self._created.pop(id(conn), time.monotonic())
+        try:
+            if self._closed or conn.closed:
+                await self._discard(conn)
+                return
+            # Незавершённая транзакция не должна достаться следующему владельцу
+            if conn.status != STATUS_READY:
+                try:
+                    await self.run_in_thread(conn.rollback)
+                except Exception:
+                    await self._discard(conn)
+                    return
+            self._idle.append((conn, created_at, time.monotonic()))
+        finally:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    # Выполнение функции func(conn, *args) на соединении из пула.
+    # Ожидание соединения и работа функции замеряются отдельно (метрики по имени функции).
+    async def run(self, func, *args):
+        name = func.__name__
+        started = time.perf_counter()
+        async with self.connection() as conn:
+            acquired = time.perf_counter()
+            DB_ACQUIRE_SECONDS.observe(acquired - started, function=name)
+            try:
+                return await self.run_in_thread(func, conn, *args)
+            except Exception:
+                DB_ERRORS.inc(function=name)
+                raise
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - acquired, function=name)
+
+    # Периодически закрываем простаивающие и устаревшие соединения сверх min_size
+    async def _maintenance(self):
+        interval = max(1.0, min(self.max_idle, self.check_interval) / 2)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            surplus = self._size - self.min_size
+            expired = [
+                entry for entry in self._idle
+                if now - entry[2] > self.max_idle or now - entry[1] > self.max_lifetime
+            ][:max(surplus, 0)]
+            for entry in expired:
+                self._idle.remove(entry)
+            for conn, _, _ in expired:
+                await self._discard(conn)
+
+
+pool = ConnectionPool(
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE", 1)),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+    acquire_timeout=float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 10)),
+    max_idle=float(os.getenv("DB_POOL_MAX_IDLE", 300)),
+    max_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", 3600)),
+    check_interval=float(os.getenv("DB_POOL_CHECK_INTERVAL", 30)),
+)
@@ -0,0 +1,202 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+
+from psycopg2 import sql
+from psycopg2.extensions import cursor as base_cursor
+from dotenv import load_dotenv
+
+from statements import statement_text
+
+
+load_dotenv()
+
+# Профилирование запросов включается QUERY_PROFILING=1 (по умолчанию выключено:
+# нормализация текста и учёт стоят времени на каждом запросе). Каждый execute
+# и COPY курсора замеряется и сводится в таблицу по нормализованному тексту
+# (литералы и параметры заменены на ?).
+# Запросы дольше QUERY_SLOW_MS пишутся в лог; для медленных SELECT с
+# вероятностью QUERY_EXPLAIN_SAMPLE дополнительно снимается план
+# EXPLAIN (ANALYZE, BUFFERS) - он выполняет запрос повторно, поэтому по
+# умолчанию выключен. План снимается на отдельном соединении в транзакции
+# только для чтения (транзакция вызывающего кода не затрагивается) и только
+# для SELECT, в котором вызываются лишь функции из EXPLAIN_CALLS: SELECT
+# pg_advisory_lock(...) или функция с DDL повторно не выполняются. Для
+# подготовленного запроса (EXECUTE имя (...), statements.py) проверяется и
+# объясняется его текст из реестра.
+QUERY_PROFILING = os.getenv("QUERY_PROFILING", "0") == "1"
+QUERY_SLOW_MS = float(os.getenv("QUERY_SLOW_MS", 200))
+QUERY_EXPLAIN_SAMPLE = float(os.getenv("QUERY_EXPLAIN_SAMPLE", 0))
+QUERY_STATS_SIZE = int(os.getenv("QUERY_STATS_SIZE", 500))  # Сколько разных запросов хранить
+QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv("QUERY_EXPLAIN_TIMEOUT_MS", 5000))
+
+# Функции и ключевые слова со скобками, допустимые в объясняемом запросе
+EXPLAIN_CALLS = frozenset({
+    "count", "sum", "min", "max", "avg", "coalesce", "nullif", "length", "lower", "upper", "hashtext",
+    "json_agg", "json_build_object", "jsonb_agg", "jsonb_build_object", "array_agg", "date_trunc", "now",
+    "in", "any", "exists", "from", "join", "on", "and", "or", "not", "as", "over", "filter", "values",
+})
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_SPACES = re.compile(r"\s+")
+_CALL = re.compile(r"\b(\w+)\s*\(")
+_EXECUTE = re.compile(r"^\s*EXECUTE\s+(\w+)", re.I)
+_TUPLES = re.compile(r"\((?:\?(?:::\w+)?(?:,\s*)?)+\)(?:\s*,\s*\((?:\?(?:::\w+)?(?:,\s*)?)+\))*")
+
+
+# Нормализованный текст: одинаковые запросы с разными значениями сводятся в одну строку
+def normalize(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", errors="replace")
+    query = _STRING.sub("?", query)
+    query = _PLACEHOLDER.sub("?", query)
+    query = _NUMBER.sub("?", query)
+    query = _SPACES.sub(" ", query).strip().rstrip(";")
+    return _TUPLES.sub("(...)", query)  # VALUES (?, ?), (?, ?) и IN (?, ?, ?) -> (...)
+
+
+class QueryStats:
+    def __init__(self, size=QUERY_STATS_SIZE):
+        self.size = size
+        self._stats = {}  # текст -> {"calls", "total", "max", "rows", "plan"}
+        self._lock = threading.Lock()
+
+    def record(self, query, seconds, rows):
+        with self._lock:
+            entry = self._stats.get(query)
+            if entry is None:
+                if len(self._stats) >= self.size:
+                    # Вытесняем запрос с наименьшим суммарным временем
+                    del self._stats[min(self._stats, key=lambda key: self._stats[key]["total"])]
+                entry = self._stats[query] = {"calls": 0, "total": 0.0, "max": 0.0, "rows": 0, "plan": None}
+            entry["calls"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["rows"] += max(rows, 0)
+
+    # Число выполнений каждого запроса (для сравнения снимков до и после прогона)
+    def calls(self):
+        with self._lock:
+            return {query: entry["calls"] for query, entry in self._stats.items()}
+
+    def set_plan(self, query, plan):
+        with self._lock:
+            if query in self._stats:
+                self._stats[query]["plan"] = plan
+
+    # Топ запросов: by = total (суммарное время), calls (частота) или max (самый долгий вызов)
+    def top(self, n=10, by="total"):
+        with self._lock:
+            items = [(query, dict(entry)) for query, entry in self._stats.items()]
+        return sorted(items, key=lambda item: item[1][by], reverse=True)[:n]
+
+    def dump(self, n=10):
+        lines = []
+        for by, title in (("total", "Самые затратные запросы"), ("calls", "Самые частые запросы")):
+            lines.append(f"{title}:")
+            lines.append(f"{'вызовов':>8} {'всего, мс':>10} {'средн., мс':>10} {'макс., мс':>10} {'строк':>8}  запрос")
+            for query, entry in self.top(n, by):
+                lines.append(
+                    f"{entry['calls']:>8} {entry['total'] * 1000:>10.1f} "
+                    f"{entry['total'] / entry['calls'] * 1000:>10.2f} {entry['max'] * 1000:>10.1f} "
+                    f"{entry['rows']:>8}  {query[:200]}"
+                )
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+query_stats = QueryStats()
+
+
+# Курсор с замером каждого запроса; подключается через cursor_factory соединения
+class ProfilingCursor(base_cursor):
+    def execute(self, query, vars=None):
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, vars, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(query, None, time.perf_counter() - started)
+
+    # COPY (выгрузка отчётов и архивов секций) - тоже запрос к базе
+    def copy_expert(self, query, file, size=8192):
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(query, file, size)
+        finally:
+            self._record(query, None, time.perf_counter() - started)
+
+    def _record(self, query, vars, seconds):
+        normalized = normalize(query)
+        query_stats.record(normalized, seconds, self.rowcount)
+        if seconds * 1000 < QUERY_SLOW_MS:
+            return
+        logging.warning("Медленный запрос: %.1f мс, строк %s: %s", seconds * 1000, self.rowcount, normalized[:500])
+        if QUERY_EXPLAIN_SAMPLE > 0 and random.random() < QUERY_EXPLAIN_SAMPLE:
+            self._explain(query, vars, normalized)
+
+    # План только для SELECT на обычном курсоре с функциями из EXPLAIN_CALLS
+    def _explain(self, query, vars, normalized):
+        text = query.decode("utf-8", errors="replace") if isinstance(query, bytes) else query
+        if self.name is not None:
+            return
+        prepare = None
+        match = _EXECUTE.match(text)
+        if match:
+            # На новом соединении запрос готовится заново, EXPLAIN выполняет его через EXECUTE
+            statement = statement_text(match.group(1))
+            if statement is None or not explainable(statement):
+                return
+            prepare = f"PREPARE {match.group(1)} AS {statement}"
+        elif not explainable(text):
+            return
+        from db import get_database_connection  # db сам импортирует этот модуль
+
+        conn = get_database_connection()
+        if conn is None:
+            return
+        try:
+            conn.set_session(readonly=True)
+            with conn.cursor(cursor_factory=base_cursor) as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s", (QUERY_EXPLAIN_TIMEOUT_MS,))
+                if prepare:
+                    cursor.execute(prepare)
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + text, vars)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            logging.warning("Не удалось получить план запроса: %s", e)
+            return
+        finally:
+            conn.rollback()
+            conn.close()
+        query_stats.set_plan(normalized, plan)
+        logging.warning("План медленного запроса:\n%s", plan)
+
+
+# Запрос можно выполнить повторно под EXPLAIN ANALYZE: чтение без блокировок
+# строк и без вызова функций вне EXPLAIN_CALLS
+def explainable(text):
+    text = _STRING.sub("?", text)
+    if not text.lstrip().upper().startswith("SELECT") or re.search(r"\bFOR\s+(UPDATE|SHARE|NO KEY|KEY)\b", text, re.I):
+        return False
+    return all(name.lower() in EXPLAIN_CALLS for name in _CALL.findall(text))
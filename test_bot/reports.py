@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import uuid
+import types
+import shutil
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+
+from dotenv import load_dotenv
+
+from excel import report_period
+from export import build_report, REPORT_FORMATS
+from metrics import REPORT_SECONDS
+from pool import pool
+from rollups import window_key
+
+
+load_dotenv()
+
+# Последний отчёт каждого вида (период + формат) хранится в REPORT_ARTIFACT_DIR
+# вместе с отпечатком данных и переживает перезапуск бота.
+REPORT_ARTIFACT_DIR = os.getenv("REPORT_ARTIFACT_DIR", "report_artifacts")
+
+
+# Процессы spawn заново выполняют главный модуль (python media_handler.py - бот,
+# диспетчер, реестр филиалов, поток логирования). Процессы пула создаются при
+# отправке задачи, поэтому на это время главный модуль подменяется пустым:
+# дочерний процесс импортирует только export, откуда берётся build_report.
+@contextmanager
+def _without_main():
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+
+# Запуск формирования отчётов в отдельных процессах, чтобы бот продолжал
+# отвечать, пока строится отчёт. Одинаковые запросы (период + формат + конец
+# окна), пришедшие во время построения, присоединяются к уже идущей задаче.
+# Готовый отчёт переиспользуется, пока не изменились данные его окна: ключ
+# отчёта - конец окна и версии снимков его дней (rollups.window_key). Окно,
+# заканчивающееся сейчас, собирается из снимков дней, и из базы читаются
+# только строки после конца снимка текущего дня (rollups.prepare_range).
+class ReportJobs:
+    def __init__(self, max_workers=1, directory=REPORT_ARTIFACT_DIR):
+        self.max_workers = max_workers
+        self.directory = directory
+        self._executor = None
+        self._inflight = {}      # (period, format, date) -> asyncio.Task
+        self._done = self._load()  # (period, format) -> (ключ, file_path)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Пул процессов и multiprocessing загружаются при первом отчёте
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # spawn: дочерний процесс не наследует событийный цикл и соединения бота
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _artifact_path(self, period, fmt):
+        return os.path.join(self.directory, f"report_{period}{REPORT_FORMATS[fmt]}")
+
+    def _meta_path(self, period, fmt):
+        return os.path.join(self.directory, f"report_{period}_{fmt}.json")
+
+    # Готовые отчёты, оставшиеся с прошлого запуска
+    def _load(self):
+        done = {}
+        if not os.path.isdir(self.directory):
+            return done
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith("report_") and filename.endswith(".json")):
+                continue
+            period, _, fmt = filename[len("report_"):-len(".json")].partition("_")
+            if fmt not in REPORT_FORMATS:
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), encoding="utf-8") as file:
+                    key = json.load(file)["key"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if os.path.exists(self._artifact_path(period, fmt)):
+                done[(period, fmt)] = (key, self._artifact_path(period, fmt))
+        return done
+
+    @staticmethod
+    def _replace(path, write):
+        partial = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            write(partial)
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+    # Перенос нового отчёта на место прежнего; файл подменяется атомарно,
+    # письма в очереди хранят свои копии вложений
+    def _store(self, period, fmt, key, file_path):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._artifact_path(period, fmt)
+        self._replace(path, lambda partial: shutil.move(file_path, partial))
+
+        def write_meta(partial):
+            with open(partial, "w", encoding="utf-8") as file:
+                json.dump({"key": key, "built_at": datetime.now().isoformat()}, file)
+        self._replace(self._meta_path(period, fmt), write_meta)
+        return path
+
+    def in_progress(self, period, fmt="xlsx"):
+        return any(key[:2] == (period, fmt) for key in self._inflight)
+
+    # Путь к актуальному отчёту за окно, заканчивающееся в end (по умолчанию -
+    # сейчас); файл принадлежит ReportJobs, удалять его нельзя
+    async def build(self, period, fmt="xlsx", end=None):
+        end = end or datetime.now()
+        key = (period, fmt, end)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build(period, fmt, end))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    # Ключ в виде, пригодном для JSON (сравнивается с сохранённым на диске);
+    # None - окно не покрыто актуальными снимками
+    @staticmethod
+    def _key(end, days):
+        return None if days is None else [end.isoformat(), days]
+
+    async def _build(self, period, fmt, end):
+        start_date, end_date = report_period(period, end)
+        key = self._key(end, await pool.run(window_key, start_date, end_date))
+
+        cached = self._done.get((period, fmt))
+        if key is not None and cached and cached[0] == key and os.path.exists(cached[1]):
+            logging.info("Отчёт '%s' (%s) не изменился, используется готовый файл", period, fmt)
+            return cached[1]
+
+        started = datetime.now()
+        with REPORT_SECONDS.time(period=period, format=fmt):
+            file_path, days = await self._run(build_report, period, end, fmt)
+        logging.info("Отчёт '%s' (%s) сформирован за %.1f с", period, fmt, (datetime.now() - started).total_seconds())
+
+        # Ключ - по снимкам, из которых отчёт действительно построен
+        key = self._key(end, days)
+        file_path = await asyncio.to_thread(self._store, period, fmt, key, file_path)
+        self._done[(period, fmt)] = (key, file_path)
+        return file_path
+
+    # Выполнение в пуле процессов. Если процесс пула погиб (например, из-за
+    # нехватки памяти на большом отчёте), пул непригоден для всех следующих
+    # задач: он пересоздаётся, и задача повторяется один раз
+    async def _run(self, function, *args):
+        from concurrent.futures.process import BrokenProcessPool
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                with _without_main():
+                    future = loop.run_in_executor(executor, function, *args)
+                return await future
+            except BrokenProcessPool:
+                if self._executor is executor:  # Пул мог уже пересоздать другой отчёт
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = None
+                if attempt:
+                    raise
+                logging.warning("Процесс формирования отчётов завершился аварийно, пул процессов пересоздан")
+
+    # Готовые отчёты остаются на диске до следующего запуска
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+report_jobs = ReportJobs(max_workers=int(os.getenv("REPORT_WORKERS", 1)))
+
+
+# Плановая рассылка: ежедневный отчёт в REPORT_DAILY_AT, еженедельный - в день
+# REPORT_WEEKLY_DAY (0 - понедельник) в REPORT_WEEKLY_AT. Пустое время - рассылка
+# выключена. Пропущенный из-за остановки бота запуск выполняется после старта,
+# если прошло не больше REPORT_SCHEDULE_CATCHUP_HOURS. Каждый запуск захватывается
+# строкой в report_runs, поэтому ни перезапуск, ни несколько процессов бота не
+# приводят к повторной отправке.
+def _schedule_time(value):
+    return time.fromisoformat(value) if value else None
+
+
+REPORT_DAILY_AT = _schedule_time(os.getenv("REPORT_DAILY_AT", ""))
+REPORT_WEEKLY_AT = _schedule_time(os.getenv("REPORT_WEEKLY_AT", ""))
+REPORT_WEEKLY_DAY = int(os.getenv("REPORT_WEEKLY_DAY", 0))
+REPORT_SCHEDULE_CATCHUP_HOURS = float(os.getenv("REPORT_SCHEDULE_CATCHUP_HOURS", 6))
+REPORT_SCHEDULE_LEASE = int(os.getenv("REPORT_SCHEDULE_LEASE", 1800))  # Сколько секунд действует захват запуска
+REPORT_SCHEDULE_POLL = 60
+
+
+# Последний запуск по расписанию (weekday - день недели или None, at - время) не позже now
+def _last_due(weekday, at, now):
+    due = datetime.combine(now.date(), at)
+    if weekday is None:
+        return due if due <= now else due - timedelta(days=1)
+    due -= timedelta(days=(now.weekday() - weekday) % 7)
+    return due if due <= now else due - timedelta(weeks=1)
+
+
+# Захват запуска: 'claimed' - отправляет этот процесс, 'sent' - уже отправлен,
+# 'busy' - отправляет другой процесс (захват ещё не истёк)
+def _claim_run(conn, period, run_date, lease_seconds):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO report_runs (period, run_date) VALUES (%s, %s)
+            ON CONFLICT (period, run_date) DO UPDATE
+            SET claimed_at = now(), attempts = report_runs.attempts + 1
+            WHERE report_runs.status = 'running'
+              AND report_runs.claimed_at < now() - %s * interval '1 second'
+            RETURNING status
+            """,
+            (period, run_date, lease_seconds)
+        )
+        if cursor.fetchone():
+            conn.commit()
+            return "claimed"
+        cursor.execute("SELECT status FROM report_runs WHERE period = %s AND run_date = %s", (period, run_date))
+        status = cursor.fetchone()[0]
+        conn.commit()
+        return "sent" if status == "sent" else "busy"
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _mark_run_sent(cursor, period, run_date, email_id):
+    cursor.execute(
+        "UPDATE report_runs SET status = 'sent', sent_at = now(), email_id = %s WHERE period = %s AND run_date = %s",
+        (email_id, period, run_date)
+    )
+
+
+def _finish_run(conn, period, run_date):
+    cursor = conn.cursor()
+    try:
+        _mark_run_sent(cursor, period, run_date, None)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class ReportScheduler:
+    # send(period, end, after) - формирует отчёт за окно, заканчивающееся в end,
+    # и ставит письмо в очередь, вызывая after(cursor, email_id) в транзакции
+    # постановки; возвращает id письма
+    def __init__(self, send, daily_at=REPORT_DAILY_AT, weekly_at=REPORT_WEEKLY_AT, weekly_day=REPORT_WEEKLY_DAY,
+                 catchup_hours=REPORT_SCHEDULE_CATCHUP_HOURS, lease=REPORT_SCHEDULE_LEASE):
+        self.send = send
+        self.schedules = {}  # period -> (день недели или None, время)
+        if daily_at:
+            self.schedules["day"] = (None, daily_at)
+        if weekly_at:
+            self.schedules["week"] = (weekly_day, weekly_at)
+        self.catchup = timedelta(hours=catchup_hours)
+        self.lease = lease
+        self._sent = set()  # (period, run_date), отправленные или уже проверенные
+        self._task = None
+
+    # Последний плановый запуск не позже now
+    def last_due(self, period, now):
+        return _last_due(*self.schedules[period], now)
+
+    def next_due(self, period, now):
+        return self.last_due(period, now) + (timedelta(days=1) if period == "day" else timedelta(weeks=1))
+
+    async def run_due(self, now=None):
+        now = now or datetime.now()
+        for period in self.schedules:
+            due = self.last_due(period, now)
+            key = (period, due.date())
+            if key in self._sent or now - due > self.catchup:
+                continue
+            status = await pool.run(_claim_run, period, due.date(), self.lease)
+            if status == "busy":
+                continue
+            if status == "claimed":
+                try:
+                    email_id = await self.send(
+                        period, due, lambda cursor, email_id: _mark_run_sent(cursor, period, due.date(), email_id))
+                    if email_id is None:
+                        await pool.run(_finish_run, period, due.date())  # Адрес не настроен - письма нет
+                except Exception as e:
+                    # Захват истечёт, и запуск повторится
+                    logging.exception("Ошибка плановой отправки отчёта '%s' за %s: %s", period,
+                                      due.strftime("%Y-%m-%d"), e)
+                    continue
+                logging.info("Плановый отчёт '%s' за %s отправлен", period, due.strftime("%Y-%m-%d"))
+            self._sent.add(key)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_due()
+            except Exception as e:
+                logging.error("Ошибка планировщика отчётов: %s", e)
+            now = datetime.now()
+            wait = min((self.next_due(period, now) - now).total_seconds() for period in self.schedules)
+            await asyncio.sleep(max(1.0, min(wait, REPORT_SCHEDULE_POLL)))
+
+    def start(self):
+        if self._task is None and self.schedules:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,390 @@
+import os
+import csv
+import gzip
+import uuid
+import shutil
+import logging
+from datetime import datetime, time, timedelta
+
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from crud import iter_requests_in_period, period_column_lengths
+
+
+load_dotenv()
+
+# Закрытые дни материализуются один раз: строки дня сохраняются в сжатый
+# снимок на диске, а количество элементов по филиалам и типам - в таблицу
+# daily_rollups. Текущий день тоже снимается, но с отставанием на CLOSE_GRACE
+# и дописывается к уже готовому снимку, поэтому из базы отчёт читает только
+# строки после конца снимка. Изменение строк, уже вошедших в снимок, отмечает
+# триггер (миграция 0008), и день строится заново при следующем отчёте.
+
+SNAPSHOT_DIR = os.getenv("REPORT_SNAPSHOT_DIR", "snapshots")
+# Снимок отстаёт от текущего момента на столько минут: успевают записаться
+# черновики, накопленные к этому моменту (закрытый день - через столько же
+# минут после полуночи)
+CLOSE_GRACE = timedelta(minutes=int(os.getenv("REPORT_SNAPSHOT_GRACE_MINUTES", 10)))
+# Класс advisory-блокировки материализации (второй ключ - номер дня): один и тот
+# же день не строится двумя процессами или потоками одновременно
+LOCK_KEY = 72_460_013
+
+MICROSECOND = timedelta(microseconds=1)
+
+
+def day_bounds(day):
+    start = datetime.combine(day, time.min)
+    return start, start + timedelta(days=1) - MICROSECOND
+
+
+def snapshot_path(day):
+    return os.path.join(SNAPSHOT_DIR, f"{day.isoformat()}.csv.gz")
+
+
+# До какого момента снимается день: закрытый - целиком, текущий - до now - CLOSE_GRACE
+def _target(day, now):
+    return min(day_bounds(day)[1], now - CLOSE_GRACE)
+
+
+# Состояние материализованных дней интервала одним запросом:
+# день -> (длины столбцов, version, built_version, covered_until)
+def _days_info(conn, first_day, last_day):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            SELECT day, column_lengths, version, built_version, covered_until FROM daily_rollup_days
+            WHERE day BETWEEN %s AND %s
+            """,
+            (first_day, last_day)
+        )
+        return {day: (lengths, version, built_version, until and until.replace(tzinfo=None))
+                for day, lengths, version, built_version, until in cursor.fetchall()}
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+# (длины столбцов, версия, до какого момента) готового снимка или None, если день
+# нужно построить заново: после построения менялись его строки (version
+# увеличил триггер) или нет файла
+def _current(day, info):
+    if info is None:
+        return None
+    lengths, version, built_version, until = info
+    if built_version == version and until is not None and os.path.exists(snapshot_path(day)):
+        return lengths, version, until
+    return None
+
+
+# Снимок не нужно дописывать: он охватывает target, а у текущего дня отстаёт
+# не больше чем на CLOSE_GRACE (остаток отчёт читает из базы)
+def _fresh(day, current, target):
+    if current is None:
+        return False
+    until = current[2]
+    return until >= target or (target < day_bounds(day)[1] and until >= target - CLOSE_GRACE)
+
+
+def _advisory(conn, function, day):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT {function}(%s, %s)", (LOCK_KEY, day.toordinal()))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+# Материализация дня до момента until (по умолчанию - весь день): снимок строк +
+# агрегаты. Готовый снимок дописывается, а строится заново, только если
+# изменились уже вошедшие в него строки.
+def materialize_day(conn, day, until=None):
+    until = until or day_bounds(day)[1]
+    _advisory(conn, "pg_advisory_lock", day)
+    try:
+        # Пока ждали блокировку, день мог построить другой процесс
+        current = _current(day, _days_info(conn, day, day).get(day))
+        if not _fresh(day, current, until):
+            extended = _extend_day(conn, day, current, until) if current else None
+            current = extended or _build_day(conn, day, until)
+    finally:
+        _advisory(conn, "pg_advisory_unlock", day)
+    return current
+
+
+# Строки в снимок; длины столбцов и количество по филиалам и типам считаются по ним же
+def _write_rows(file, rows, lengths, totals):
+    writer = csv.writer(file)
+    for row in rows:
+        row = list(row)
+        row[-1] = row[-1].replace(tzinfo=None)
+        row[2] = row[2] or ""
+        lengths = [max(length, len(str(value))) for length, value in zip(lengths, row)]
+        totals[(row[2], row[3])] = totals.get((row[2], row[3]), 0) + 1
+        row[-1] = row[-1].isoformat()
+        writer.writerow(row)
+    return lengths
+
+
+# Снимок заменяется атомарно: отчёт, уже читающий прежний файл, дочитывает его
+def _replace_snapshot(day, write):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = f"{snapshot_path(day)}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, snapshot_path(day))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Агрегаты и длины столбцов; built_version = version делает снимок снова актуальным
+def _save_day(conn, day, version, lengths, totals, replace):
+    cursor = conn.cursor()
+    try:
+        if replace:
+            cursor.execute("DELETE FROM daily_rollups WHERE day = %s", (day,))
+        execute_values(
+            cursor,
+            """
+            INSERT INTO daily_rollups (day, branch, content_type, items) VALUES %s
+            ON CONFLICT (day, branch, content_type) DO UPDATE SET items = daily_rollups.items + EXCLUDED.items
+            """,
+            [(day, branch, content_type, items) for (branch, content_type), items in totals.items()]
+        )
+        cursor.execute(
+            """
+            UPDATE daily_rollup_days SET column_lengths = %s, built_version = %s, built_at = CURRENT_TIMESTAMP
+            WHERE day = %s
+            """,
+            (lengths, version, day)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# День отмечается охваченным до чтения строк: изменение, пришедшее во время
+# построения, увеличит version, и день построится заново при следующем отчёте.
+def _build_day(conn, day, until):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO daily_rollup_days (day, column_lengths, covered_until) VALUES (%s, %s, %s)
+            ON CONFLICT (day) DO UPDATE SET covered_until = EXCLUDED.covered_until, built_version = NULL
+            RETURNING version
+            """,
+            (day, [0] * 6, until)
+        )
+        version = cursor.fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    lengths = [0] * 6
+    totals = {}
+
+    def write(path):
+        nonlocal lengths
+        with gzip.open(path, "wt", newline="", encoding="utf-8") as file:
+            lengths = _write_rows(file, iter_requests_in_period(conn, day_bounds(day)[0], until), lengths, totals)
+
+    _replace_snapshot(day, write)
+    _save_day(conn, day, version, lengths, totals, replace=True)
+    logging.info("День %s материализован до %s", day, until.strftime("%H:%M:%S"))
+    return lengths, version, until
+
+
+# Дописывание готового снимка строками после его конца: копия файла и новый
+# gzip-член в конце, агрегаты увеличиваются на количество новых строк.
+# None - снимок устарел, пока ждали блокировку, и день нужно построить заново.
+def _extend_day(conn, day, current, until):
+    lengths, version, covered = current
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """
+            UPDATE daily_rollup_days SET covered_until = %s, built_version = NULL
+            WHERE day = %s AND version = %s AND built_version = version
+            RETURNING day
+            """,
+            (until, day, version)
+        )
+        extended = cursor.fetchone() is not None
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    if not extended:
+        return None
+
+    totals = {}
+
+    def write(path):
+        nonlocal lengths
+        shutil.copyfile(snapshot_path(day), path)
+        with gzip.open(path, "at", newline="", encoding="utf-8") as file:
+            lengths = _write_rows(file, iter_requests_in_period(conn, covered + MICROSECOND, until), lengths, totals)
+
+    _replace_snapshot(day, write)
+    _save_day(conn, day, version, lengths, totals, replace=False)
+    logging.debug("Снимок дня %s дописан до %s", day, until.strftime("%H:%M:%S"))
+    return lengths, version, until
+
+
+# Материализация всех закрытых дней в интервале (например, для планировщика)
+def materialize_days(conn, start_day, end_day):
+    prepare_range(conn, day_bounds(start_day)[0], day_bounds(end_day)[1])
+
+
+def _read_snapshot(day, start, end):
+    with gzip.open(snapshot_path(day), "rt", newline="", encoding="utf-8") as file:
+        for request_id, user_id, branch, content_type, content, timestamp in csv.reader(file):
+            timestamp = datetime.fromisoformat(timestamp)
+            if start <= timestamp <= end:
+                yield int(request_id), int(user_id), branch or None, content_type, content, timestamp
+
+
+# Части интервала: (день, начало, конец)
+def _split_days(start, end):
+    day = start.date()
+    while day <= end.date():
+        day_start, day_end = day_bounds(day)
+        yield day, max(start, day_start), min(end, day_end)
+        day += timedelta(days=1)
+
+
+# Часть дня после конца снимка (её отчёт читает из базы) или None
+def _rest(part_start, part_end, until):
+    start = part_start if until is None else max(part_start, until + MICROSECOND)
+    return (start, part_end) if start <= part_end else None
+
+
+# Части интервала для отчёта: [(день, начало, конец, длины столбцов снимка,
+# версия, до какого момента снимок)]. Снимки проверяются одним запросом и при
+# необходимости строятся или дописываются - один раз за отчёт. Если день ещё
+# не снимался (первые CLOSE_GRACE минут суток), последние три поля - None.
+def prepare_range(conn, start, end, now=None):
+    now = now or datetime.now()
+    parts = list(_split_days(start, end))
+    if not parts:
+        return []
+    info = _days_info(conn, parts[0][0], parts[-1][0])
+    prepared = []
+    for day, part_start, part_end in parts:
+        target = _target(day, now)
+        current = None
+        if target >= day_bounds(day)[0]:
+            current = _current(day, info.get(day))
+            if not _fresh(day, current, target):
+                current = materialize_day(conn, day, target)
+        prepared.append((day, part_start, part_end, *(current or (None, None, None))))
+    return prepared
+
+
+# Ключ отчёта по частям интервала: версии снимков всех дней. None - часть окна
+# читается из базы, и отчёт по такому окну не переиспользуется
+def range_key(parts):
+    if any(until is None or until < part_end for _, _, part_end, _, _, until in parts):
+        return None
+    return [[day.isoformat(), version] for day, _, _, _, version, _ in parts]
+
+
+# Ключ отчёта за интервал без построения снимков (совпадает с range_key после
+# prepare_range): позволяет отдать готовый отчёт, не запуская его формирование
+def window_key(conn, start, end):
+    parts = list(_split_days(start, end))
+    if not parts:
+        return None
+    info = _days_info(conn, parts[0][0], parts[-1][0])
+    key = []
+    for day, _, part_end in parts:
+        current = _current(day, info.get(day))
+        if current is None or current[2] < part_end:
+            return None
+        key.append([day.isoformat(), current[1]])
+    return key
+
+
+# Строки отчёта за интервал в порядке времени: из снимка, остаток дня - из базы
+def iter_range_rows(conn, parts, chunk_size=2000):
+    for day, part_start, part_end, _, _, until in parts:
+        if until is not None:
+            yield from _read_snapshot(day, part_start, min(part_end, until))
+        rest = _rest(part_start, part_end, until)
+        if rest:
+            for row in iter_requests_in_period(conn, *rest, chunk_size):
+                row = list(row)
+                row[-1] = row[-1].replace(tzinfo=None)
+                yield tuple(row)
+
+
+# Максимальные длины значений столбцов за интервал (для ширины столбцов отчёта)
+def range_column_lengths(conn, parts):
+    lengths = [0] * 6
+    for _, part_start, part_end, day_lengths, _, until in parts:
+        if day_lengths is not None:
+            lengths = [max(a, b) for a, b in zip(lengths, day_lengths)]
+        rest = _rest(part_start, part_end, until)
+        if rest:
+            lengths = [max(a, b) for a, b in zip(lengths, period_column_lengths(conn, *rest))]
+    return lengths
+
+
+# Сводка: количество элементов по филиалам и типам содержимого. Дни, покрытые
+# снимком с начала суток, берутся из daily_rollups, часть дня внутри снимка
+# считается по снимку, а база считает только остаток после конца снимка.
+def range_summary(conn, parts):
+    covered_days = []
+    partial = []
+    totals = {}
+    for day, part_start, part_end, _, _, until in parts:
+        if until is not None and part_start == day_bounds(day)[0] and part_end >= until:
+            covered_days.append(day)
+        elif until is not None:
+            for _, _, branch, content_type, _, _ in _read_snapshot(day, part_start, min(part_end, until)):
+                totals[(branch or "", content_type)] = totals.get((branch or "", content_type), 0) + 1
+        rest = _rest(part_start, part_end, until)
+        if rest:
+            partial.append(rest)
+
+    cursor = conn.cursor()
+    try:
+        if covered_days:
+            cursor.execute(
+                """
+                SELECT branch, content_type, sum(items) FROM daily_rollups
+                WHERE day = ANY(%s) GROUP BY branch, content_type
+                """,
+                (covered_days,)
+            )
+            for branch, content_type, items in cursor.fetchall():
+                totals[(branch, content_type)] = totals.get((branch, content_type), 0) + items
+        for part_start, part_end in partial:
+            cursor.execute(
+                """
+                SELECT COALESCE(r.branch, ''), ri.content_type, count(*)
+                FROM requests AS r
+                JOIN request_items AS ri ON r.request_id = ri.request_id
+                WHERE ri.timestamp BETWEEN %s AND %s
+                GROUP BY COALESCE(r.branch, ''), ri.content_type
+                """,
+                (part_start, part_end)
+            )
+            for branch, content_type, items in cursor.fetchall():
+                totals[(branch, content_type)] = totals.get((branch, content_type), 0) + items
+    finally:
+        cursor.close()
+        conn.rollback()
+    return sorted(totals.items())
@@ -1,42 +1,65 @@
 import os
-import smtplib
 import logging
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
 
+from metrics import SMTP_SECONDS, SMTP_ERRORS
 
-# Функция для отправки email
-def send_email(subject, body, to_email, file_path=None):
-    from_email = os.getenv("EMAIL_USER")
-    email_password = os.getenv("EMAIL_PASSWORD")
-    smtp_server = os.getenv("SMTP_SERVER")
-    smtp_port = int(os.getenv("SMTP_PORT"))
+
+# Формирование письма; attachments - список пар (путь к файлу, имя вложения).
+# Модули email и smtplib загружаются при первом письме, а не при запуске бота.
+def build_message(subject, body, to_email, attachments=()):
+    from email import encoders
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
 
     # Настройка MIME
     msg = MIMEMultipart()
-    msg['From'] = from_email
+    msg['From'] = os.getenv("EMAIL_USER")
     msg['To'] = to_email
     msg['Subject'] = subject
     msg.attach(MIMEText(body, 'plain'))
 
-    if file_path:
+    for file_path, filename in attachments:
         with open(file_path, "rb") as attachment:
             part = MIMEBase("application", "octet-stream")
             part.set_payload(attachment.read())
             encoders.encode_base64(part)
             part.add_header(
                 "Content-Disposition",
-                f"attachment; filename={file_path}",
+                "attachment",
+                filename=filename or os.path.basename(file_path),
             )
             msg.attach(part)
+    return msg
+
+
+# Подключение к SMTP-серверу с авторизацией.
+# SMTP_USE_SSL=0 - обычное соединение (например, для локального тестового сервера).
+def connect_smtp(timeout=30):
+    import smtplib
+
+    smtp_server = os.getenv("SMTP_SERVER")
+    smtp_port = int(os.getenv("SMTP_PORT"))
+    if os.getenv("SMTP_USE_SSL", "1") == "1":
+        server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=timeout)
+    else:
+        server = smtplib.SMTP(smtp_server, smtp_port, timeout=timeout)
+    email_password = os.getenv("EMAIL_PASSWORD")
+    if email_password:
+        server.login(os.getenv("EMAIL_USER"), email_password)
+    return server
+
+
+# Функция для отправки email (синхронно, новым соединением)
+def send_email(subject, body, to_email, file_path=None):
+    attachments = [(file_path, None)] if file_path else []
+    msg = build_message(subject, body, to_email, attachments)
 
     # Отправка письма через SMTP
     try:
-        with smtplib.SMTP_SSL(smtp_server, smtp_port) as server:
-            server.login(from_email, email_password)
-            server.sendmail(from_email, to_email, msg.as_string())
+        with SMTP_SECONDS.time(), connect_smtp() as server:
+            server.sendmail(msg['From'], to_email, msg.as_string())
         logging.info("Письмо успешно отправлено!")
     except Exception as e:
-        logging.info(f"Ошибка при отправке письма: {e}")
\ No newline at end of file
+        SMTP_ERRORS.inc()
+        logging.info("Ошибка при отправке письма: %s", e)
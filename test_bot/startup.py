@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+
+# Отсчёт времени запуска: модуль импортируется первым в media_handler
+_STARTED = time.perf_counter()
+
+
+# Время этапов запуска (--startup-profile). Этапы идут друг за другом - mark()
+# закрывает этап, начатый предыдущей отметкой; параллельные этапы (проверка
+# схемы в отдельном потоке) добавляются через record() со своей длительностью.
+class StartupProfile:
+    def __init__(self, started=_STARTED):
+        self.started = started
+        self.enabled = False
+        self.phases = []  # (этап, длительность, момент окончания от начала запуска)
+        self._last = started
+        self._printed = 0
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last, now - self.started))
+        self._last = now
+
+    def record(self, phase, seconds):
+        self.phases.append((phase, seconds, time.perf_counter() - self.started))
+
+    # Печать этапов, появившихся с прошлого вызова
+    def report(self, file=None):
+        if not self.enabled:
+            return
+        phases, self._printed = self.phases[self._printed:], len(self.phases)
+        file = file or sys.stderr
+        for phase, seconds, at in phases:
+            print(f"[startup] {phase:<36} {seconds * 1000:9.1f} мс  (от начала {at * 1000:9.1f} мс)", file=file)
+        file.flush()
+
+
+startup_profile = StartupProfile()
+
+
+# Проверка и миграция схемы БД в отдельном потоке: идёт параллельно с запуском
+# бота - запросами к Telegram, сервером метрик и открытием пула соединений.
+# Задачи, работающие с таблицами, запускаются после wait(). Перед fork (процессы
+# вебхука) проверка дожидается завершения, чтобы дочерние процессы получили
+# готовый результат, а не ждали чужой поток.
+class SchemaCheck:
+    def __init__(self, check):
+        self._check = check
+        self._future = None
+        os.register_at_fork(before=self._join)
+
+    def start(self):
+        if self._future is None:
+            self._future = Future()
+            self._thread = threading.Thread(target=self._run, name="schema-check", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            self._future.set_result(self._check())
+        except BaseException as e:
+            self._future.set_exception(e)
+        finally:
+            startup_profile.record("проверка схемы БД (параллельно)", time.perf_counter() - started)
+
+    def _join(self):
+        if self._future is not None:
+            self._thread.join()
+
+    async def wait(self):
+        self.start()
+        try:
+            await asyncio.wrap_future(self._future)
+        except Exception as e:
+            # Как и раньше при ошибке init_database: бот работает, ошибка в логе
+            logging.error("Проверка схемы базы данных завершилась ошибкой: %s", e)
+
+
+# Внешний middleware обновлений: первое обработанное обновление закрывает профиль запуска
+class FirstUpdateProfile:
+    def __init__(self, profile=startup_profile):
+        self.profile = profile
+        self._first = True
+
+    async def __call__(self, handler, event, data):
+        if not self._first:
+            return await handler(event, data)
+        self._first = False
+        try:
+            return await handler(event, data)
+        finally:
+            self.profile.mark("первое обновление обработано")
+            self.profile.report()
@@ -0,0 +1,48 @@
+import re
+import logging
+
+from psycopg2 import errors
+from psycopg2.extensions import connection as base_connection
+
+
+# Реестр подготовленных запросов. Частые запросы готовятся (PREPARE) один раз
+# на соединение при первом использовании, дальше выполняются через EXECUTE -
+# сервер не разбирает и не планирует их заново. Параметры в тексте - $1, $2, ...
+_statements = {}  # имя -> текст запроса
+_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+# Соединение, которое помнит подготовленные на нём запросы (connection_factory в db.py)
+class StatementConnection(base_connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def register(name, query):
+    if not _NAME.match(name):
+        raise ValueError(f"Некорректное имя запроса: {name}")
+    if _statements.get(name, query) != query:
+        raise ValueError(f"Запрос {name} уже зарегистрирован с другим текстом")
+    _statements[name] = query
+    return name
+
+
+# Текст зарегистрированного запроса (None - нет такого)
+def statement_text(name):
+    return _statements.get(name)
+
+
+def execute(cursor, name, params=()):
+    prepared = cursor.connection.prepared
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {_statements[name]}")
+        prepared.add(name)
+    try:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {name}",
+                       params)
+    except errors.InvalidSqlStatementName:
+        # Подготовленные запросы сброшены на сервере (DISCARD ALL): подготовим заново при следующем вызове
+        logging.warning("Подготовленный запрос %s не найден на соединении, реестр соединения сброшен", name)
+        prepared.clear()
+        raise
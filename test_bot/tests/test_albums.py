@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+from datetime import datetime
+
+from aiogram.types import Message, Chat
+
+from albums import AlbumMiddleware
+
+
+def _message(message_id, media_group_id="g1", chat_id=1):
+    return Message(message_id=message_id, date=datetime.now(), chat=Chat(id=chat_id, type="private"),
+                   media_group_id=media_group_id, text="x")
+
+
+def _data(album=True):
+    return {"handler": SimpleNamespace(flags={"album": True} if album else {})}
+
+
+class Handler:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, event, data):
+        self.calls.append((event.message_id, [message.message_id for message in data.get("album", [])]))
+        return event.message_id
+
+
+async def _deliver(middleware, handler, messages, gap):
+    tasks = []
+    for message in messages:
+        tasks.append(asyncio.create_task(middleware(handler, message, _data())))
+        await asyncio.sleep(gap)
+    return await asyncio.gather(*tasks)
+
+
+# Части, пришедшие в пределах окна, обрабатываются одним вызовом первого сообщения
+def test_parts_within_window_are_coalesced():
+    handler = Handler()
+    middleware = AlbumMiddleware(window=0.1, max_size=10)
+    results = asyncio.run(_deliver(middleware, handler, [_message(3), _message(1), _message(2)], 0.01))
+    assert handler.calls == [(3, [1, 2, 3])]
+    assert results == [3, None, None]
+
+
+def test_part_after_window_starts_new_album():
+    handler = Handler()
+    middleware = AlbumMiddleware(window=0.03, max_size=10)
+    asyncio.run(_deliver(middleware, handler, [_message(1), _message(2)], 0.1))
+    assert handler.calls == [(1, [1]), (2, [2])]
+
+
+def test_full_album_is_handled_without_waiting():
+    handler = Handler()
+    middleware = AlbumMiddleware(window=5, max_size=2)
+
+    async def scenario():
+        return await asyncio.wait_for(_deliver(middleware, handler, [_message(1), _message(2)], 0), 1)
+
+    asyncio.run(scenario())
+    assert handler.calls == [(1, [1, 2])]
+
+
+def test_messages_without_flag_or_group_pass_through():
+    handler = Handler()
+    middleware = AlbumMiddleware(window=5)
+
+    async def scenario():
+        await middleware(handler, _message(1), _data(album=False))
+        await middleware(handler, _message(2, media_group_id=None), _data())
+
+    asyncio.run(scenario())
+    assert handler.calls == [(1, []), (2, [])]
@@ -0,0 +1,61 @@
+import pytest
+
+import cache
+from cache import RequestCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _request(request_id):
+    return {"request_id": request_id, "items": []}
+
+
+def test_get_returns_copy(clock):
+    requests = RequestCache()
+    requests.put(1, _request(1))
+    requests.get(1)["items"].append("changed")
+    assert requests.get(1)["items"] == []
+    assert requests.stats()["hits"] == 2
+
+
+def test_entries_expire_after_ttl(clock):
+    requests = RequestCache(ttl=10)
+    requests.put(1, _request(1))
+    clock[0] = 10
+    assert requests.get(1) is not None
+    clock[0] = 10.5
+    assert requests.get(1) is None
+    assert len(requests) == 0 and requests.stats()["misses"] == 1
+
+
+def test_least_recently_used_is_evicted(clock):
+    requests = RequestCache(max_size=2)
+    requests.put(1, _request(1))
+    requests.put(2, _request(2))
+    requests.get(1)
+    requests.put(3, _request(3))
+    assert requests.get(2) is None
+    assert requests.get(1) is not None and requests.get(3) is not None
+
+
+# Агрегат, прочитанный до изменения обращения, в кэш не попадает
+def test_put_skips_request_changed_during_read(clock):
+    requests = RequestCache()
+    since = requests.version()
+    requests.invalidate(1)
+    requests.put(1, _request(1), since=since)
+    assert requests.get(1) is None
+    requests.put(2, _request(2), since=since)
+    assert requests.get(2) is not None
+
+
+def test_disabled_cache_stores_nothing(clock):
+    requests = RequestCache()
+    requests.enabled = False
+    requests.put(1, _request(1))
+    assert requests.get(1) is None and len(requests) == 0
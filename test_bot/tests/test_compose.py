@@ -0,0 +1,72 @@
+from aiogram.methods import SendMessage, SendMediaGroup, SendPhoto, SendVoice
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from compose import MediaSet, compose, for_chat, split_text, CAPTION_LIMIT, TEXT_LIMIT
+
+
+def _items(*types):
+    return [{"content_type": content_type, "content": f"{content_type}{index}"}
+            for index, content_type in enumerate(types)]
+
+
+MARKUP = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Ответить", callback_data="reply")]])
+
+
+# Альбомы примерно одного размера, голосовые - отдельно и в конце
+def test_media_set_splits_albums_evenly():
+    media = MediaSet(_items(*["photo"] * 11, "voice"))
+    assert [len(unit) if isinstance(unit, list) else unit[0] for unit in media.units] == [6, 5, "voice"]
+
+
+def test_media_set_single_visual_is_not_an_album():
+    media = MediaSet(_items("video"))
+    assert media.units == [("video", "video0")]
+
+
+def test_media_set_empty():
+    assert not MediaSet(_items())
+    assert not MediaSet(_items("text"))
+
+
+def test_compose_text_only_is_split_by_limit():
+    methods = compose(None, "a" * (TEXT_LIMIT + 10), MARKUP)
+    assert [type(method) for method in methods] == [SendMessage, SendMessage]
+    assert methods[0].reply_markup is None and methods[1].reply_markup is MARKUP
+
+
+def test_compose_short_text_becomes_album_caption():
+    methods = compose(MediaSet(_items("photo", "video")), "Подпись")
+    assert len(methods) == 1 and isinstance(methods[0], SendMediaGroup)
+    assert methods[0].media[0].caption == "Подпись" and methods[0].media[1].caption is None
+
+
+def test_compose_long_caption_goes_to_separate_message():
+    text = "b" * (CAPTION_LIMIT + 1)
+    methods = compose(MediaSet(_items("photo")), text)
+    assert [type(method) for method in methods] == [SendPhoto, SendMessage]
+    assert methods[0].caption is None and methods[1].text == text
+
+
+# Кнопки нельзя прикрепить к альбому: подпись и кнопки - на первое одиночное медиа
+def test_compose_markup_goes_to_single_media():
+    methods = compose(MediaSet(_items("photo", "photo", "voice")), "Подпись", MARKUP)
+    assert [type(method) for method in methods] == [SendMediaGroup, SendVoice]
+    assert methods[1].caption == "Подпись" and methods[1].reply_markup is MARKUP
+    assert methods[0].media[0].caption is None
+
+
+def test_compose_markup_with_albums_only_adds_text_message():
+    methods = compose(MediaSet(_items("photo", "photo")), "Подпись", MARKUP)
+    assert [type(method) for method in methods] == [SendMediaGroup, SendMessage]
+    assert methods[1].reply_markup is MARKUP
+
+
+def test_for_chat_copies_methods():
+    methods = compose(None, "Текст")
+    copies = for_chat(methods, 42)
+    assert copies[0].chat_id == 42 and methods[0].chat_id == 0
+
+
+def test_split_text_prefers_line_breaks():
+    assert split_text("abc\ndef", limit=5) == ["abc", "def"]
+    assert split_text("abcdefgh", limit=5) == ["abcde", "fgh"]
@@ -0,0 +1,58 @@
+import pytest
+from aiogram.methods import SendMessage, SendMediaGroup
+from aiogram.types import InputMediaPhoto
+
+import delivery
+from delivery import TokenBucket, DeliveryScheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(delivery.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_burst_up_to_capacity(clock):
+    bucket = TokenBucket(rate=1.0, capacity=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(1.0)
+    assert bucket.reserve() == pytest.approx(2.0)
+
+
+def test_bucket_refills_over_time_without_exceeding_capacity(clock):
+    bucket = TokenBucket(rate=2.0, capacity=2)
+    bucket.reserve(2)
+    clock.now += 0.5
+    assert bucket.reserve() == 0.0
+    clock.now += 100
+    bucket.reserve()
+    assert bucket.tokens == pytest.approx(1.0)
+
+
+def test_bucket_cost(clock):
+    bucket = TokenBucket(rate=10.0, capacity=10)
+    assert bucket.reserve(15) == pytest.approx(0.5)
+
+
+def test_bucket_block_delays_reservations(clock):
+    bucket = TokenBucket(rate=1.0, capacity=5)
+    bucket.block(7)
+    assert bucket.reserve() == pytest.approx(7.0)
+    clock.now += 7
+    assert bucket.reserve() == 0.0
+
+
+# Для общего лимита альбом стоит по сообщению на элемент
+def test_album_cost():
+    album = SendMediaGroup(chat_id=1, media=[InputMediaPhoto(media=f"p{index}") for index in range(4)])
+    assert DeliveryScheduler._cost(album) == 4
+    assert DeliveryScheduler._cost(SendMessage(chat_id=1, text="a")) == 1
@@ -0,0 +1,72 @@
+import asyncio
+
+from drafts import DraftBuffer
+
+
+class Writer:
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+
+    async def __call__(self, rows):
+        if self.fail:
+            raise RuntimeError("база недоступна")
+        self.batches.append(rows)
+
+
+def test_full_after_flush_size():
+    buffer = DraftBuffer(Writer(), flush_size=3)
+    for index in range(2):
+        buffer.add(1, "text", f"t{index}")
+    assert not buffer.full(1)
+    buffer.add(1, "text", "t2")
+    assert buffer.full(1) and not buffer.full(2)
+
+
+def test_flush_writes_pending_items_once():
+    writer = Writer()
+    buffer = DraftBuffer(writer)
+    buffer.add(1, "text", "a")
+    buffer.add(2, "photo", "p", "u")
+    asyncio.run(buffer.flush())
+    assert sorted((row[1], row[3]) for row in writer.batches[0]) == [(1, "a"), (2, "p")]
+    assert len(buffer) == 0
+    asyncio.run(buffer.flush())
+    assert len(writer.batches) == 1
+
+
+def test_failed_flush_keeps_items_pending():
+    writer = Writer()
+    buffer = DraftBuffer(writer, max_attempts=2)
+    buffer.add(1, "text", "a")
+    writer.fail = True
+    asyncio.run(buffer.flush())
+    assert [item["content"] for item in buffer.pending(1)] == ["a"]
+    asyncio.run(buffer.flush())  # Вторая неудача подряд - черновик отброшен
+    assert buffer.pending(1) == []
+
+
+def test_discard_drops_items_without_writing():
+    writer = Writer()
+    buffer = DraftBuffer(writer)
+    buffer.add(1, "text", "a")
+    dropped = asyncio.run(buffer.discard(1))
+    assert [item["content"] for item in dropped] == ["a"]
+    asyncio.run(buffer.flush())
+    assert writer.batches == []
+
+
+def test_timer_flushes_in_background():
+    writer = Writer()
+    buffer = DraftBuffer(writer, flush_interval=0.01)
+
+    async def scenario():
+        buffer.start()
+        buffer.add(1, "text", "a")
+        await asyncio.sleep(0.05)
+        flushed = len(writer.batches)
+        await buffer.stop()
+        return flushed
+
+    assert asyncio.run(scenario()) == 1
+    assert len(buffer) == 0
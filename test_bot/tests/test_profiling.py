@@ -0,0 +1,33 @@
+from profiling import normalize, explainable
+
+
+def test_normalize_replaces_literals_and_placeholders():
+    assert normalize("SELECT * FROM t WHERE a = 'x''y' AND b = 42 AND c = %s;") == \
+        "SELECT * FROM t WHERE a = ? AND b = ? AND c = ?"
+    assert normalize(b"SELECT  %(id)s,\n  -1.5") == "SELECT ?, ?"
+
+
+def test_normalize_keeps_identifiers_with_digits():
+    assert normalize("SELECT col1 FROM request_items_2024_01") == "SELECT col1 FROM request_items_2024_01"
+
+
+# Пачки VALUES и списки IN разной длины сводятся к одному запросу
+def test_normalize_collapses_value_lists():
+    assert normalize("INSERT INTO t VALUES (1, 'a'), (2, 'b')") == normalize("INSERT INTO t VALUES (3, 'c')")
+    assert normalize("SELECT 1 FROM t WHERE id IN (1, 2, 3)") == "SELECT ? FROM t WHERE id IN (...)"
+
+
+def test_explainable_accepts_plain_select():
+    assert explainable("SELECT count(*) FROM requests WHERE created_at >= now()")
+    assert explainable("  select coalesce(max(id), 0) from requests")
+
+
+def test_explainable_rejects_writes_locks_and_unknown_calls():
+    assert not explainable("UPDATE requests SET status = 'done'")
+    assert not explainable("SELECT * FROM requests FOR UPDATE")
+    assert not explainable("SELECT nextval('requests_request_id_seq')")
+    assert not explainable("EXECUTE get_request (1)")
+
+
+def test_explainable_ignores_calls_inside_strings():
+    assert explainable("SELECT * FROM requests WHERE comment = 'pg_sleep(10)'")
@@ -0,0 +1,19 @@
+from datetime import datetime, time
+
+from reports import _last_due
+
+
+def test_daily_schedule():
+    at = time(9, 0)
+    assert _last_due(None, at, datetime(2024, 5, 15, 10, 0)) == datetime(2024, 5, 15, 9, 0)
+    assert _last_due(None, at, datetime(2024, 5, 15, 9, 0)) == datetime(2024, 5, 15, 9, 0)
+    assert _last_due(None, at, datetime(2024, 5, 15, 8, 59)) == datetime(2024, 5, 14, 9, 0)
+
+
+def test_weekly_schedule():
+    at = time(8, 30)
+    # 2024-05-15 - среда (2), отчёт по понедельникам (0)
+    assert _last_due(0, at, datetime(2024, 5, 15, 12, 0)) == datetime(2024, 5, 13, 8, 30)
+    assert _last_due(0, at, datetime(2024, 5, 13, 8, 30)) == datetime(2024, 5, 13, 8, 30)
+    assert _last_due(0, at, datetime(2024, 5, 13, 8, 0)) == datetime(2024, 5, 6, 8, 30)
+    assert _last_due(2, at, datetime(2024, 5, 15, 12, 0)) == datetime(2024, 5, 15, 8, 30)
@@ -0,0 +1,142 @@
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+from aiohttp import web
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import setup_application
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Число процессов вебхука; при нескольких процессах память у каждого своя
+WEBHOOK_PROCESSES = int(os.getenv("WEBHOOK_PROCESSES", 1))
+
+# Режим вебхука: aiohttp-сервер принимает обновления, сразу отвечает Telegram
+# и ставит обновление в ограниченную очередь, которую разбирают воркеры.
+# Для локальной проверки достаточно не задавать WEBHOOK_URL и отправить
+# сохранённое обновление:
+#   curl -X POST -H "Content-Type: application/json" -d @update.json http://127.0.0.1:8080/webhook
+
+
+class UpdateWorkers:
+    def __init__(self, dp, bot, workers=8, queue_size=1000, secret_token=None):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.secret_token = secret_token
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    # Приём обновления: проверка, разбор и постановка в очередь без обработки
+    async def handle(self, request):
+        if self.secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.warning("Некорректное обновление: %s", e)
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            logging.warning("Очередь обновлений переполнена")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _work(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logging.exception("Ошибка при обработке обновления %s: %s", update.update_id, e)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, app):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    # Дорабатываем принятые обновления перед остановкой
+    async def stop(self, app, timeout=10.0):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Не обработано обновлений при остановке: %s", self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+def create_app(dp, bot, path="/webhook", workers=8, queue_size=1000, secret_token=None):
+    update_workers = UpdateWorkers(dp, bot, workers=workers, queue_size=queue_size, secret_token=secret_token)
+    app = web.Application()
+    app.router.add_post(path, update_workers.handle)
+    # Очередь запускается до и останавливается до событий диспетчера,
+    # чтобы обработчики успели завершиться при открытом пуле соединений
+    app.on_startup.append(update_workers.start)
+    app.on_shutdown.append(update_workers.stop)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def _serve(dp, bot, host, port, path, workers, queue_size, secret_token, reuse_port, index=0):
+    os.environ["METRICS_PROCESS_INDEX"] = str(index)  # У каждого процесса свой порт метрик
+    app = create_app(dp, bot, path=path, workers=workers, queue_size=queue_size, secret_token=secret_token)
+    web.run_app(app, host=host, port=port, reuse_port=reuse_port, print=None)
+
+
+async def _set_webhook(bot, dp, url, secret_token):
+    try:
+        await bot.set_webhook(url, secret_token=secret_token,
+                              allowed_updates=dp.resolve_used_update_types())
+        logging.info("Вебхук установлен: %s", url)
+    finally:
+        await bot.session.close()
+
+
+# Запуск в режиме вебхука. При processes > 1 несколько процессов слушают
+# один порт (SO_REUSEPORT), ядро распределяет между ними соединения.
+def run_webhook(dp, bot):
+    host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    port = int(os.getenv("WEBHOOK_PORT", 8080))
+    path = os.getenv("WEBHOOK_PATH", "/webhook")
+    url = os.getenv("WEBHOOK_URL")  # Публичный адрес; без него вебхук в Telegram не регистрируется
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    workers = int(os.getenv("WEBHOOK_WORKERS", 8))
+    queue_size = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+    processes = WEBHOOK_PROCESSES
+
+    if url:
+        asyncio.run(_set_webhook(bot, dp, url.rstrip("/") + path, secret_token))
+
+    args = (dp, bot, host, port, path, workers, queue_size, secret_token)
+    if processes <= 1:
+        _serve(*args, reuse_port=False)
+        return
+
+    if os.getenv("FSM_STORAGE", "postgres") == "memory":
+        logging.warning("FSM_STORAGE=memory не разделяется между процессами вебхука")
+
+    # fork: процессы получают уже настроенные dp и bot без повторного импорта
+    context = multiprocessing.get_context("fork")
+    children = [context.Process(target=_serve, args=args, kwargs={"reuse_port": True, "index": index},
+                                daemon=False)
+                for index in range(processes)]
+    for child in children:
+        child.start()
+    logging.info("Запущено процессов вебхука: %s, порт %s", processes, port)
+
+    def stop(signum, frame):
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        child.join()